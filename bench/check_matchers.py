@@ -0,0 +1,193 @@
+"""
+Checks that the matchers and diffs of snapshots find the same fixes as
+match_dns_records on randomised datasets of bench.datagen.
+
+    python -m bench.check_matchers [--trials=N] [--domains=N] [--records=N] [--match-workers=N]
+
+Every trial generates a dataset with its own seed and rates, then adds
+PowerDNS records with NULL names and contents (their hashes are read as '')
+and Hub records with NULL contents and with duplicate hashes. Exits with 1
+if any matcher differs.
+"""
+import getopt
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from operator import itemgetter
+
+from bench.datagen import generate
+
+DEFAULT_TRIALS = 50
+DEFAULT_DOMAINS = 20
+DEFAULT_RECORDS = 30
+DEFAULT_MATCH_WORKERS = 3
+# all records of a dataset are diffed as one domain, their hashes cover the host names
+SNAPSHOT_DOMAIN = 'check.example'
+
+__long_options = [
+    ('trials=', "Number of datasets (default is {}).".format(DEFAULT_TRIALS)),
+    ('domains=', "Domains of a dataset (default is {}).".format(DEFAULT_DOMAINS)),
+    ('records=', "Hub records per domain (default is {}).".format(DEFAULT_RECORDS)),
+    ('match-workers=', "Processes of the sharded matcher, 0 skips it (default is {}).".format(
+        DEFAULT_MATCH_WORKERS)),
+]
+
+
+def _add_irregular_records(pdns_records, hub_records, hub_idn_hosts, rnd):
+    next_id = max(rec[0] for rec in pdns_records) + 1
+    hub_count = len(hub_records)
+    for _ in xrange(rnd.randint(0, 5)):
+        pdns_records.append(
+            (next_id, '', 'A', '', rnd.choice((300, 3600)), 0, 1, 'domain0.example', '', ''))
+        next_id += 1
+    for _ in xrange(rnd.randint(0, 5)):
+        hub_records.append(('A', None, rnd.choice((300, 3600)), None, None, 100001))
+        hub_idn_hosts.append('null.domain0.example')
+    # the last of Hub records with the same rec_hash gives the TTL
+    for pos in rnd.sample(xrange(hub_count), rnd.randint(0, 10)):
+        (rr_type, rec_data, ttl, rec_hash, _, domain_id) = hub_records[pos]
+        ttl_key = hub_idn_hosts[pos] + rr_type + rec_data + str(ttl * 2)
+        hub_records.append(
+            (rr_type, rec_data, ttl * 2, rec_hash, hashlib.md5(ttl_key).hexdigest(), domain_id))
+        hub_idn_hosts.append(hub_idn_hosts[pos])
+
+
+def make_trial(trial, domains, records):
+    """
+    Returns (powerdns_records ordered by rec_id descending, hub_records,
+    idn_host of every Hub record) of a dataset
+    """
+    rnd = random.Random(trial)
+    dataset = generate(domains, records, duplicate_rate=rnd.uniform(0, 0.2),
+                       ttl_drift_rate=rnd.uniform(0, 0.2), phantom_rate=rnd.uniform(0, 0.2),
+                       seed=trial)
+    pdns_records = [rec for recs in dataset.powerdns_records.values() for rec in recs]
+    hub_records = [rec for recs in dataset.hub_records.values() for rec in recs]
+    hub_idn_hosts = [idn_host for domain_id in dataset.hub_records
+                     for idn_host in dataset.hub_idn_hosts[domain_id]]
+    _add_irregular_records(pdns_records, hub_records, hub_idn_hosts, rnd)
+    pdns_records.sort(key=itemgetter(0), reverse=True)
+    return (pdns_records, hub_records, hub_idn_hosts)
+
+
+def _merge_results(pdns_records, hub_records, hub_idn_hosts):
+    from processing.merge_matcher import HUB_REC_HASH, PDNS_REC_HASH, merge_match_dns_records
+
+    # the sorts are stable, as the orders of the queries of the merge matcher
+    return merge_match_dns_records(
+        sorted(pdns_records, key=itemgetter(PDNS_REC_HASH)),
+        sorted(hub_records, key=itemgetter(HUB_REC_HASH)))[:2]
+
+
+def _numpy_results(pdns_records, hub_records, hub_idn_hosts):
+    from processing.numpy_matcher import index_hub_records_array, numpy_match_dns_records
+    from processing.record_store import PowerDnsRecordStore
+
+    return numpy_match_dns_records(
+        PowerDnsRecordStore.from_rows(pdns_records, keep_fields=False),
+        *index_hub_records_array(hub_records)[:-1])[:2]
+
+
+def _client_hashing_results(pdns_records, hub_records, hub_idn_hosts):
+    from db.hashing import hash_hub_rows, hash_powerdns_rows
+    from processing.synchronizer import match_dns_records
+
+    # rows as the queries return them without hashes, see db.hashing
+    return match_dns_records(
+        list(hash_powerdns_rows(rec[:8] for rec in pdns_records)),
+        list(hash_hub_rows(rec[:3] + (idn_host, rec[5])
+                           for (rec, idn_host) in zip(hub_records, hub_idn_hosts))))
+
+
+def _sharded_results(pdns_records, hub_records, hub_idn_hosts):
+    from processing.record_store import PowerDnsRecordStore
+    from processing.sharded_matcher import index_hub_records_sharded, sharded_match_dns_records
+
+    # match_dns_records shards only chunks of MIN_SHARDED_RECORDS and more
+    return sharded_match_dns_records(
+        PowerDnsRecordStore.from_rows(pdns_records, keep_fields=False),
+        *index_hub_records_sharded(hub_records)[:-1])[:2]
+
+
+def _snapshot_results(pdns_records, hub_records, hub_idn_hosts):
+    from processing.snapshot import (
+        KIND_HUB,
+        KIND_POWERDNS,
+        Snapshot,
+        SnapshotWriter,
+        diff_snapshots,
+    )
+
+    directory = tempfile.mkdtemp(prefix='check_matchers_')
+    try:
+        powerdns_path = os.path.join(directory, KIND_POWERDNS)
+        hub_path = os.path.join(directory, KIND_HUB)
+        with SnapshotWriter(powerdns_path, KIND_POWERDNS, host_id=1) as writer:
+            writer.add_powerdns_domain(1, SNAPSHOT_DOMAIN, pdns_records)
+        with SnapshotWriter(hub_path, KIND_HUB) as writer:
+            writer.add_hub_domain(1, SNAPSHOT_DOMAIN, hub_records)
+        with Snapshot(powerdns_path) as powerdns_snapshot, Snapshot(hub_path) as hub_snapshot:
+            # [(domain_name, upd_map, del_set, powerdns_rec_dict)] of the only domain
+            return list(diff_snapshots(powerdns_snapshot, hub_snapshot))[0][1:3]
+    finally:
+        shutil.rmtree(directory)
+
+
+# name: fn(powerdns_records, hub_records, hub_idn_hosts) -> (upd_map, del_set)
+MATCHERS = [
+    ('merge', _merge_results),
+    ('numpy', _numpy_results),
+    ('client-hashing', _client_hashing_results),
+    ('sharded', _sharded_results),
+    ('snapshot', _snapshot_results),
+]
+
+
+def available_matchers():
+    from processing.numpy_matcher import numpy_available
+    from processing.sharded_matcher import sharding_enabled
+
+    available = {'numpy': numpy_available(), 'sharded': sharding_enabled()}
+    return [(name, match_fn) for (name, match_fn) in MATCHERS if available.get(name, True)]
+
+
+def check(trials, domains, records):
+    """Returns a list of differences"""
+    from processing.synchronizer import match_dns_records
+
+    failed = []
+    for trial in xrange(trials):
+        pdns_records, hub_records, hub_idn_hosts = make_trial(trial, domains, records)
+        expected = match_dns_records(pdns_records, hub_records)
+        for (name, match_fn) in available_matchers():
+            if match_fn(pdns_records, hub_records, hub_idn_hosts) != expected:
+                failed.append("{}: trial {} differs from match_dns_records".format(name, trial))
+    return failed
+
+
+def main(argv):
+    from processing.sharded_matcher import set_match_workers
+
+    opts, _ = getopt.getopt(argv, '', dict(__long_options).keys())
+    opts = dict(opts)
+    trials = int(opts.get('--trials', DEFAULT_TRIALS))
+    set_match_workers(int(opts.get('--match-workers', DEFAULT_MATCH_WORKERS)))
+    failed = check(trials, int(opts.get('--domains', DEFAULT_DOMAINS)),
+                   int(opts.get('--records', DEFAULT_RECORDS)))
+    for line in failed:
+        print line
+    print "{} trials of {}: {}".format(
+        trials, ', '.join(name for (name, _) in available_matchers()),
+        'FAILED' if failed else 'OK')
+    set_match_workers(0)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
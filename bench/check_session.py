@@ -0,0 +1,170 @@
+"""
+Checks remote sessions of db.session with fake Requests: batching of statements
+into round trips, splitting of the output by RESULT_MARKER, retries and quoting
+of SQL in the here-document of the remote command.
+
+    python -m bench.check_session
+
+Remote commands are run by sh, and by bash when it is installed, with psql
+replaced by sed, which prints the statements of the script and the markers of
+its \\echo lines. Exits with 1 if any check fails.
+"""
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+from db.session import (
+    MAX_SCRIPT_SIZE,
+    PSQL_CMD,
+    RESULT_MARKER,
+    RETVAR,
+    RemoteQueryError,
+    RemoteSession,
+    _terminate,
+    split_script_output,
+)
+
+ECHO_PSQL = "sed -e 's/^\\\\echo //'"
+# stops as psql with ON_ERROR_STOP at a statement which selects 'fail'
+FAILING_PSQL = "sed -e 's/^\\\\echo //' -e \"/'fail'/Q3\""
+QUOTED_STATEMENTS = [
+    "SELECT 'it''s', \"name\"",
+    "SELECT '$HOME', $$dollar quoted$$, $1, '`id`', '$(id)'",
+    "SELECT E'back\\\\slash\\n', '\\\\N', 'tab\there'",
+    "SELECT '!#&;|<>*?[]{}~'",
+    "COPY powerdns_sync_stage (value) FROM STDIN;\na\\tb\\\\c\n'd'\n\\.",
+]
+
+
+class _ShellRequest(object):
+    """Runs a remote command locally, see _ShellRequestFactory"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._command = None
+
+    def command(self, command_body, valid_exit_codes, stdout, stderr, retvar):
+        self._command = command_body
+
+    def perform(self):
+        factory = self._factory
+        factory.requests += 1
+        factory.command_sizes.append(len(self._command))
+        if factory.transport_failures > 0:
+            factory.transport_failures -= 1
+            raise IOError("Connection reset by the fake host")
+        with tempfile.NamedTemporaryFile(prefix='check_session_') as script:
+            script.write(self._command.replace(PSQL_CMD, factory.psql_cmd))
+            script.flush()
+            proc = subprocess.Popen([factory.shell, script.name],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+        return {RETVAR: str(proc.returncode), 'stdout': stdout, 'stderr': stderr}
+
+
+class _ShellRequestFactory(object):
+    """
+    Replaces utils.remote.Request, psql of remote commands is replaced by psql_cmd.
+    The first transport_failures requests fail before the command is run.
+    """
+    def __init__(self, shell, psql_cmd=ECHO_PSQL, transport_failures=0):
+        self.shell = shell
+        self.psql_cmd = psql_cmd
+        self.transport_failures = transport_failures
+        self.requests = 0
+        self.command_sizes = []
+
+    def __call__(self, host_id, login, password):
+        return _ShellRequest(self)
+
+
+def _shells():
+    return [shell for shell in ('sh', 'bash')
+            if any(os.access(os.path.join(path, shell), os.X_OK)
+                   for path in os.environ.get('PATH', '').split(os.pathsep))]
+
+
+def _echoed(sql_list):
+    return [_terminate(sql) for sql in sql_list]
+
+
+def check_quoting(shell, compress):
+    factory = _ShellRequestFactory(shell)
+    results = RemoteSession(1, factory).query_batch(QUOTED_STATEMENTS, compress)
+    if results != _echoed(QUOTED_STATEMENTS):
+        return ["quoting: statements are changed on the way to psql: {!r}".format(results)]
+    return []
+
+
+def check_batching(shell, compress):
+    # 25 statements of 10KB, 9 of them fit into a script
+    sql_list = ["SELECT {}, '{}'".format(pos, 'x' * 10 * 1024) for pos in xrange(25)]
+    factory = _ShellRequestFactory(shell)
+    session = RemoteSession(1, factory)
+    failed = []
+    if session.query_batch(sql_list, compress) != _echoed(sql_list):
+        failed.append("batching: outputs are lost or out of order")
+    if session.round_trips != 3 or session.statements != len(sql_list):
+        failed.append("batching: {} statements in {} round trips, expected 25 in 3".format(
+            session.statements, session.round_trips))
+    if max(factory.command_sizes) > MAX_SCRIPT_SIZE + 1024:
+        failed.append("batching: a command of {} bytes".format(max(factory.command_sizes)))
+    return failed
+
+
+def check_marker_split():
+    output = "\n 1\n{0}\n\n {0}  \n a | b\n c | d\n{0}\n".format(RESULT_MARKER)
+    results = split_script_output(output)
+    if results != ['1', '', 'a | b\n c | d']:
+        return ["marker split: {!r}".format(results)]
+    return []
+
+
+def check_retries(shell, compress):
+    failed = []
+    factory = _ShellRequestFactory(shell, transport_failures=1)
+    if RemoteSession(1, factory, retries=1).query_batch(['SELECT 1'], compress) != ['SELECT 1;']:
+        failed.append("retries: a transport failure is not retried")
+
+    factory = _ShellRequestFactory(shell, transport_failures=2)
+    try:
+        RemoteSession(1, factory, retries=1).query_batch(['SELECT 1'], compress)
+        failed.append("retries: a repeated transport failure is not raised")
+    except IOError:
+        pass
+
+    factory = _ShellRequestFactory(shell, psql_cmd=FAILING_PSQL)
+    try:
+        RemoteSession(1, factory, retries=1).query_batch(
+            ['SELECT 1', "SELECT 'fail'", 'SELECT 3'], compress)
+        failed.append("retries: a failed statement is not raised")
+    except RemoteQueryError:
+        if factory.requests != 1:
+            failed.append("retries: a failed statement is retried")
+    return failed
+
+
+def check():
+    """Returns a list of failed checks"""
+    failed = check_marker_split()
+    for shell in _shells():
+        for compress in (False, True):
+            for check_fn in (check_quoting, check_batching, check_retries):
+                failed.extend("{}{}: {}".format(shell, ', compressed' if compress else '', line)
+                              for line in check_fn(shell, compress))
+    return failed
+
+
+def main(argv):
+    failed = check()
+    for line in failed:
+        print line
+    print "session checks with {}: {}".format(
+        ', '.join(_shells()), 'FAILED' if failed else 'OK')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+"""
+Synthetic Hub and PowerDNS datasets for benchmarks.
+"""
+import hashlib
+import random
+
+RR_TYPES = ('A', 'AAAA', 'CNAME', 'TXT', 'MX', 'NS')
+
+
+def _md5(value):
+    return hashlib.md5(value).hexdigest()
+
+
+class Dataset(object):
+    """
+    powerdns_domains: [(domain_id, domain_name), ...]
+    hub_domains: {domain_name: hub_domain_id}
+    powerdns_records: {domain_id: [(rec_id, idn_host, rr_type, rec_data, ttl, prio,
+                                    domain_id, domain_name, rec_hash, ttl_hash), ...]}
+    hub_records: {hub_domain_id: [(rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id), ...]}
+    hub_idn_hosts: {hub_domain_id: [idn_host of every record of hub_records, ...]}
+    """
+    def __init__(self):
+        self.powerdns_domains = []
+        self.hub_domains = {}
+        self.powerdns_records = {}
+        self.hub_records = {}
+        self.hub_idn_hosts = {}
+
+    def records_count(self):
+        return sum(len(recs) for recs in self.powerdns_records.values())
+
+
+def generate(domains, records_per_domain, duplicate_rate=0.01, ttl_drift_rate=0.01,
+             phantom_rate=0.005, seed=1):
+    """
+    Every domain gets records_per_domain Hub records which are copied to PowerDNS,
+    then the given shares of PowerDNS records are duplicated, get another TTL or
+    are added without a Hub counterpart.
+    """
+    rnd = random.Random(seed)
+    dataset = Dataset()
+    for domain_idx in xrange(domains):
+        domain_id = domain_idx + 1
+        hub_domain_id = domain_id + 100000
+        domain_name = 'domain{}.example'.format(domain_idx)
+        dataset.powerdns_domains.append((domain_id, domain_name))
+        dataset.hub_domains[domain_name] = hub_domain_id
+
+        hub_recs = []
+        hub_idn_hosts = []
+        pdns_recs = []
+
+        def add_powerdns_rec(idn_host, rr_type, rec_data, ttl, prio):
+            rec_id = domain_id * (records_per_domain * 3 + 1) + len(pdns_recs)
+            pdns_recs.append((
+                rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name,
+                _md5(idn_host + rr_type + rec_data),
+                _md5(idn_host + rr_type + rec_data + str(ttl)),
+            ))
+
+        for rec_idx in xrange(records_per_domain):
+            rr_type = RR_TYPES[rec_idx % len(RR_TYPES)]
+            idn_host = 'host{}.{}'.format(rec_idx, domain_name)
+            prio = 10 if rr_type == 'MX' else 0
+            rec_data = 'value{}-{}'.format(rec_idx, rnd.randint(0, 1 << 30))
+            if rr_type == 'MX':
+                rec_data = '{} {}'.format(prio, rec_data)
+            ttl = rnd.choice((300, 3600, 86400))
+            rec_hash = _md5(idn_host + rr_type + rec_data)
+            hub_recs.append((rr_type, rec_data, ttl, rec_hash,
+                             _md5(idn_host + rr_type + rec_data + str(ttl)), hub_domain_id))
+            hub_idn_hosts.append(idn_host)
+
+            pdns_ttl = ttl * 2 if rnd.random() < ttl_drift_rate else ttl
+            add_powerdns_rec(idn_host, rr_type, rec_data, pdns_ttl, prio)
+            if rnd.random() < duplicate_rate:
+                add_powerdns_rec(idn_host, rr_type, rec_data, pdns_ttl, prio)
+            if rnd.random() < phantom_rate:
+                add_powerdns_rec(idn_host, rr_type, rec_data + '-deleted', ttl, prio)
+
+        dataset.hub_records[hub_domain_id] = hub_recs
+        dataset.hub_idn_hosts[hub_domain_id] = hub_idn_hosts
+        dataset.powerdns_records[domain_id] = pdns_recs
+    return dataset
@@ -0,0 +1,312 @@
+"""
+In-process stand-ins for PowerDNS hosts (a fake utils.remote.Request) and for
+the Hub database connection, both serving a bench.datagen.Dataset.
+
+They recognise the queries built by db.references by their shape, so they
+have to follow changes of the SQL there.
+"""
+import base64
+import csv
+import gzip
+import hashlib
+import re
+
+from cStringIO import StringIO
+
+from db.references import HUB_NULL_HASH, POWERDNS_NULL_HASH
+from db.session import RESULT_MARKER, SCRIPT_EOF
+
+_IN_LIST_RE = re.compile(r"domain_id in \(([^)]*)\)", re.IGNORECASE)
+_NAMES_RE = re.compile(r"'([^']*)'")
+_VALUES_RE = re.compile(r"\(([^()]*)\)")
+_STAGED_RE = re.compile(r"^SELECT value FROM (\w+)$")
+_COPY_FROM_RE = re.compile(r"^COPY (\w+) \(value\) FROM STDIN;\n(.*)\\\.$", re.DOTALL)
+_COPY_RE = re.compile(r"^\s*COPY \((.*)\) TO STDOUT WITH CSV\s*$", re.DOTALL)
+
+
+def _staged_values(in_list, staged):
+    """Values of an IN list which selects from a staging table (see db.staging)"""
+    match = _STAGED_RE.match(in_list.strip())
+    return staged[match.group(1)] if match else None
+
+
+def _ids_in(sql, staged):
+    match = _IN_LIST_RE.search(sql)
+    if not match:
+        return []
+    values = _staged_values(match.group(1), staged)
+    if values is not None:
+        return [int(x) for x in values]
+    return [int(x) for x in match.group(1).split(',') if x.strip()]
+
+
+def _names_in(sql, clause, staged):
+    start = sql.find(clause)
+    if start < 0:
+        return None
+    start = sql.find('(', start + len(clause))
+    end = sql.find(')', start)
+    values = _staged_values(sql[start + 1:end], staged)
+    if values is not None:
+        return set(values)
+    return set(_NAMES_RE.findall(sql[start:end]))
+
+
+def _stage(sql, staged):
+    """Answers statements of db.staging, returns False for other statements"""
+    if sql.startswith(('CREATE TEMP TABLE', 'ANALYZE')):
+        return True
+    if sql.startswith('DROP TABLE'):
+        staged.pop(sql.split()[-1], None)
+        return True
+    match = _COPY_FROM_RE.match(sql)
+    if match:
+        staged[match.group(1)] = match.group(2).splitlines()
+        return True
+    return False
+
+
+def _digest(ttl_hashes):
+    return hashlib.md5(','.join(sorted(ttl_hashes))).hexdigest()
+
+
+def _psql_output(rows):
+    return '\n'.join(' ' + ' | '.join(str(cell) for cell in row) for row in rows)
+
+
+def _csv_output(rows):
+    buf = StringIO()
+    csv.writer(buf, lineterminator='\n').writerows(rows)
+    return buf.getvalue()
+
+
+def _gzip_base64(output):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb')
+    gz.write(output)
+    gz.close()
+    return base64.b64encode(buf.getvalue())
+
+
+class FakePowerDnsHost(object):
+    """Answers SQL statements sent to a PowerDNS host"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.statements = 0
+        self.updated_rows = 0
+        self.deleted_rows = 0
+        self._staged = {}
+
+    def answer(self, sql):
+        self.statements += 1
+        if _stage(sql.strip(), self._staged):
+            return ''
+        copy_match = _COPY_RE.match(sql)
+        if copy_match:
+            return _csv_output(self.select(copy_match.group(1)))
+        if sql.lstrip().startswith('WITH '):
+            return str(self._checked_fix(sql))
+        if 'UPDATE records' in sql:
+            self.updated_rows += sql.count('),(') + 1
+            return ''
+        if 'DELETE FROM records' in sql:
+            self.deleted_rows += sql.count(',') + 1
+            return ''
+        return _psql_output(self.select(sql))
+
+    def select(self, sql):
+        if 'AS fingerprint' in sql:
+            return self._select_fingerprints()
+        if 'string_agg' in sql:
+            return self._select_digests(_ids_in(sql, self._staged))
+        if 'count(*)' in sql:
+            domain_ids = set(_ids_in(sql, self._staged)) if 'IN (' in sql else None
+            return [(domain_id, len(records))
+                    for (domain_id, records) in self.dataset.powerdns_records.items()
+                    if records and (domain_ids is None or domain_id in domain_ids)]
+        if 'FROM records' in sql:
+            records = self._select_records(_ids_in(sql, self._staged), 'decode(' in sql)
+            # without hashes with db.hashing
+            return records if 'md5(' in sql else [rec[:8] for rec in records]
+        if 'FROM domains' in sql:
+            return self._select_domains(
+                _names_in(sql, 'trim(name) IN', self._staged),
+                _names_in(sql, 'trim(name) NOT IN', self._staged))
+        raise Exception("Fake PowerDNS host does not know the query: {}".format(sql))
+
+    def _checked_fix(self, sql):
+        """Counts records of a checked fix which hold the expected values"""
+        records = {rec[0]: rec for recs in self.dataset.powerdns_records.values() for rec in recs}
+        count = 0
+        for item in _VALUES_RE.findall(sql[sql.find('VALUES'):sql.find(') AS v(') + 1]):
+            values = item.split(',')
+            rec = records.get(int(values[0]))
+            if rec is None:
+                continue
+            old_ttl = int(values[2]) if values[2] != 'NULL' else None
+            if 'UPDATE records' in sql and rec[4] == old_ttl:
+                count += 1
+                self.updated_rows += 1
+            elif 'DELETE FROM records' in sql and rec[8] == values[1].strip("'"):
+                count += 1
+                self.deleted_rows += 1
+        return count
+
+    def _select_fingerprints(self):
+        return [
+            (domain_id,
+             _digest('{}:{}'.format(rec[0], rec[9] or POWERDNS_NULL_HASH) for rec in records))
+            for (domain_id, records) in self.dataset.powerdns_records.items() if records
+        ]
+
+    def _select_domains(self, sync_domains, exclude_domains):
+        return [
+            (domain_id, domain_name)
+            for (domain_id, domain_name) in sorted(self.dataset.powerdns_domains)
+            if (sync_domains is None or domain_name in sync_domains)
+            and (exclude_domains is None or domain_name not in exclude_domains)
+        ]
+
+    def _select_records(self, domain_ids, order_by_rec_hash):
+        records = [rec for domain_id in domain_ids
+                   for rec in self.dataset.powerdns_records.get(domain_id, [])]
+        records.sort(key=lambda rec: rec[0], reverse=True)
+        if order_by_rec_hash:
+            records.sort(key=lambda rec: rec[8])
+        return records
+
+    def _select_digests(self, domain_ids):
+        return [
+            (domain_id, _digest(rec[9] or POWERDNS_NULL_HASH
+                                for rec in self.dataset.powerdns_records[domain_id]))
+            for domain_id in domain_ids
+            if self.dataset.powerdns_records.get(domain_id)
+        ]
+
+
+class FakeRequestFactory(object):
+    """
+    Replaces utils.remote.Request, see db.session.set_request_factory.
+    hosts: {host_id: FakePowerDnsHost}
+    """
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.round_trips = 0
+
+    def __call__(self, host_id, login, password):
+        return _FakeRequest(self, host_id)
+
+
+class _FakeRequest(object):
+    def __init__(self, factory, host_id):
+        self._factory = factory
+        self._host = factory.hosts[host_id]
+        self._command = None
+
+    def command(self, command_body, valid_exit_codes, stdout, stderr, retvar):
+        self._command = command_body
+
+    def perform(self):
+        self._factory.round_trips += 1
+        first_line, script = self._command.split('\n', 1)
+        script = script[:script.rindex(SCRIPT_EOF)]
+        separator = "\\echo {}\n".format(RESULT_MARKER)
+        output = ''.join(
+            "{}\n{}\n".format(self._host.answer(sql.strip().rstrip(';')), RESULT_MARKER)
+            for sql in script.split(separator) if sql.strip()
+        )
+        if '| gzip' in first_line:
+            output = _gzip_base64(output)
+        return {'retcode': '0', 'stdout': output, 'stderr': ''}
+
+
+class FakeHubConnection(object):
+    """Replaces a psycopg2 connection to the Hub database"""
+    def __init__(self, dataset, powerdns_hosts):
+        self.dataset = dataset
+        self.powerdns_hosts = powerdns_hosts
+        self.queries = 0
+        self.watermark = 1
+        self.changed_domains = set()  # answer to the query of changed domains
+        self.staged = {}  # tables of db.staging
+
+    def cursor(self, *args, **kwargs):
+        return FakeHubCursor(self)
+
+    def get_transaction_status(self):
+        return 0  # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeHubCursor(object):
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+        self.itersize = 2000
+
+    def execute(self, sql, params=None):
+        if _stage(sql.strip(), self._conn.staged):
+            self._rows = []
+            return
+        self._conn.queries += 1
+        self._rows = self._select(sql)
+
+    def copy_from(self, data_file, table, columns=None):
+        self._conn.staged[table] = data_file.read().splitlines()
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=None):
+        size = size or self.itersize
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+    def _select(self, sql):
+        dataset = self._conn.dataset
+        if 'FROM registered_hosts' in sql:
+            return [(host_id,) for host_id in self._conn.powerdns_hosts]
+        if 'txid_snapshot_xmin' in sql:
+            return [(self._conn.watermark,)]
+        if 'age(' in sql:
+            return [(name,) for name in sorted(self._conn.changed_domains)]
+        if 'max(xmin' in sql:
+            return [("{}:{}".format(len(dataset.hub_domains), self._conn.watermark),)]
+        if sql.lstrip().startswith('SELECT trim(name), id'):
+            return sorted(dataset.hub_domains.items())
+        if sql.lstrip().startswith('SELECT trim(name)'):
+            return [(name,) for name in sorted(dataset.hub_domains)]
+        if 'string_agg' in sql:
+            id2name = {v: k for k, v in dataset.hub_domains.items()}
+            return [
+                (id2name[domain_id], _digest(set(rec[4] if rec[4] is not None else HUB_NULL_HASH
+                                                 for rec in dataset.hub_records[domain_id])))
+                for domain_id in _ids_in(sql, self._conn.staged) if dataset.hub_records.get(domain_id)
+            ]
+        if 'dns_resource_records' in sql:
+            if 'md5(' not in sql:  # idn_host instead of hashes with db.hashing
+                return [rec[:3] + (idn_host, rec[5])
+                        for domain_id in _ids_in(sql, self._conn.staged)
+                        for (rec, idn_host) in zip(dataset.hub_records.get(domain_id, []),
+                                                   dataset.hub_idn_hosts.get(domain_id, []))]
+            return [rec for domain_id in _ids_in(sql, self._conn.staged)
+                    for rec in dataset.hub_records.get(domain_id, [])]
+        if 'FROM domains' in sql:
+            names = _names_in(sql, 'trim(name) IN', self._conn.staged) or set()
+            return [(dataset.hub_domains[name],) for name in names if name in dataset.hub_domains]
+        raise Exception("Fake Hub does not know the query: {}".format(sql))
@@ -0,0 +1,216 @@
+"""
+Benchmarks of record parsing, matching and the whole synchronization
+against in-process fakes of PowerDNS hosts and Hub.
+
+    python -m bench.run [--scenarios=10k,100k] [--json=FILE] [--baseline=FILE] ...
+
+Every scenario runs in its own process, so the reported peak RSS is its own.
+"""
+import getopt
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.datagen import generate
+from bench.fakes import FakeHubConnection, FakePowerDnsHost, FakeRequestFactory, _csv_output, \
+    _psql_output
+
+# name: (domains, records per domain)
+SCENARIOS = {
+    '10k': (1000, 10),
+    '100k': (5000, 20),
+    '1M': (20000, 50),
+}
+DEFAULT_SCENARIOS = ('10k', '100k')
+DEFAULT_TOLERANCE = 0.2
+
+__long_options = [
+    ('scenarios=', "Comma separated scenarios: {}.".format(', '.join(sorted(SCENARIOS)))),
+    ('hosts=', "Number of fake PowerDNS hosts (default is 1)."),
+    ('matcher=', "Matcher passed to synchronize."),
+    ('wire-format=', "Wire format of fake PowerDNS hosts."),
+    ('parallel-hosts=', "Passed to synchronize."),
+    ('pipeline-depth=', "Passed to synchronize."),
+    ('digest-precheck', "Passed to synchronize."),
+    ('match-workers=', "Processes of the sharded matcher, see processing.sharded_matcher."),
+    ('json=', "Writes results to the file."),
+    ('baseline=', "Fails if records/s of a scenario is lower than in the baseline JSON file."),
+    ('tolerance=', "Allowed relative slowdown against the baseline (default is {}).".format(
+        DEFAULT_TOLERANCE)),
+    ('single=', "Runs one scenario in this process and prints its result as JSON."),
+]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def _parse_all(parser, output, types):
+    return list(parser(output, types))
+
+
+def _numpy_match(pdns_records, hub_records):
+    # the same work as of synchronizer.match_dns_records
+    from processing.numpy_matcher import index_hub_records_array, numpy_match_dns_records
+    from processing.record_store import PowerDnsRecordStore
+
+    return numpy_match_dns_records(
+        PowerDnsRecordStore.from_rows(pdns_records, keep_fields=False),
+        *index_hub_records_array(hub_records)[:-1])
+
+
+def run_scenario(name, opts):
+    from db.core import set_wire_format
+    from db.session import set_request_factory
+    from db.wire import WIRE_PSQL, iter_csv_rows, iter_psql_rows
+    from db.selectors import POWERDNS_RECORD_TYPES
+    from processing.merge_matcher import merge_match_dns_records
+    from processing.numpy_matcher import numpy_available
+    from processing.sharded_matcher import set_match_workers
+    from processing.reporters import PowerDnsSyncCsvReporter
+    from processing.synchronizer import MATCHER_DEFAULT, match_dns_records, synchronize
+
+    domains, records_per_domain = SCENARIOS[name]
+    dataset, gen_time = _timed(generate, domains, records_per_domain)
+    pdns_records = [rec for recs in dataset.powerdns_records.values() for rec in recs]
+    hub_records = [rec for recs in dataset.hub_records.values() for rec in recs]
+    records = len(pdns_records)
+    result = {'scenario': name, 'records': records, 'generate_s': gen_time}
+
+    _, elapsed = _timed(
+        _parse_all, iter_psql_rows, _psql_output(pdns_records), POWERDNS_RECORD_TYPES)
+    result['parse_psql_rec_per_s'] = records / elapsed
+    _, elapsed = _timed(
+        _parse_all, iter_csv_rows, _csv_output(pdns_records), POWERDNS_RECORD_TYPES)
+    result['parse_csv_rec_per_s'] = records / elapsed
+
+    pdns_records.sort(key=lambda rec: rec[0], reverse=True)
+    _, elapsed = _timed(match_dns_records, pdns_records, hub_records)
+    result['match_default_rec_per_s'] = records / elapsed
+    if '--match-workers' in opts:
+        set_match_workers(int(opts['--match-workers']))
+        _, elapsed = _timed(match_dns_records, pdns_records, hub_records)
+        result['match_sharded_rec_per_s'] = records / elapsed
+    if numpy_available():
+        _, elapsed = _timed(_numpy_match, pdns_records, hub_records)
+        result['match_numpy_rec_per_s'] = records / elapsed
+    pdns_records.sort(key=lambda rec: rec[8])
+    hub_records.sort(key=lambda rec: rec[3])
+    _, elapsed = _timed(merge_match_dns_records, pdns_records, hub_records)
+    result['match_merge_rec_per_s'] = records / elapsed
+    del pdns_records, hub_records
+
+    hosts = range(1, int(opts.get('--hosts', 1)) + 1)
+    request_factory = FakeRequestFactory({host_id: FakePowerDnsHost(dataset) for host_id in hosts})
+    set_request_factory(request_factory)
+    set_wire_format(opts.get('--wire-format', WIRE_PSQL))
+    hub_conn = FakeHubConnection(dataset, hosts)
+
+    report_fd, report_path = tempfile.mkstemp(suffix='.csv')
+    os.close(report_fd)
+    try:
+        with PowerDnsSyncCsvReporter(report_path) as reporter:
+            _, elapsed = _timed(
+                synchronize,
+                db_conn=hub_conn,
+                csv_reporter=reporter,
+                hosts=hosts,
+                sync_domains=None,
+                exclude_domains=None,
+                skip_error_report=False,
+                fix_errors=True,
+                parallel_hosts=int(opts.get('--parallel-hosts', 1)),
+                digest_precheck='--digest-precheck' in opts,
+                pipeline_depth=int(opts.get('--pipeline-depth', 0)),
+                matcher=opts.get('--matcher', MATCHER_DEFAULT),
+            )
+    finally:
+        os.remove(report_path)
+    result['synchronize_rec_per_s'] = records * len(hosts) / elapsed
+    result['synchronize_s'] = elapsed
+    result['round_trips'] = request_factory.round_trips
+    result['hub_queries'] = hub_conn.queries
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def run_isolated(name, argv):
+    cmd = [sys.executable, '-m', 'bench.run', '--single={}'.format(name)] + [
+        arg for arg in argv if not arg.startswith(('--scenarios', '--json', '--baseline',
+                                                   '--tolerance'))
+    ]
+    output = subprocess.check_output(cmd, cwd=os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def print_result(result):
+    print "{scenario}: {records} records".format(**result)
+    for key in sorted(result):
+        if key not in ('scenario', 'records'):
+            value = result[key]
+            print "\t{}: {}".format(key, "{:.1f}".format(value) if isinstance(value, float)
+                                    else value)
+
+
+def regressions(results, baseline, tolerance):
+    failed = []
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if not base:
+            continue
+        for key in sorted(result):
+            if key.endswith('_rec_per_s') and key in base and \
+                    result[key] < base[key] * (1.0 - tolerance):
+                failed.append("{}: {} {:.1f} < {:.1f}".format(
+                    result['scenario'], key, result[key], base[key]))
+    return failed
+
+
+def main(argv):
+    opts, _ = getopt.getopt(argv, '', dict(__long_options).keys())
+    opts = dict(opts)
+
+    if '--single' in opts:
+        print json.dumps(run_scenario(opts['--single'], opts))
+        return 0
+
+    names = opts.get('--scenarios', ','.join(DEFAULT_SCENARIOS)).split(',')
+    results = []
+    for name in names:
+        if name not in SCENARIOS:
+            print "Unknown scenario: {}".format(name)
+            return 2
+        result = run_isolated(name, argv)
+        print_result(result)
+        results.append(result)
+
+    if '--json' in opts:
+        with open(opts['--json'], 'w') as json_file:
+            json.dump({result['scenario']: result for result in results}, json_file, indent=2)
+
+    if '--baseline' in opts:
+        with open(opts['--baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        failed = regressions(results, baseline,
+                             float(opts.get('--tolerance', DEFAULT_TOLERANCE)))
+        for line in failed:
+            print "REGRESSION {}".format(line)
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main(sys.argv[1:]))
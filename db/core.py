@@ -1,25 +1,64 @@
-from utils.remote import Request
+import itertools
+
+from db.session import get_session
+from db.wire import WIRE_CSV_GZIP, WIRE_FORMATS, WIRE_PSQL, copy_sql, iter_csv_rows, iter_psql_rows
 from utils.decorators import log_remote_errors
 
-RETVAR = 'retcode'
+_wire_format = WIRE_PSQL
+DEFAULT_HUB_ITERSIZE = 2000
+_hub_itersize = DEFAULT_HUB_ITERSIZE
+_hub_cursor_ids = itertools.count()
+# psycopg2.extensions.TRANSACTION_STATUS_INERROR, the queries do not import psycopg2
+# so that they also run on the connections of bench.fakes
+_HUB_TRANSACTION_INERROR = 3
+
 
+def set_wire_format(wire_format):
+    """Sets the format of remote select results, one of db.wire.WIRE_FORMATS"""
+    global _wire_format
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError("Unknown wire format: {}".format(wire_format))
+    _wire_format = wire_format
 
-def make_hcl_cmd(sql):
-    return """su - postgres -c "psql -U postgres powerdns -t -c \\"{}\\"" """.format(sql)
+
+def set_hub_itersize(itersize):
+    """Sets the number of rows fetched from Hub per round trip by exec_hub_select"""
+    global _hub_itersize
+    _hub_itersize = itersize
 
 
 @log_remote_errors
 def exec_remote_query(host_id, sql):
-    request = Request(host_id, 'root', 'root')
-    request.command(make_hcl_cmd(sql),
-                    valid_exit_codes=[0],
-                    stdout='stdout',
-                    stderr='stderr',
-                    retvar=RETVAR)
-    result = request.perform()
-    if '0' != result[RETVAR]:
-        raise Exception("Remote command fail: {}".format(result))
-    return result['stdout'].strip()
+    return get_session(host_id).query(sql)
+
+
+@log_remote_errors
+def exec_remote_select(host_id, sql, types=None, setup=None):
+    """
+    Returns an iterator over rows of a remote select, cells are converted
+    with types (see db.wire) if given. setup statements are executed before
+    the select in the same psql process (see db.staging).
+    """
+    setup = setup or []
+    if _wire_format == WIRE_PSQL:
+        return iter_psql_rows(get_session(host_id).query_script(setup + [sql])[-1], types)
+    output = get_session(host_id).query_script(
+        setup + [copy_sql(sql)], compress=(_wire_format == WIRE_CSV_GZIP))[-1]
+    return iter_csv_rows(output, types)
+
+
+@log_remote_errors
+def exec_remote_batch(host_id, sql_list):
+    """
+    Executes several statements in as few remote round trips as possible,
+    returns a list of their outputs.
+    """
+    return get_session(host_id).query_batch(sql_list)
+
+
+def hub_transaction_failed(con):
+    """Whether a failed statement has aborted the current transaction of con"""
+    return con.get_transaction_status() == _HUB_TRANSACTION_INERROR
 
 
 def exec_hub_query(con, sql):
@@ -27,3 +66,20 @@ def exec_hub_query(con, sql):
     cur.execute(sql)
     record_set = cur.fetchall()
     return record_set
+
+
+def exec_hub_select(con, sql):
+    """
+    Returns an iterator over rows of a Hub select, which are fetched through
+    a server-side cursor in batches of the Hub itersize. The cursor lives in
+    the current transaction of con, so the iterator has to be consumed before
+    it ends.
+    """
+    cur = con.cursor(name="powerdns_sync_{}".format(next(_hub_cursor_ids)))
+    cur.itersize = _hub_itersize
+    try:
+        cur.execute(sql)
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
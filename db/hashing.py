@@ -0,0 +1,141 @@
+"""
+Hashing of DNS records by the sync client (--client-hashing).
+
+By default rec_hash and ttl_hash of every record are computed with md5() by
+the databases, which takes CPU of PowerDNS backends and doubles the bytes of
+a result. With client hashing the queries return the normalised fields only
+(the normalisation itself stays in the SQL of db.references, it also defines
+the content which is reported and checked by fixes) and the hashes are
+computed here, in batches and optionally in a pool of processes.
+
+Both PowerDNS and Hub records are hashed the same way, with blake2b if it is
+available and with md5 otherwise. The digests are 16 bytes either way, see
+processing.record_store. Hashes which are compared with the ones computed by
+a database (digests, checked fixes of plans) are always md5.
+"""
+import collections
+import hashlib
+import itertools
+import logging
+
+from multiprocessing import Pool
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:  # Python 2 without pyblake2
+        blake2b = None
+
+HASH_DIGEST_SIZE = 16
+HASH_BATCH_SIZE = 5000
+# batches in flight per worker, rows are streamed, so they are not all read ahead
+HASH_BATCHES_PER_WORKER = 2
+
+logger = logging.getLogger(__name__)
+
+_client_hashing = False
+_hash_pool = None
+_hash_workers = 0
+
+
+def md5_hex(value):
+    return hashlib.md5(value).hexdigest()
+
+
+def _blake2b_hex(value):
+    return blake2b(value, digest_size=HASH_DIGEST_SIZE).hexdigest()
+
+
+client_hex = _blake2b_hex if blake2b is not None else md5_hex
+
+
+def record_hashes(idn_host, rr_type, rec_data, ttl, hex_fn=client_hex):
+    """
+    (rec_hash, ttl_hash) of normalised fields, composed as by the SQL of
+    db.references: a NULL field gives NULL hashes.
+    """
+    if idn_host is None or rr_type is None or rec_data is None:
+        return (None, None)
+    rec_key = idn_host + rr_type + rec_data
+    return (hex_fn(rec_key), hex_fn(rec_key + str(ttl)) if ttl is not None else None)
+
+
+def set_client_hashing(enabled, workers=0):
+    """With workers > 0 batches are hashed by a pool of as many processes"""
+    global _client_hashing, _hash_pool, _hash_workers
+    _client_hashing = enabled
+    if _hash_pool is not None:
+        _hash_pool.close()
+        _hash_pool = None
+    _hash_workers = workers if enabled else 0
+    if _hash_workers > 0:
+        _hash_pool = Pool(_hash_workers)
+    logger.debug("Client hashing: {}, hash workers: {}".format(enabled, workers))
+
+
+def client_hashing_enabled():
+    return _client_hashing
+
+
+def hash_name():
+    """Hash of records fetched now, records hashed by different hashes never match"""
+    return 'blake2b' if _client_hashing and blake2b is not None else 'md5'
+
+
+def _hash_powerdns_batch(rows):
+    # (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name)
+    return [tuple(row) + record_hashes(row[1], row[2], row[3], row[4]) for row in rows]
+
+
+def _hash_hub_batch(rows):
+    return [
+        (rr_type, rec_data, ttl) + record_hashes(idn_host, rr_type, rec_data, ttl) + (domain_id,)
+        for (rr_type, rec_data, ttl, idn_host, domain_id) in rows
+    ]
+
+
+def _batches(rows):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, HASH_BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def _hash_rows(rows, hash_batch):
+    if _hash_pool is None:
+        for batch in _batches(rows):
+            for row in hash_batch(batch):
+                yield row
+        return
+
+    pending = collections.deque()
+    for batch in _batches(rows):
+        pending.append(_hash_pool.apply_async(hash_batch, (batch,)))
+        if len(pending) > _hash_workers * HASH_BATCHES_PER_WORKER:
+            for row in pending.popleft().get():
+                yield row
+    while pending:
+        for row in pending.popleft().get():
+            yield row
+
+
+def hash_powerdns_rows(rows):
+    """
+    (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name) ->
+    (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name, rec_hash, ttl_hash)
+    Rows are hashed lazily, batch by batch.
+    """
+    return _hash_rows(rows, _hash_powerdns_batch)
+
+
+def hash_hub_rows(rows):
+    """
+    (rr_type, rec_data, ttl, idn_host, domain_id) ->
+    (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id)
+    Rows are hashed lazily, batch by batch.
+    """
+    return _hash_rows(rows, _hash_hub_batch)
@@ -0,0 +1,137 @@
+import logging
+import os
+import shelve
+import shutil
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from db.selectors import fetch_hub_records_by_domain_ids
+
+DEFAULT_MAX_RECORDS = 1000000
+HUB_REC_DOMAIN_ID = 5
+
+logger = logging.getLogger(__name__)
+
+
+class HubRecordCache(object):
+    """
+    Hub DNS records grouped by Hub domain ID, shared by all PowerDNS hosts of a run.
+
+    At most max_records records are kept in memory, least recently used domains
+    are evicted first. When spill_dir is given, evicted domains are written to
+    a temporary on-disk shelf instead of being dropped and re-queried from Hub.
+    Missing domains are fetched through the connection of the caller if given,
+    db_conn otherwise.
+    """
+    def __init__(self, db_conn, max_records=DEFAULT_MAX_RECORDS, spill_dir=None):
+        self._db_conn = db_conn
+        self._max_records = max_records
+        self._entries = OrderedDict()  # domain_id -> [hub record, ...]
+        self._size = 0
+        self._pending = {}  # domain_id -> threading.Event, domains being fetched
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        self._spill_dir = None
+        self._spill = None
+        if spill_dir:
+            self._spill_dir = tempfile.mkdtemp(prefix='hub_cache_', dir=spill_dir)
+            self._spill = shelve.open(os.path.join(self._spill_dir, 'records'), 'n', protocol=2)
+
+    def get_records(self, domain_ids_list, db_conn=None):
+        records = []
+        remaining = list(domain_ids_list)
+        while remaining:
+            to_fetch, to_wait = [], []
+            with self._lock:
+                for domain_id in remaining:
+                    recs = self._lookup(domain_id)
+                    if recs is not None:
+                        records.extend(recs)
+                    elif domain_id in self._pending:
+                        to_wait.append((domain_id, self._pending[domain_id]))
+                    else:
+                        self._pending[domain_id] = threading.Event()
+                        to_fetch.append(domain_id)
+
+            if to_fetch:
+                records.extend(self._fetch(to_fetch, db_conn or self._db_conn))
+
+            # domains fetched by other threads are looked up again,
+            # they are fetched here if the other thread has failed
+            for _, fetched in to_wait:
+                fetched.wait()
+            remaining = [domain_id for domain_id, _ in to_wait]
+        return records
+
+    def close(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+        logger.debug("Hub record cache is closed, hits: {}, misses: {}".format(
+            self._hits, self._misses))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _fetch(self, domain_ids, db_conn):
+        grouped = {domain_id: [] for domain_id in domain_ids}
+        try:
+            for rec in fetch_hub_records_by_domain_ids(db_conn, domain_ids, stream=True):
+                grouped[rec[HUB_REC_DOMAIN_ID]].append(rec)
+        except Exception:
+            # waiting threads fetch the domains themselves
+            with self._lock:
+                self._release(domain_ids)
+            raise
+
+        # stored before waiting threads are woken, so they find the domains
+        with self._lock:
+            try:
+                self._misses += len(domain_ids)
+                for domain_id, recs in grouped.items():
+                    self._store(domain_id, recs)
+            finally:
+                self._release(domain_ids)
+        return [rec for recs in grouped.values() for rec in recs]
+
+    def _release(self, domain_ids):
+        for domain_id in domain_ids:
+            self._pending.pop(domain_id).set()
+
+    def _lookup(self, domain_id):
+        recs = self._entries.pop(domain_id, None)
+        if recs is not None:
+            self._entries[domain_id] = recs  # mark as recently used
+        elif self._spill is not None and str(domain_id) in self._spill:
+            recs = self._spill[str(domain_id)]
+            self._store(domain_id, recs)
+        else:
+            return None
+        self._hits += 1
+        return recs
+
+    def _store(self, domain_id, recs):
+        old = self._entries.pop(domain_id, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[domain_id] = recs
+        self._size += len(recs)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self._max_records and len(self._entries) > 1:
+            domain_id, recs = self._entries.popitem(last=False)
+            self._size -= len(recs)
+            if self._spill is not None and str(domain_id) not in self._spill:
+                self._spill[str(domain_id)] = recs
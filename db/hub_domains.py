@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+
+from db.selectors import fetch_hub_domain_ids_by_name, fetch_hub_domains_change_marker
+from utils.utils import write_file_atomically
+
+CACHE_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class HubDomainIndex(object):
+    """
+    Hub IDs of all domains synchronized to PowerDNS by name, loaded once per run
+    instead of resolving names of every chunk on every host.
+
+    With cache_file the index is kept on disk together with a change marker of
+    the Hub domains table and is loaded from Hub again only when the marker differs.
+    Domains added to Hub during the run are not in the index and are skipped
+    as domains missing in Hub.
+    """
+    def __init__(self, db_conn, cache_file=None):
+        # the marker is read first, so a change made while loading invalidates the cache
+        marker = fetch_hub_domains_change_marker(db_conn)
+        self._ids = self._load_cache(cache_file, marker)
+        if self._ids is None:
+            self._ids = fetch_hub_domain_ids_by_name(db_conn)
+            if cache_file:
+                self._save_cache(cache_file, marker)
+        logger.info("Hub domain index holds {} domains".format(len(self._ids)))
+
+    @staticmethod
+    def _load_cache(cache_file, marker):
+        if not cache_file or not os.path.exists(cache_file):
+            return None
+        try:
+            with open(cache_file) as cache:
+                state = json.load(cache)
+        except ValueError:
+            logger.warning("Hub domain cache {} is broken, it is rebuilt".format(cache_file))
+            return None
+        if state.get('version') != CACHE_VERSION or state.get('marker') != marker:
+            return None
+        logger.debug("Hub domain index is loaded from {}".format(cache_file))
+        return {name.encode('utf-8'): domain_id for (name, domain_id) in state['ids'].items()}
+
+    def _save_cache(self, cache_file, marker):
+        state = {
+            'version': CACHE_VERSION,
+            'marker': marker,
+            'ids': self._ids,
+        }
+        write_file_atomically(cache_file, json.dumps(state, separators=(',', ':')))
+
+    def get_ids(self, domain_names):
+        """Returns Hub IDs of the domains which are found in Hub"""
+        ids = self._ids
+        return [ids[name] for name in domain_names if name in ids]
+
+    def names(self):
+        return self._ids.keys()
+
+    def items(self):
+        """[(domain_name, domain_id), ...]"""
+        return self._ids.items()
+
+    def __len__(self):
+        return len(self._ids)
@@ -1,6 +1,6 @@
 from utils.decorators import log_start_end
 
-from db.core import exec_remote_query
+from db.core import exec_remote_batch, exec_remote_query
 from db.references import PowerDnsSqlReference
 
 
@@ -12,3 +12,27 @@ def update_ttl(host_id, upd_map):
 @log_start_end
 def delete_duplicates(host_id, del_set):
     exec_remote_query(host_id, PowerDnsSqlReference.delete_dns_records(del_set))
+
+
+@log_start_end
+def update_ttl_and_delete_duplicates(host_id, upd_maps, del_sets):
+    """
+    Sends all updates and deletions to the host in as few round trips as possible
+    """
+    exec_remote_batch(
+        host_id,
+        [PowerDnsSqlReference.update_dns_records(upd_map) for upd_map in upd_maps] +
+        [PowerDnsSqlReference.delete_dns_records(del_set) for del_set in del_sets]
+    )
+
+
+@log_start_end
+def apply_checked_fixes(host_id, upd_lists, del_lists):
+    """
+    Applies planned updates and deletions to records which still hold the expected
+    values, returns the numbers of (updated, deleted) records.
+    """
+    upd_sql = [PowerDnsSqlReference.checked_update_dns_records(x) for x in upd_lists]
+    del_sql = [PowerDnsSqlReference.checked_delete_dns_records(x) for x in del_lists]
+    counts = [int(output) for output in exec_remote_batch(host_id, upd_sql + del_sql)]
+    return (sum(counts[:len(upd_sql)]), sum(counts[len(upd_sql):]))
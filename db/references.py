@@ -1,11 +1,51 @@
+# stand for NULL hashes in digests and fingerprints, they differ between PowerDNS and Hub,
+# so the digest precheck never skips a domain with a NULL hash (NULL hashes do not match
+# by default)
+POWERDNS_NULL_HASH = 'powerdns-null'
+HUB_NULL_HASH = 'hub-null'
+
+
+class StagedValues(object):
+    """Values loaded into a temporary table (see db.staging), used in place of an IN list"""
+    def __init__(self, table):
+        self.table = table
+
+    def __str__(self):
+        return "SELECT value FROM {}".format(self.table)
+
+
+def _make_csv_str(lst):
+    if isinstance(lst, StagedValues):
+        return str(lst)
+    return ','.join(map(str, lst))
+
+
 def _make_quoted_csv_str(lst):
+    if isinstance(lst, StagedValues):
+        return str(lst)
     return ','.join(["'{}'".format(x) for x in lst])
 
 
+def _sql_int(value):
+    return str(value) if value is not None else 'NULL'
+
+
 class PowerDnsSqlReference(object):
     @staticmethod
-    def select_dns_records(domain_ids_list):
-        domains_str = ','.join(domain_ids_list)
+    def _dns_records(domain_ids_list, with_hashes=True):
+        """
+        Records of all domains if domain_ids_list is None. Without hashes
+        rec_hash and ttl_hash are left to the client, see db.hashing.
+        """
+        if domain_ids_list is None:
+            domains_str = """SELECT id FROM domains"""
+        else:
+            domains_str = _make_csv_str(domain_ids_list)
+        hashes_str = ""
+        if with_hashes:
+            hashes_str = """,
+                        md5(t.idn_host || t.type || t.rec_data) AS rec_hash,
+                        md5(t.idn_host || t.type || t.rec_data || t.ttl) AS ttl_hash"""
         sql = """SELECT t.id,
                         t.idn_host,
                         t.type,
@@ -13,9 +53,7 @@ class PowerDnsSqlReference(object):
                         t.ttl,
                         t.prio,
                         t.domain_id,
-                        (SELECT name FROM domains WHERE id = t.domain_id) as domain_name,
-                        md5(t.idn_host || t.type || t.rec_data) AS rec_hash,
-                        md5(t.idn_host || t.type || t.rec_data || t.ttl) AS ttl_hash
+                        (SELECT name FROM domains WHERE id = t.domain_id) as domain_name{2}
                  FROM
                    (SELECT id,
                            trim(name) AS idn_host,
@@ -43,8 +81,50 @@ class PowerDnsSqlReference(object):
                                    'AAAA',
                                    'PTR',
                                    'NAPTR')
-                    AND domain_id in ({1})) AS t
-            ORDER BY t.id DESC""".format(domains_str, domains_str)
+                    AND domain_id in ({1})) AS t""".format(domains_str, domains_str, hashes_str)
+        return sql
+
+    @staticmethod
+    def select_dns_records(domain_ids_list, order_by_rec_hash=False, with_hashes=True):
+        sql = PowerDnsSqlReference._dns_records(domain_ids_list, with_hashes)
+        if order_by_rec_hash:
+            # bytea is compared bytewise, so the order does not depend on collation;
+            # NULL hashes are read as '', which the merge matcher expects first
+            sql += """ ORDER BY decode(md5(t.idn_host || t.type || t.rec_data), 'hex') NULLS FIRST,
+                              t.id DESC"""
+        else:
+            sql += """ ORDER BY t.id DESC"""
+        return sql
+
+    @staticmethod
+    def select_domain_digests(domain_ids_list):
+        sql = """SELECT r.domain_id,
+                        md5(string_agg(coalesce(r.ttl_hash, '{1}'), ','
+                                       ORDER BY coalesce(r.ttl_hash, '{1}'))) AS digest
+                 FROM ({0}) AS r
+                 GROUP BY r.domain_id""".format(
+                     PowerDnsSqlReference._dns_records(domain_ids_list), POWERDNS_NULL_HASH)
+        return sql
+
+    @staticmethod
+    def select_domain_fingerprints():
+        # unlike digests, fingerprints also cover record IDs, so replicas with equal
+        # fingerprints can be fixed by the same record IDs
+        sql = """SELECT r.domain_id,
+                        md5(string_agg(r.id || ':' || coalesce(r.ttl_hash, '{1}'), ','
+                                       ORDER BY r.id)) AS fingerprint
+                 FROM ({0}) AS r
+                 GROUP BY r.domain_id""".format(
+                     PowerDnsSqlReference._dns_records(None), POWERDNS_NULL_HASH)
+        return sql
+
+    @staticmethod
+    def select_domain_record_counts(domain_ids_list=None):
+        """Counts of all domains if domain_ids_list is None"""
+        sql = """SELECT domain_id, count(*) FROM records"""
+        if domain_ids_list is not None:
+            sql += """ WHERE domain_id IN ({0})""".format(_make_csv_str(domain_ids_list))
+        sql += """ GROUP BY domain_id"""
         return sql
 
     @staticmethod
@@ -59,16 +139,76 @@ class PowerDnsSqlReference(object):
                 prefix, _make_quoted_csv_str(exclude_domains)
             )
             prefix = "AND"
+        # resumed runs rely on the order, see processing.checkpoint
+        sql += """ ORDER BY id"""
         return sql
 
     @staticmethod
     def delete_dns_records(id_list):
-        return """DELETE FROM records WHERE id IN ({0})""".format(','.join(id_list))
+        return """DELETE FROM records WHERE id IN ({0})""".format(','.join(map(str, id_list)))
+
+    @staticmethod
+    def update_values_item(rec_id, ttl):
+        return "({},{})".format(rec_id, _sql_int(ttl))
 
     @staticmethod
     def update_dns_records(ttl_map):
-        sql_template = "UPDATE records SET ttl = {} WHERE id = {}"
-        return ';'.join(sql_template.format(ttl, rec_id) for (rec_id, ttl) in ttl_map.items())
+        values_str = ','.join(
+            PowerDnsSqlReference.update_values_item(rec_id, ttl)
+            for (rec_id, ttl) in ttl_map.items()
+        )
+        sql = """UPDATE records SET ttl = v.ttl::integer
+                 FROM (VALUES {0}) AS v(id, ttl)
+                 WHERE records.id = v.id""".format(values_str)
+        return sql
+
+    @staticmethod
+    def checked_update_values_item(rec_id, ttl, old_ttl):
+        return "({},{},{})".format(rec_id, _sql_int(ttl), _sql_int(old_ttl))
+
+    @staticmethod
+    def checked_update_dns_records(upd_list):
+        """
+        Updates TTL of records which still have the expected one,
+        upd_list is [(rec_id, ttl, old_ttl), ...]. Returns the number of updated records.
+        TTLs may be NULL, a column of NULLs only would be text without the casts.
+        """
+        values_str = ','.join(
+            PowerDnsSqlReference.checked_update_values_item(*item) for item in upd_list)
+        sql = """WITH updated AS
+                   (UPDATE records SET ttl = v.ttl::integer
+                    FROM (VALUES {0}) AS v(id, ttl, old_ttl)
+                    WHERE records.id = v.id
+                      AND records.ttl IS NOT DISTINCT FROM v.old_ttl::integer
+                    RETURNING records.id)
+                 SELECT count(*) FROM updated""".format(values_str)
+        return sql
+
+    @staticmethod
+    def checked_delete_values_item(rec_id, rec_hash):
+        return "({},'{}')".format(rec_id, rec_hash)
+
+    @staticmethod
+    def checked_delete_dns_records(del_list):
+        """
+        Deletes records which still have the expected rec_hash (see _dns_records),
+        del_list is [(rec_id, rec_hash), ...]. Returns the number of deleted records.
+        """
+        values_str = ','.join(
+            PowerDnsSqlReference.checked_delete_values_item(*item) for item in del_list)
+        sql = """WITH deleted AS
+                   (DELETE FROM records
+                    USING (VALUES {0}) AS v(id, rec_hash)
+                    WHERE records.id = v.id
+                      AND md5(trim(records.name) || trim(records.type) ||
+                              CASE
+                                  WHEN records.type IN ('SRV', 'MX')
+                                       THEN records.prio || ' ' || trim(records.content)
+                                  ELSE trim(records.content)
+                              END) = v.rec_hash
+                    RETURNING records.id)
+                 SELECT count(*) FROM deleted""".format(values_str)
+        return sql
 
 
 class HubSqlReference(object):
@@ -83,6 +223,52 @@ class HubSqlReference(object):
                       WHERE dat.name = 'PowerDns')"""
         return sql
 
+    @staticmethod
+    def select_sync_watermark():
+        # transactions started after the oldest running one are not visible yet
+        return """SELECT txid_snapshot_xmin(txid_current_snapshot())"""
+
+    @staticmethod
+    def select_changed_domains(watermark):
+        # rows written by transactions since the watermark have a small enough age(xmin);
+        # deleted resource records leave no row, but a zone change also updates its
+        # SOA serial in dns_sys_records
+        sql = """SELECT DISTINCT trim(d.name) AS domain_name
+                 FROM domains d
+                 INNER JOIN dns_sys_records dsr ON d.sys_record_id = dsr.record_id
+                 LEFT JOIN dns_resource_records drr ON drr.domain_id = d.domain_id
+                 CROSS JOIN
+                   (SELECT txid_snapshot_xmax(txid_current_snapshot()) - {0} AS delta) AS w
+                 WHERE d.state = 'g'
+                   AND d.type IN ('d', 's')
+                   AND (age(d.xmin) <= w.delta
+                        OR age(dsr.xmin) <= w.delta
+                        OR age(drr.xmin) <= w.delta)""".format(int(watermark))
+        return sql
+
+    @staticmethod
+    def select_domain_names():
+        sql = """SELECT trim(name)
+                 FROM domains
+                 WHERE state = 'g'
+                 AND type IN ('d', 's')"""
+        return sql
+
+    @staticmethod
+    def select_domain_ids_by_name():
+        sql = """SELECT trim(name), id
+                 FROM domains
+                 WHERE state = 'g'
+                 AND type IN ('d', 's')"""
+        return sql
+
+    @staticmethod
+    def select_domains_change_marker():
+        # a new or updated row gets a newer xmin, a deleted one changes the count
+        sql = """SELECT count(*) || ':' || coalesce(max(xmin::text::bigint), 0)
+                 FROM domains"""
+        return sql
+
     @staticmethod
     def select_domain_id(domain_names):
         domain_names_str = _make_quoted_csv_str(domain_names)
@@ -94,13 +280,25 @@ class HubSqlReference(object):
         return sql
 
     @staticmethod
-    def select_dns_records(domain_ids_list):
-        domains_str = ','.join(map(str, domain_ids_list))
+    def select_dns_records(domain_ids_list, with_hashes=True):
+        """
+        Without hashes idn_host is selected instead of rec_hash and ttl_hash,
+        which are computed by the client, see db.hashing.
+        """
+        domains_str = _make_csv_str(domain_ids_list)
+        if with_hashes:
+            hashes_str = """md5(rr.idn_host || rr.rr_type || rr.rec_data) AS rec_hash,
+                        md5(rr.idn_host || rr.rr_type || rr.rec_data || ttl) AS ttl_hash"""
+            ns_hashes_str = """md5(t.idn_host || t.rrtype || t.rec_data) AS rec_hash,
+                         md5(t.idn_host || t.rrtype || t.rec_data || t.ttl) AS ttl_hash"""
+        else:
+            hashes_str = """rr.idn_host"""
+            ns_hashes_str = """t.idn_host"""
         sql = """SELECT rr.rr_type,
                         rr.rec_data,
                         rr.ttl,
-                        md5(rr.idn_host || rr.rr_type || rr.rec_data) AS rec_hash,
-                        md5(rr.idn_host || rr.rr_type || rr.rec_data || ttl) AS ttl_hash
+                        {1},
+                        rr.domain_id
                   FROM
                    (SELECT trim(drr.rr_type) AS rr_type,
                            trim(trailing '.' from trim(drr.idn_host)) as idn_host,
@@ -121,15 +319,15 @@ class HubSqlReference(object):
                     FROM dns_resource_records drr
                     INNER JOIN domains d ON d.domain_id = drr.domain_id
                     INNER JOIN dns_sys_records dsr ON d.sys_record_id = dsr.record_id) AS rr
-                  WHERE rr.domain_id IN ({0})""".format(domains_str)
+                  WHERE rr.domain_id IN ({0})""".format(domains_str, hashes_str)
 
         # get system NS records
         sql += """ UNION ALL """
         sql += """SELECT t.rrtype,
                          t.rec_data,
                          t.ttl,
-                         md5(t.idn_host || t.rrtype || t.rec_data) AS rec_hash,
-                         md5(t.idn_host || t.rrtype || t.rec_data || t.ttl) AS ttl_hash
+                         {1},
+                         t.domain_id
                   FROM
                     (SELECT 'NS'::text AS rrtype,
                             trim(dsr.ns1_name) AS rec_data,
@@ -155,6 +353,38 @@ class HubSqlReference(object):
                      FROM dns_sys_records dsr
                      INNER JOIN domains d ON d.sys_record_id = dsr.record_id
                      WHERE dsr.ns3_name IS NOT NULL) AS t
-                  WHERE t.domain_id IN ({0})""".format(domains_str)
+                  WHERE t.domain_id IN ({0})""".format(domains_str, ns_hashes_str)
 
         return sql
+
+    @staticmethod
+    def select_domain_digests(domain_ids_list):
+        # duplicates are collapsed, so a duplicate in PowerDNS gives a different digest
+        sql = """SELECT trim(d.name) AS domain_name,
+                        md5(string_agg(DISTINCT coalesce(h.ttl_hash, '{1}'), ','
+                                       ORDER BY coalesce(h.ttl_hash, '{1}'))) AS digest
+                 FROM ({0}) AS h
+                 INNER JOIN domains d ON d.domain_id = h.domain_id
+                 GROUP BY trim(d.name)""".format(
+                     HubSqlReference.select_dns_records(domain_ids_list), HUB_NULL_HASH)
+        return sql
+
+
+class StagingSqlReference(object):
+    @staticmethod
+    def create_table(table, value_type):
+        return """CREATE TEMP TABLE {0} (value {1})""".format(table, value_type)
+
+    @staticmethod
+    def copy_from_stdin(table, lines):
+        """COPY with its data inline, for scripts run by psql"""
+        return """COPY {0} (value) FROM STDIN;\n{1}\\.""".format(
+            table, ''.join(line + '\n' for line in lines))
+
+    @staticmethod
+    def analyze_table(table):
+        return """ANALYZE {0}""".format(table)
+
+    @staticmethod
+    def drop_table(table):
+        return """DROP TABLE IF EXISTS {0}""".format(table)
@@ -1,41 +1,169 @@
 import logging
 
-from db.core import exec_hub_query, exec_remote_query
+from operator import itemgetter
+
+from db.core import exec_hub_query, exec_hub_select, exec_remote_select
+from db.hashing import client_hashing_enabled, hash_hub_rows, hash_powerdns_rows
 from db.references import HubSqlReference, PowerDnsSqlReference
+from db.session import MAX_SCRIPT_SIZE
+from db.staging import INTEGER_VALUE, TEXT_VALUE, stage_hub_values, stage_remote_values
+from db.wire import INT, TEXT
 
-from utils.decorators import log_start_end
-from utils.utils import flatten_list
+from utils.decorators import log_start_end, measure_worktime
+from utils.utils import flatten_list, split_to_sized_chunks
 
 logger = logging.getLogger(__name__)
 
 
-def to_record_set(input_str):
-    row_strings = map(lambda row: row.split(' | '), input_str.splitlines())
-    record_set = [map(lambda cell: cell.strip(), row) for row in row_strings]
-    return record_set
+# powerdns_records: [
+#   (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
+#    domain_name, rec_hash, ttl_hash),
+# ]
+POWERDNS_RECORD_TYPES = (INT, TEXT, TEXT, TEXT, INT, INT, INT, TEXT, TEXT, TEXT)
+POWERDNS_DOMAIN_TYPES = (INT, TEXT)
+POWERDNS_DIGEST_TYPES = (INT, TEXT)
+POWERDNS_COUNT_TYPES = (INT, INT)
+# an inlined list of IDs is sent within a remote script, the rest of the query takes a few KB
+MAX_INLINED_IDS_SIZE = MAX_SCRIPT_SIZE - 8 * 1024
 
 
 def fetch_powerdns_domains(host_id, sync_domains=None, exclude_domains=None):
-    return to_record_set(
-        exec_remote_query(
+    sync_domains, sync_setup = stage_remote_values(sync_domains, TEXT_VALUE)
+    exclude_domains, exclude_setup = stage_remote_values(
+        exclude_domains, TEXT_VALUE, 'powerdns_sync_exclude')
+    return list(
+        exec_remote_select(
             host_id,
             PowerDnsSqlReference.select_domains(
                 sync_domains,
-                exclude_domains)))
+                exclude_domains),
+            POWERDNS_DOMAIN_TYPES,
+            sync_setup + exclude_setup))
 
 
 @log_start_end
-def fetch_powerdns_records_by_domain_list(host_id, domain_ids_list):
-    sql_select = PowerDnsSqlReference.select_dns_records(domain_ids_list)
-    powerdns_records = to_record_set(exec_remote_query(host_id, sql_select))
-    return powerdns_records
-
-
-def fetch_hub_records_by_domain_list(db_conn, domain_names):
+def fetch_powerdns_records_by_domain_list(
+    host_id, domain_ids_list, order_by_rec_hash=False, stream=False
+):
+    """
+    With stream an iterator over records is returned instead of a list,
+    records are parsed while they are consumed. With client hashing
+    (see db.hashing) records are hashed while they are consumed too, but
+    records ordered by rec_hash are sorted by the client, so they are not streamed.
+    """
+    domain_ids, setup = stage_remote_values(domain_ids_list, INTEGER_VALUE)
+    if not client_hashing_enabled():
+        sql_select = PowerDnsSqlReference.select_dns_records(domain_ids, order_by_rec_hash)
+        powerdns_records = exec_remote_select(host_id, sql_select, POWERDNS_RECORD_TYPES, setup)
+        return powerdns_records if stream else list(powerdns_records)
+
+    sql_select = PowerDnsSqlReference.select_dns_records(domain_ids, with_hashes=False)
+    powerdns_records = hash_powerdns_rows(
+        exec_remote_select(host_id, sql_select, POWERDNS_RECORD_TYPES[:-2], setup))
+    if order_by_rec_hash:
+        # the sort is stable, so records with the same rec_hash stay ordered by ID descending
+        return sorted(powerdns_records, key=itemgetter(8))
+    return powerdns_records if stream else list(powerdns_records)
+
+
+def fetch_powerdns_record_counts(host_id, domain_ids_list=None):
+    """
+    Returns {domain_id: number of records of the domain} of the domains,
+    of all domains of the host if domain_ids_list is None
+    """
+    if domain_ids_list is None:
+        sql_select = PowerDnsSqlReference.select_domain_record_counts()
+        return dict(exec_remote_select(host_id, sql_select, POWERDNS_COUNT_TYPES))
+
+    domain_ids, setup = stage_remote_values(domain_ids_list, INTEGER_VALUE)
+    if setup:
+        id_chunks = [domain_ids]
+    else:
+        id_chunks = split_to_sized_chunks(
+            domain_ids, MAX_INLINED_IDS_SIZE, lambda domain_id: len(str(domain_id)) + 1)
+    record_counts = {}
+    for ids in id_chunks:
+        sql_select = PowerDnsSqlReference.select_domain_record_counts(ids)
+        record_counts.update(exec_remote_select(host_id, sql_select, POWERDNS_COUNT_TYPES, setup))
+    return record_counts
+
+
+def fetch_powerdns_domain_fingerprints(host_id):
+    """
+    Returns {domain_id: fingerprint of records of the domain with their IDs}
+    """
+    sql_select = PowerDnsSqlReference.select_domain_fingerprints()
+    return dict(exec_remote_select(host_id, sql_select, POWERDNS_DIGEST_TYPES))
+
+
+def fetch_powerdns_domain_digests(host_id, domain_ids_list):
+    """
+    Returns {domain_id: digest of all records of the domain}
+    """
+    domain_ids, setup = stage_remote_values(domain_ids_list, INTEGER_VALUE)
+    sql_select = PowerDnsSqlReference.select_domain_digests(domain_ids)
+    return dict(exec_remote_select(host_id, sql_select, POWERDNS_DIGEST_TYPES, setup))
+
+
+def fetch_hub_domain_digests(db_conn, domain_names, domain_index=None):
+    """
+    Returns {domain_name: digest of all records of the domain}, see
+    fetch_hub_records_by_domain_list for domain_index.
+    """
+    domain_ids_list = _fetch_hub_domain_ids(db_conn, domain_names, domain_index)
+    if not domain_ids_list:
+        return {}
+    with stage_hub_values(db_conn, domain_ids_list, INTEGER_VALUE) as domain_ids:
+        return dict(exec_hub_query(db_conn, HubSqlReference.select_domain_digests(domain_ids)))
+
+
+def _fetch_hub_domain_ids(db_conn, domain_names, domain_index=None):
+    if domain_index is not None:
+        return domain_index.get_ids(domain_names)
+    with stage_hub_values(db_conn, domain_names, TEXT_VALUE) as names:
+        return flatten_list(exec_hub_query(db_conn, HubSqlReference.select_domain_id(names)))
+
+
+def fetch_hub_records_by_domain_ids(db_conn, domain_ids_list, stream=False):
+    """
+    With stream records are returned as an iterator over a server-side cursor,
+    which has to be consumed before the next query of the thread.
+    """
+    if stream:
+        return _stream_hub_records_by_domain_ids(db_conn, domain_ids_list)
+    with_hashes = not client_hashing_enabled()
+    with stage_hub_values(db_conn, domain_ids_list, INTEGER_VALUE) as domain_ids:
+        hub_records = exec_hub_query(
+            db_conn, HubSqlReference.select_dns_records(domain_ids, with_hashes))
+    return hub_records if with_hashes else list(hash_hub_rows(hub_records))
+
+
+def _stream_hub_records_by_domain_ids(db_conn, domain_ids_list):
+    with_hashes = not client_hashing_enabled()
+    # the staged table has to live until the stream is consumed
+    with stage_hub_values(db_conn, domain_ids_list, INTEGER_VALUE) as domain_ids:
+        hub_records = exec_hub_select(
+            db_conn, HubSqlReference.select_dns_records(domain_ids, with_hashes))
+        try:
+            for row in (hub_records if with_hashes else hash_hub_rows(hub_records)):
+                yield row
+        finally:
+            # a stream left early still reads the table through its cursor
+            hub_records.close()
+
+
+def fetch_hub_records_by_domain_list(
+    db_conn, domain_names, hub_cache=None, stream=False, domain_index=None
+):
+    """
+    Returns (whether any domain was found in Hub, Hub records of the domains),
+    see fetch_hub_records_by_domain_ids for stream. Names are resolved to Hub IDs
+    through domain_index (see db.hub_domains.HubDomainIndex) if given.
+    """
     logger.debug("Looking up ID in MN for domains: {}".format(','.join(domain_names)))
 
-    domain_record_set = exec_hub_query(db_conn, HubSqlReference.select_domain_id(domain_names))
-    real_size = len(domain_record_set)
+    domain_ids_list = _fetch_hub_domain_ids(db_conn, domain_names, domain_index)
+    real_size = len(domain_ids_list)
     requested_size = len(domain_names)
 
     if real_size == 0:
@@ -50,19 +178,36 @@ def fetch_hub_records_by_domain_list(db_conn, domain_names):
         msg += " Synchronization for {} domain(s) is skipped.".format(requested_size - real_size)
         logger.warning(msg)
 
-    domain_ids_list = flatten_list(domain_record_set)
-    return (True, exec_hub_query(db_conn, HubSqlReference.select_dns_records(domain_ids_list)))
+    if hub_cache is not None:
+        return (True, hub_cache.get_records(domain_ids_list, db_conn))
+    return (True, fetch_hub_records_by_domain_ids(db_conn, domain_ids_list, stream))
+
+
+def fetch_hub_domain_names(db_conn):
+    return flatten_list(exec_hub_query(db_conn, HubSqlReference.select_domain_names()))
+
+
+def fetch_hub_domain_ids_by_name(db_conn):
+    """
+    Returns {domain_name: Hub domain ID} of all domains synchronized to PowerDNS
+    """
+    return dict(exec_hub_select(db_conn, HubSqlReference.select_domain_ids_by_name()))
+
+
+def fetch_hub_domains_change_marker(db_conn):
+    return exec_hub_query(db_conn, HubSqlReference.select_domains_change_marker())[0][0]
+
+
+def fetch_hub_sync_watermark(db_conn):
+    return exec_hub_query(db_conn, HubSqlReference.select_sync_watermark())[0][0]
 
 
-# @measure_worktime
 @log_start_end
-def get_powerdns_hosts(db_conn):
-    return flatten_list(exec_hub_query(db_conn, HubSqlReference.select_powerdns_hosts()))
+def fetch_hub_changed_domains(db_conn, watermark):
+    return flatten_list(exec_hub_query(db_conn, HubSqlReference.select_changed_domains(watermark)))
 
 
-def get_powerdns_report_dict(powerdns_records):
-    return {
-        rec_id: (idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name)
-        for (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name, _, _)
-        in powerdns_records
-    }
+@measure_worktime
+@log_start_end
+def get_powerdns_hosts(db_conn):
+    return flatten_list(exec_hub_query(db_conn, HubSqlReference.select_powerdns_hosts()))
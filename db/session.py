@@ -0,0 +1,189 @@
+import logging
+import threading
+
+from db.wire import compress_cmd, decompress_output
+from utils.remote import Request
+
+RETVAR = 'retcode'
+RESULT_MARKER = '__PDNS_SYNC_END_OF_RESULT__'
+SCRIPT_EOF = '__PDNS_SYNC_SQL__'
+# a script is passed to the host in a single remote command
+MAX_SCRIPT_SIZE = 96 * 1024
+
+PSQL_CMD = "su - postgres -c \"psql -U postgres powerdns -t -q -v ON_ERROR_STOP=1 -f -\""
+# exit code of psql when a statement of its script fails
+PSQL_SCRIPT_ERROR = '3'
+
+logger = logging.getLogger(__name__)
+
+
+def make_hcl_script_cmd(sql_list, compress=False):
+    """
+    A command which pipes several SQL statements through one psql process,
+    the output of every statement is followed by RESULT_MARKER line.
+    The script is passed as a quoted here-document, so SQL is not touched by the shell.
+    """
+    script = ''.join(
+        "{}\n\\echo {}\n".format(_terminate(sql), RESULT_MARKER) for sql in sql_list
+    )
+    cmd = "{} <<'{}'".format(PSQL_CMD, SCRIPT_EOF)
+    if compress:
+        cmd = compress_cmd(cmd)
+    return "{0}\n{1}{2}\n".format(cmd, script, SCRIPT_EOF)
+
+
+def _terminate(sql):
+    sql = sql.rstrip()
+    # inline data of COPY ... FROM STDIN ends with a line of its own
+    if sql.endswith('\n\\.'):
+        return sql
+    return sql.rstrip(';') + ';'
+
+
+def split_script_output(output):
+    results = []
+    lines = []
+    for line in output.splitlines():
+        if line.strip() == RESULT_MARKER:
+            results.append('\n'.join(lines).strip())
+            lines = []
+        else:
+            lines.append(line)
+    return results
+
+
+class RemoteQueryError(Exception):
+    """A statement of a remote script failed, the script would fail again if retried"""
+
+
+class RemoteSession(object):
+    """
+    psql session on a PowerDNS host.
+
+    Request performs one command per round trip and can not keep a process
+    open between them, so a session sends as many statements as possible
+    through one psql process (see query_batch). A round trip which fails in
+    transport is retried on a new Request up to `retries` times, a failed
+    statement raises RemoteQueryError at once.
+    """
+    def __init__(self, host_id, request_factory=Request, retries=1):
+        self.host_id = host_id
+        self._request_factory = request_factory
+        self._retries = retries
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.statements = 0
+
+    def query(self, sql, compress=False):
+        return self.query_batch([sql], compress)[0]
+
+    def query_batch(self, sql_list, compress=False):
+        """
+        Executes statements in as few round trips as MAX_SCRIPT_SIZE allows,
+        returns stripped output of every statement. With compress the output
+        is gzipped and base64-encoded on the host.
+        """
+        results = []
+        script = []
+        script_size = 0
+        for sql in sql_list:
+            if script and script_size + len(sql) > MAX_SCRIPT_SIZE:
+                results.extend(self._perform(script, compress))
+                script = []
+                script_size = 0
+            script.append(sql)
+            script_size += len(sql)
+        if script:
+            results.extend(self._perform(script, compress))
+        return results
+
+    def query_script(self, sql_list, compress=False):
+        """
+        Executes statements in a single psql process whatever their size, so they
+        share temporary tables, returns stripped output of every statement.
+        """
+        return self._perform(sql_list, compress)
+
+    def _perform(self, sql_list, compress):
+        attempt = 0
+        while True:
+            try:
+                return self._perform_once(sql_list, compress)
+            except RemoteQueryError:
+                raise
+            except Exception as exc:
+                attempt += 1
+                if attempt > self._retries:
+                    raise
+                logger.warning("PowerDNS host #{}: remote query failed ({}), reconnecting".format(
+                    self.host_id, exc))
+
+    def _perform_once(self, sql_list, compress):
+        request = self._request_factory(self.host_id, 'root', 'root')
+        request.command(make_hcl_script_cmd(sql_list, compress),
+                        valid_exit_codes=[0],
+                        stdout='stdout',
+                        stderr='stderr',
+                        retvar=RETVAR)
+        result = request.perform()
+        if PSQL_SCRIPT_ERROR == str(result[RETVAR]):
+            raise RemoteQueryError("Remote statement failed: {}".format(result))
+        if '0' != str(result[RETVAR]):
+            raise Exception("Remote command fail: {}".format(result))
+
+        output = result['stdout']
+        if compress:
+            output = decompress_output(output)
+        results = split_script_output(output)
+        # psql stops at a failed statement, whose RESULT_MARKER is then missing
+        if len(results) != len(sql_list):
+            raise RemoteQueryError(
+                "Remote command returned {} results for {} statements: {}".format(
+                    len(results), len(sql_list), result))
+
+        with self._lock:
+            self.round_trips += 1
+            self.statements += len(sql_list)
+        return results
+
+
+class SessionPool(object):
+    """RemoteSession per PowerDNS host, shared by all threads of a run"""
+    def __init__(self, request_factory=Request, retries=1):
+        self._request_factory = request_factory
+        self._retries = retries
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, host_id):
+        with self._lock:
+            session = self._sessions.get(host_id)
+            if session is None:
+                session = RemoteSession(host_id, self._request_factory, self._retries)
+                self._sessions[host_id] = session
+            return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                logger.debug("PowerDNS host #{}: {} statements in {} round trips".format(
+                    session.host_id, session.statements, session.round_trips))
+            self._sessions.clear()
+
+
+_pool = SessionPool()
+
+
+def get_session(host_id):
+    return _pool.get(host_id)
+
+
+def set_request_factory(request_factory, retries=1):
+    """Replaces the transport of remote sessions, e.g. with a fake Request"""
+    global _pool
+    _pool.close()
+    _pool = SessionPool(request_factory, retries)
+
+
+def close_sessions():
+    _pool.close()
@@ -0,0 +1,87 @@
+"""
+Staging of long lists of domains in temporary tables (--stage-domains).
+
+Queries by thousands of domains inline thousands of IDs or quoted names into
+IN lists, which makes huge SQL texts that are slow to plan. With staging such
+lists are loaded into a temporary table with COPY and the queries select from
+it (see db.references.StagedValues). On Hub the table is loaded through
+psycopg2 copy_from, on PowerDNS hosts the COPY and its data go within the
+psql script of the query.
+"""
+import itertools
+import logging
+
+from contextlib import contextmanager
+from cStringIO import StringIO
+
+from db.core import hub_transaction_failed
+from db.references import StagedValues, StagingSqlReference
+
+# shorter lists are inlined
+STAGE_MIN_VALUES = 500
+INTEGER_VALUE = 'integer'
+TEXT_VALUE = 'text'
+# every remote script runs in its own psql process, so the name is not shared
+REMOTE_STAGE_TABLE = 'powerdns_sync_stage'
+
+logger = logging.getLogger(__name__)
+
+_staging_enabled = False
+_hub_stage_ids = itertools.count()
+
+
+def set_staging(enabled):
+    global _staging_enabled
+    _staging_enabled = enabled
+
+
+def _should_stage(values):
+    return _staging_enabled and len(values) >= STAGE_MIN_VALUES
+
+
+def _copy_line(value):
+    # text format of COPY
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def stage_remote_values(values, value_type, table=REMOTE_STAGE_TABLE):
+    """
+    Returns (values or StagedValues, setup statements) for exec_remote_select,
+    values are staged only if staging is enabled and they are many.
+    """
+    if not values or not _should_stage(values):
+        return (values, [])
+    setup = [
+        StagingSqlReference.create_table(table, value_type),
+        StagingSqlReference.copy_from_stdin(table, map(_copy_line, values)),
+        StagingSqlReference.analyze_table(table),
+    ]
+    return (StagedValues(table), setup)
+
+
+@contextmanager
+def stage_hub_values(db_conn, values, value_type):
+    """
+    Yields values or StagedValues of a temporary table on Hub which exists
+    within the block, values are staged only if staging is enabled and they are many.
+    Queries of the table have to be done with it when the block ends.
+    """
+    if not values or not _should_stage(values):
+        yield values
+        return
+
+    table = "powerdns_sync_stage_{}".format(next(_hub_stage_ids))
+    cur = db_conn.cursor()
+    try:
+        cur.execute(StagingSqlReference.create_table(table, value_type))
+        cur.copy_from(StringIO(''.join(_copy_line(value) + '\n' for value in values)),
+                      table, columns=('value',))
+        cur.execute(StagingSqlReference.analyze_table(table))
+        yield StagedValues(table)
+    finally:
+        try:
+            # a failed statement aborts the transaction, the table is dropped with its rollback
+            if not hub_transaction_failed(db_conn):
+                cur.execute(StagingSqlReference.drop_table(table))
+        finally:
+            cur.close()
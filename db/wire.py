@@ -0,0 +1,55 @@
+"""
+Formats of remote query results.
+
+WIRE_PSQL is psql's human readable output (`psql -t`), cells are separated by ' | '
+and can not contain it. WIRE_CSV runs the query as `COPY (...) TO STDOUT WITH CSV`,
+WIRE_CSV_GZIP additionally compresses the output with gzip and base64 for transport.
+"""
+import base64
+import csv
+import zlib
+
+from cStringIO import StringIO
+
+WIRE_PSQL = 'psql'
+WIRE_CSV = 'csv'
+WIRE_CSV_GZIP = 'csv-gzip'
+WIRE_FORMATS = (WIRE_PSQL, WIRE_CSV, WIRE_CSV_GZIP)
+
+
+def INT(cell):
+    return int(cell) if cell != '' else None
+
+
+def TEXT(cell):
+    return cell
+
+
+def copy_sql(sql):
+    return "COPY ({}) TO STDOUT WITH CSV".format(sql)
+
+
+def compress_cmd(cmd):
+    # where the shell has pipefail a failed psql fails the pipeline, elsewhere it is
+    # found by the missing RESULT_MARKER of its statement (see db.session)
+    return "(set -o pipefail) 2>/dev/null && set -o pipefail; {} | gzip -c | base64".format(cmd)
+
+
+def decompress_output(output):
+    return zlib.decompress(base64.b64decode(output), 16 + zlib.MAX_WBITS)
+
+
+def _typed(row, types):
+    if types is None:
+        return row
+    return [convert(cell) for (convert, cell) in zip(types, row)]
+
+
+def iter_psql_rows(output, types=None):
+    for line in output.splitlines():
+        yield _typed([cell.strip() for cell in line.split(' | ')], types)
+
+
+def iter_csv_rows(output, types=None):
+    for row in csv.reader(StringIO(output)):
+        yield _typed(row, types)
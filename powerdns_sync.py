@@ -4,11 +4,38 @@ import sys
 import logging
 
 from db import db_client
+from db.core import DEFAULT_HUB_ITERSIZE, set_hub_itersize, set_wire_format
+from db.hashing import set_client_hashing
+from db.hub_cache import DEFAULT_MAX_RECORDS, HubRecordCache
+from db.hub_domains import HubDomainIndex
+from db.session import close_sessions
+from db.staging import set_staging
+from db.wire import WIRE_FORMATS, WIRE_PSQL
 from db.selectors import get_powerdns_hosts
 
-from processing.synchronizer import synchronize
+from processing.synchronizer import MATCHER_DEFAULT, MATCHER_NUMPY, MATCHERS, synchronize
+from processing.chunking import DEFAULT_CHUNK_RECORDS, DEFAULT_CHUNK_SECONDS
+from processing.checkpoint import DEFAULT_CHECKPOINT_FILE, SyncCheckpoint
+from processing.daemon import DEFAULT_CYCLE_DOMAINS, DEFAULT_CYCLE_INTERVAL, SyncDaemon
+from processing.incremental import (
+    DEFAULT_FULL_RESCAN_INTERVAL,
+    DEFAULT_STATE_FILE,
+    SyncState,
+    plan_incremental_run,
+)
+from processing.numpy_matcher import numpy_available
+from processing.plan import FixPlanWriter, apply_plan
 from processing.reporters import PowerDnsSyncCsvReporter
+from processing.sharded_matcher import set_match_workers
+from processing.snapshot import (
+    HUB_SNAPSHOT_FILE,
+    export_snapshots,
+    powerdns_snapshot_paths,
+    report_snapshot_diffs,
+)
+from processing.throttle import WriteThrottle
 
+from utils.metrics import metrics
 from utils.utils import timestamp
 
 
@@ -23,6 +50,105 @@ __long_options = [
         "The script ignores domains with listed names (separated with comma)."),
     ('skip-error-report',
         "The script does not create a report powerdns_diff_report_YYYY-MM-DD_HH-MM-SS.mmm.csv."),
+    ('parallel-hosts=',
+        "The script synchronizes up to N PowerDNS hosts concurrently (default is 1)."),
+    ('hub-cache-size=',
+        "The script keeps up to N Hub DNS records in memory to share them between hosts "
+        "(default is {}).".format(DEFAULT_MAX_RECORDS)),
+    ('hub-cache-spill-dir=',
+        "The script spills Hub DNS records evicted from memory to a temporary file "
+        "in the directory."),
+    ('digest-precheck',
+        "The script compares per-domain digests first and fetches DNS records "
+        "only for domains which differ."),
+    ('pipeline-depth=',
+        "The script fetches up to N domain chunks of a host ahead while the current one "
+        "is matched and fixed (default is 0, no prefetching)."),
+    ('matcher=',
+        "The script matches DNS records with one of the engines: {} (default is {}). "
+        "'merge' streams over records ordered by hash and needs less memory, "
+        "'numpy' matches hashes in arrays and needs NumPy."
+        .format(', '.join(MATCHERS), MATCHER_DEFAULT)),
+    ('match-workers=',
+        "The script matches DNS records of large chunks in N processes with "
+        "the default matcher (by default in the synchronizing threads)."),
+    ('wire-format=',
+        "The script reads PowerDNS query results in one of the formats: {} (default is {}). "
+        "'csv' is faster to parse and safe for any content, 'csv-gzip' also compresses it."
+        .format(', '.join(WIRE_FORMATS), WIRE_PSQL)),
+    ('metrics-json=',
+        "The script writes a JSON summary of stage latencies and counters to the file."),
+    ('metrics-prom=',
+        "The script writes stage latencies and counters to the file in Prometheus text format."),
+    ('trace-memory',
+        "The script also records the peak of memory used by every stage."),
+    ('incremental',
+        "The script synchronizes only domains changed on Hub since the previous incremental run "
+        "and domains found inconsistent by it."),
+    ('state-file=',
+        "The script keeps the state of incremental runs in the file (default is ./{})."
+        .format(DEFAULT_STATE_FILE)),
+    ('full-rescan-interval=',
+        "The script makes a full incremental run if the last one was more than N hours ago "
+        "(default is {}).".format(DEFAULT_FULL_RESCAN_INTERVAL / 3600)),
+    ('consensus',
+        "The script matches domains which are identical on several PowerDNS hosts once "
+        "and applies the results to all of them."),
+    ('daemon',
+        "The script runs until SIGTERM, synchronizing domains in cycles, "
+        "changed, inconsistent and failed domains first."),
+    ('cycle-domains=',
+        "The script synchronizes up to N domains per daemon cycle (default is {})."
+        .format(DEFAULT_CYCLE_DOMAINS)),
+    ('cycle-interval=',
+        "The script starts daemon cycles at most every N seconds (default is {})."
+        .format(DEFAULT_CYCLE_INTERVAL)),
+    ('stage-domains',
+        "The script loads long lists of domains into temporary tables with COPY "
+        "instead of inlining them into SQL (needs a writable Hub session)."),
+    ('client-hashing',
+        "The script hashes DNS records itself instead of PowerDNS and Hub databases."),
+    ('hash-workers=',
+        "The script hashes DNS records in N processes with --client-hashing "
+        "(by default in the synchronizing threads)."),
+    ('hub-domain-cache=',
+        "The script keeps the index of Hub domain IDs in the file and loads it from Hub "
+        "again only when Hub domains have changed."),
+    ('hub-itersize=',
+        "The script streams Hub records in batches of N rows (default is {})."
+        .format(DEFAULT_HUB_ITERSIZE)),
+    ('chunk-records=',
+        "The script fetches domains in chunks of about N records (default is {}), "
+        "fewer if a chunk takes longer than --chunk-seconds.".format(DEFAULT_CHUNK_RECORDS)),
+    ('chunk-seconds=',
+        "The script sizes chunks of domains to be fetched in about N seconds (default is {})."
+        .format(DEFAULT_CHUNK_SECONDS)),
+    ('fix-rows-per-second=',
+        "The script writes at most N rows per second to a PowerDNS host, "
+        "less while its statements are slower than usual."),
+    ('max-fix-writers=',
+        "The script writes fixes to at most N PowerDNS hosts at once."),
+    ('plan-file=',
+        "The script writes the fixes it would make to the file, see --apply-plan."),
+    ('apply-plan=',
+        "The script applies fixes of the plan file to PowerDNS records which have not "
+        "changed since, without a scan."),
+    ('export-snapshots=',
+        "The script writes snapshots of DNS records of Hub and PowerDNS hosts "
+        "to the directory and exits, see --diff-snapshots."),
+    ('diff-snapshots=',
+        "The script reports the difference of PowerDNS snapshots in the directory "
+        "from the Hub snapshot without connecting to databases (fixes are written "
+        "with --plan-file) and exits."),
+    ('hub-snapshot=',
+        "The script diffs with the Hub snapshot file instead of hub.snapshot "
+        "of the directory, --export-snapshots does not export Hub then."),
+    ('resume',
+        "The script continues the interrupted run from its checkpoint and appends "
+        "to its report; --sync-domains and --exclude-domains of that run are used."),
+    ('checkpoint-file=',
+        "The script records checkpoints of a run to the file (default is ./{})."
+        .format(DEFAULT_CHECKPOINT_FILE)),
     ('help',
         "The script prints this message and exits (all other arguments are ignored).")
 ]  # list of available long options
@@ -61,26 +187,232 @@ if __name__ == '__main__':
         print_usage()
         sys.exit(0)
 
+    def positive_int_opt(name, default):
+        try:
+            value = int(opts.get(name, default))
+            if value < 1:
+                raise ValueError(value)
+        except ValueError:
+            print "{} expects a positive integer".format(name)
+            print_usage()
+            sys.exit(2)
+        return value
+
+    parallel_hosts = positive_int_opt('--parallel-hosts', 1)
+    hub_cache_size = positive_int_opt('--hub-cache-size', DEFAULT_MAX_RECORDS)
+    pipeline_depth = positive_int_opt('--pipeline-depth', 1) if '--pipeline-depth' in opts else 0
+    chunk_records = positive_int_opt('--chunk-records', DEFAULT_CHUNK_RECORDS)
+    chunk_seconds = positive_int_opt('--chunk-seconds', DEFAULT_CHUNK_SECONDS)
+    throttle = None
+    if '--fix-rows-per-second' in opts or '--max-fix-writers' in opts:
+        throttle = WriteThrottle(
+            positive_int_opt('--fix-rows-per-second', 1)
+            if '--fix-rows-per-second' in opts else None,
+            positive_int_opt('--max-fix-writers', 1) if '--max-fix-writers' in opts else None)
+    full_rescan_interval = 3600 * positive_int_opt(
+        '--full-rescan-interval', DEFAULT_FULL_RESCAN_INTERVAL / 3600)
+
+    matcher = opts.get('--matcher', MATCHER_DEFAULT)
+    if matcher not in MATCHERS:
+        print "--matcher expects one of: {}".format(', '.join(MATCHERS))
+        print_usage()
+        sys.exit(2)
+    if matcher == MATCHER_NUMPY and not numpy_available():
+        print "--matcher={} needs NumPy to be installed".format(MATCHER_NUMPY)
+        sys.exit(2)
+    if '--match-workers' in opts:
+        set_match_workers(positive_int_opt('--match-workers', 1))
+
+    wire_format = opts.get('--wire-format', WIRE_PSQL)
+    if wire_format not in WIRE_FORMATS:
+        print "--wire-format expects one of: {}".format(', '.join(WIRE_FORMATS))
+        print_usage()
+        sys.exit(2)
+    set_wire_format(wire_format)
+    set_hub_itersize(positive_int_opt('--hub-itersize', DEFAULT_HUB_ITERSIZE))
+    if '--client-hashing' in opts:
+        set_client_hashing(
+            True, positive_int_opt('--hash-workers', 1) if '--hash-workers' in opts else 0)
+    set_staging('--stage-domains' in opts)
+
+    metrics.reset(trace_memory='--trace-memory' in opts)
+
+    def save_metrics():
+        if '--metrics-json' in opts:
+            metrics.write_json(opts['--metrics-json'])
+        if '--metrics-prom' in opts:
+            metrics.write_prometheus(opts['--metrics-prom'])
+
+    if '--apply-plan' in opts:
+        failed_hosts = apply_plan(opts['--apply-plan'], parallel_hosts, throttle)
+        close_sessions()
+        save_metrics()
+        sys.exit(1 if failed_hosts else 0)
+
+    def make_reporter():
+        return PowerDnsSyncCsvReporter(
+            "{}/powerdns_diff_report_{}.csv".format(
+                os.getcwd(),
+                timestamp().replace(':', '-').replace(' ', '_'))
+        )
+
+    sync_domains = opts['--sync-domains'].split(',') if '--sync-domains' in opts else None
+    exclude_domains = opts['--exclude-domains'].split(',') if '--exclude-domains' in opts else None
+
+    if '--diff-snapshots' in opts:
+        snapshot_dir = opts['--diff-snapshots']
+        csv_reporter = make_reporter()
+        plan = None
+        if '--plan-file' in opts:
+            plan = FixPlanWriter(opts['--plan-file'], csv_reporter.get_report_path())
+        report_snapshot_diffs(
+            powerdns_snapshot_paths(snapshot_dir),
+            opts.get('--hub-snapshot', os.path.join(snapshot_dir, HUB_SNAPSHOT_FILE)),
+            csv_reporter, plan)
+        csv_reporter.close()
+        logger.info("A difference report has been created: {}".format(
+            csv_reporter.get_report_path()))
+        if plan is not None:
+            plan.close()
+            logger.info("A fix plan has been created: {}".format(plan.get_plan_path()))
+        save_metrics()
+        sys.exit(0)
+
+    if '--export-snapshots' in opts:
+        conn = db_client.connect()
+        hub_domain_index = None
+        if '--hub-snapshot' not in opts:
+            hub_domain_index = HubDomainIndex(conn, opts.get('--hub-domain-cache'))
+        failed_hosts = export_snapshots(
+            conn, opts['--export-snapshots'], get_powerdns_hosts(conn),
+            sync_domains, exclude_domains, hub_domain_index, chunk_records)
+        close_sessions()
+        save_metrics()
+        sys.exit(1 if failed_hosts else 0)
+
+    if '--resume' in opts and (
+        '--incremental' in opts or '--daemon' in opts or '--plan-file' in opts or
+        '--consensus' in opts
+    ):
+        print "--resume can not be combined with --incremental, --daemon, --plan-file " \
+            "and --consensus"
+        print_usage()
+        sys.exit(2)
+
+    if '--daemon' in opts:
+        if '--incremental' in opts or sync_domains or '--plan-file' in opts or \
+                '--consensus' in opts:
+            print "--daemon can not be combined with --incremental, --sync-domains, " \
+                "--plan-file and --consensus"
+            print_usage()
+            sys.exit(2)
+
+        def save_cycle_metrics():
+            save_metrics()
+            # counters and histograms add up over cycles, latencies of chunks are per cycle
+            metrics.reset_chunks()
+
+        daemon = SyncDaemon(
+            connect=db_client.connect,
+            make_reporter=make_reporter,
+            sync_kwargs=dict(
+                exclude_domains=exclude_domains,
+                skip_error_report='--skip-error-report' in opts,
+                fix_errors='--fix-errors' in opts,
+                parallel_hosts=parallel_hosts,
+                digest_precheck='--digest-precheck' in opts,
+                pipeline_depth=pipeline_depth,
+                matcher=matcher,
+                throttle=throttle,
+                chunk_records=chunk_records,
+                chunk_seconds=chunk_seconds,
+            ),
+            cycle_domains=positive_int_opt('--cycle-domains', DEFAULT_CYCLE_DOMAINS),
+            cycle_interval=positive_int_opt('--cycle-interval', DEFAULT_CYCLE_INTERVAL),
+            hub_cache_size=hub_cache_size,
+            after_cycle=save_cycle_metrics,
+        )
+        daemon.install_signal_handlers()
+        daemon.run()
+        close_sessions()
+        sys.exit(0)
+
     conn = db_client.connect()
     hosts = get_powerdns_hosts(conn)
     if len(hosts) == 0:
         logger.info("No PowerDNS hosts are found.")
         sys.exit(0)
 
-    csv_reporter = PowerDnsSyncCsvReporter(
-        "{}/powerdns_diff_report_{}.csv".format(
-            os.getcwd(),
-            timestamp().replace(':', '-').replace(' ', '_'))
-    )
+    checkpoint = None
+    checkpoint_file = opts.get('--checkpoint-file', DEFAULT_CHECKPOINT_FILE)
+    if '--resume' in opts:
+        checkpoint = SyncCheckpoint.load(checkpoint_file)
+        sync_domains = checkpoint.sync_domains
+        exclude_domains = checkpoint.exclude_domains
+        csv_reporter = PowerDnsSyncCsvReporter(
+            checkpoint.report_path, resume_position=checkpoint.report_position)
+    else:
+        csv_reporter = make_reporter()
+        # a checkpoint of a leading host does not cover the hosts it matches for
+        if '--incremental' not in opts and '--consensus' not in opts:
+            checkpoint = SyncCheckpoint(
+                checkpoint_file, csv_reporter.get_report_path(), sync_domains, exclude_domains)
+            checkpoint.save()
 
-    exclude_domains = opts['--exclude-domains'].split(',') if '--exclude_domains' in opts else None,
+    sync_state = None
+    host_sync_domains = None
+    if '--incremental' in opts:
+        sync_state = SyncState(opts.get('--state-file', DEFAULT_STATE_FILE))
+        incremental_run = plan_incremental_run(
+            conn, sync_state, hosts, sync_domains, full_rescan_interval)
+        hosts = incremental_run.hosts
+        sync_domains = incremental_run.sync_domains
+        host_sync_domains = incremental_run.host_sync_domains
 
-    synchronize(
-        db_conn=conn,
-        csv_reporter=csv_reporter,
-        hosts=hosts,
-        sync_domains=opts['--sync-domains'].split(',') if '--sync-domains' in opts else None,
-        exclude_domains=exclude_domains,
-        skip_error_report='--skip-error-report' in opts,
-        fix_errors='--fix_errors' in opts,
-    )
+    plan = None
+    if '--plan-file' in opts:
+        plan = FixPlanWriter(opts['--plan-file'], csv_reporter.get_report_path())
+
+    hub_cache = HubRecordCache(conn, hub_cache_size, opts.get('--hub-cache-spill-dir'))
+    hub_domain_index = HubDomainIndex(conn, opts.get('--hub-domain-cache'))
+
+    with hub_cache:
+        failed_hosts = synchronize(
+            db_conn=conn,
+            csv_reporter=csv_reporter,
+            hosts=hosts,
+            sync_domains=sync_domains,
+            exclude_domains=exclude_domains,
+            skip_error_report='--skip-error-report' in opts,
+            fix_errors='--fix-errors' in opts,
+            parallel_hosts=parallel_hosts,
+            hub_cache=hub_cache,
+            digest_precheck='--digest-precheck' in opts,
+            pipeline_depth=pipeline_depth,
+            matcher=matcher,
+            sync_state=sync_state,
+            host_sync_domains=host_sync_domains,
+            checkpoint=checkpoint,
+            throttle=throttle,
+            plan=plan,
+            chunk_records=chunk_records,
+            chunk_seconds=chunk_seconds,
+            hub_domain_index=hub_domain_index,
+            consensus='--consensus' in opts,
+            connect=db_client.connect,
+        )
+    close_sessions()
+    csv_reporter.close()
+    if plan is not None:
+        plan.close()
+        logger.info("A fix plan has been created: {}".format(plan.get_plan_path()))
+
+    # failed hosts are continued by --resume
+    if checkpoint is not None and not failed_hosts:
+        checkpoint.remove()
+
+    if sync_state is not None:
+        sync_state.save(incremental_run.watermark, failed_hosts, incremental_run.full_scan)
+
+    save_metrics()
+    sys.exit(1 if failed_hosts else 0)
@@ -0,0 +1,93 @@
+"""
+Checkpoints of a synchronization run (--resume).
+
+After every chunk of domains is fixed and reported, the checkpoint file records
+for its host the number of processed domains and the last processed domain ID
+(domains are processed in the order of IDs), together with the position of
+the end of the CSV report. A resumed run skips completed hosts and processed
+domains, truncates the report to that position and appends to it.
+"""
+import json
+import logging
+import os
+import threading
+
+from utils.utils import write_file_atomically
+
+CHECKPOINT_VERSION = 1
+DEFAULT_CHECKPOINT_FILE = 'powerdns_sync_checkpoint.json'
+
+logger = logging.getLogger(__name__)
+
+
+class SyncCheckpoint(object):
+    def __init__(self, path, report_path, sync_domains=None, exclude_domains=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self.report_path = report_path
+        self.report_position = 0
+        self.sync_domains = sync_domains
+        self.exclude_domains = exclude_domains
+        self._hosts = {}
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            raise Exception("There is no checkpoint to resume from: {}".format(path))
+        with open(path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise Exception("Unsupported version of checkpoint file {}: {}".format(
+                path, state.get('version')))
+        checkpoint = cls(path, state['report_path'],
+                         state['sync_domains'], state['exclude_domains'])
+        checkpoint.report_position = state['report_position']
+        # JSON keys are strings
+        checkpoint._hosts = {int(host_id): host for (host_id, host) in state['hosts'].items()}
+        logger.info("Resuming from checkpoint {}: {} hosts completed".format(
+            path, len([host for host in checkpoint._hosts.values() if host['done']])))
+        return checkpoint
+
+    def is_host_done(self, host_id):
+        with self._lock:
+            return self._hosts.get(host_id, {}).get('done', False)
+
+    def host_progress(self, host_id):
+        """Returns (number of processed domains, last processed domain ID or None)"""
+        with self._lock:
+            host = self._hosts.get(host_id, {})
+            return host.get('offset', 0), host.get('last_domain_id')
+
+    def chunk_done(self, host_id, offset, last_domain_id, report_position):
+        """
+        Called with the report held (see CsvReporter.batch), so report_position
+        does not include rows of chunks of other hosts which are not recorded yet.
+        """
+        with self._lock:
+            host = self._hosts.setdefault(host_id, {'done': False})
+            host['offset'] = offset
+            host['last_domain_id'] = last_domain_id
+            self.report_position = report_position
+        self.save()
+
+    def host_done(self, host_id):
+        with self._lock:
+            self._hosts.setdefault(host_id, {})['done'] = True
+        self.save()
+
+    def save(self):
+        with self._lock:
+            state = {
+                'version': CHECKPOINT_VERSION,
+                'report_path': self.report_path,
+                'report_position': self.report_position,
+                'sync_domains': self.sync_domains,
+                'exclude_domains': self.exclude_domains,
+                'hosts': self._hosts,
+            }
+            # under the lock, so an older state never overwrites a newer one
+            write_file_atomically(self._path, json.dumps(state, indent=1))
+
+    def remove(self):
+        if os.path.exists(self._path):
+            os.remove(self._path)
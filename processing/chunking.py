@@ -0,0 +1,77 @@
+"""
+Sizing of chunks of domains by their records.
+
+Domains differ in the number of records by orders of magnitude, so a chunk
+takes domains until their records (counted on the host beforehand) reach the
+record budget. The budget starts at target_records, which bounds the memory
+of a chunk, and follows the observed records per second so that a chunk is
+fetched in about target_seconds.
+"""
+from db.selectors import fetch_powerdns_record_counts
+from db.session import MAX_SCRIPT_SIZE
+
+DEFAULT_CHUNK_RECORDS = 100000
+DEFAULT_CHUNK_SECONDS = 10
+MIN_CHUNK_RECORDS = 1000
+# so few domains are fetched in a single chunk without counting their records
+MAX_UNCOUNTED_DOMAINS = 100
+# ids of a chunk are inlined twice into a query (see db.references.PowerDnsSqlReference),
+# which is sent within a remote script, the rest of the query takes a few KB
+MAX_CHUNK_IDS_SIZE = (MAX_SCRIPT_SIZE - 8 * 1024) // 2
+# weight of the last chunk in the budget
+BUDGET_SMOOTHING = 0.5
+
+
+def fetch_record_counts(host_id, pdns_domains, all_domains=False):
+    """
+    Record counts of pdns_domains ([(domain_id, domain_name), ...]) for AdaptiveChunker.
+    With all_domains (pdns_domains are all domains of the host, maybe but a few) records
+    are counted in one pass over the table instead of by a long list of IDs.
+    """
+    if len(pdns_domains) <= MAX_UNCOUNTED_DOMAINS:
+        return {}
+    if all_domains:
+        return fetch_powerdns_record_counts(host_id)
+    return fetch_powerdns_record_counts(host_id, [domain_id for (domain_id, _) in pdns_domains])
+
+
+class AdaptiveChunker(object):
+    def __init__(self, record_counts, target_records=DEFAULT_CHUNK_RECORDS,
+                 target_seconds=DEFAULT_CHUNK_SECONDS):
+        """record_counts is {domain_id: number of records}"""
+        self._record_counts = record_counts
+        self.target_records = target_records
+        self.target_seconds = target_seconds
+        self.budget = target_records
+
+    def estimate(self, domain_id):
+        # a domain costs at least as much as a record
+        return max(self._record_counts.get(domain_id, 0), 1)
+
+    def split(self, domains):
+        """Yields chunks of [(domain_id, domain_name), ...], see observe()"""
+        chunk = []
+        chunk_records = 0
+        chunk_ids_size = 0
+        for domain in domains:
+            records = self.estimate(domain[0])
+            ids_size = len(str(domain[0])) + 1  # with a comma
+            if chunk and (chunk_records + records > self.budget
+                          or chunk_ids_size + ids_size > MAX_CHUNK_IDS_SIZE):
+                yield chunk
+                chunk = []
+                chunk_records = 0
+                chunk_ids_size = 0
+            chunk.append(domain)
+            chunk_records += records
+            chunk_ids_size += ids_size
+        if chunk:
+            yield chunk
+
+    def observe(self, records, seconds):
+        """Adjusts the budget by the time the last chunk of records took"""
+        if records < 1 or seconds <= 0:
+            return
+        budget = records / seconds * self.target_seconds
+        budget = self.budget + (budget - self.budget) * BUDGET_SMOOTHING
+        self.budget = int(min(max(budget, MIN_CHUNK_RECORDS), self.target_records))
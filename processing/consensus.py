@@ -0,0 +1,111 @@
+"""
+Cross-host consensus (--consensus).
+
+PowerDNS hosts are usually replicas with identical records tables. Before
+synchronization every host is asked for fingerprints of its domains, which
+cover record IDs and contents. Hosts with the same domain ID and fingerprint
+of a domain form a class, the first host of the class (the leader) fetches
+and matches the domain, and the fixes and report rows found for it are
+fanned out to the other hosts of the class. So a domain is compared once per
+distinct content instead of once per host.
+"""
+import logging
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+from db.selectors import fetch_powerdns_domain_fingerprints, fetch_powerdns_domains
+from utils.decorators import save_traceback
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HostAssignment(object):
+    """
+    pdns_domains: [(domain_id, domain_name), ...] the host fetches and matches
+    fanout: {domain_id: [host_id, ...]} other hosts which get the results
+    """
+    def __init__(self):
+        self.pdns_domains = []
+        self.fanout = {}
+
+
+def _fetch_host_domains(host_id, host_sync_domains, sync_domains, exclude_domains):
+    try:
+        pdns_domains = fetch_powerdns_domains(
+            host_id, host_sync_domains.get(host_id, sync_domains), exclude_domains)
+        with metrics.stage('fingerprints', host_id):
+            fingerprints = fetch_powerdns_domain_fingerprints(host_id)
+    except Exception:
+        save_traceback()
+        logger.error("Fingerprints of PowerDNS host #{} are not available: {}".format(
+            host_id, sys.exc_info()[1]))
+        return None
+    return (pdns_domains, fingerprints)
+
+
+def assign_hosts(hosts, host_domains):
+    """
+    host_domains: {host_id: ([(domain_id, domain_name), ...], {domain_id: fingerprint})}
+    Returns {host_id: HostAssignment} of hosts which lead at least one domain.
+    """
+    classes = {}  # (domain_name, domain_id, fingerprint) -> [host_id, ...]
+    for host_id in hosts:
+        (pdns_domains, fingerprints) = host_domains[host_id]
+        for (domain_id, domain_name) in pdns_domains:
+            key = (domain_name, domain_id, fingerprints.get(domain_id))
+            classes.setdefault(key, []).append(host_id)
+
+    assignments = {}
+    for ((domain_name, domain_id, _), class_hosts) in classes.items():
+        assignment = assignments.setdefault(class_hosts[0], HostAssignment())
+        assignment.pdns_domains.append((domain_id, domain_name))
+        if len(class_hosts) > 1:
+            assignment.fanout[domain_id] = class_hosts[1:]
+    # domains are processed in the order of IDs, see processing.checkpoint
+    for assignment in assignments.values():
+        assignment.pdns_domains.sort()
+    return assignments
+
+
+def plan_consensus(hosts, sync_domains, exclude_domains, host_sync_domains, parallel_hosts=1):
+    """
+    Returns {host_id: HostAssignment or None}, hosts without fingerprints get None
+    and are synchronized on their own, hosts which lead no domain are left out.
+    """
+    def fetch(host_id):
+        return _fetch_host_domains(host_id, host_sync_domains, sync_domains, exclude_domains)
+
+    if parallel_hosts > 1 and len(hosts) > 1:
+        pool = ThreadPool(min(parallel_hosts, len(hosts)))
+        try:
+            results = pool.map(fetch, hosts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch(host_id) for host_id in hosts]
+
+    host_domains = dict(
+        (host_id, result) for (host_id, result) in zip(hosts, results) if result is not None)
+    consensus_hosts = [host_id for host_id in hosts if host_id in host_domains]
+    assignments = assign_hosts(consensus_hosts, host_domains)
+    for host_id in hosts:
+        if host_id not in host_domains:
+            assignments[host_id] = None
+
+    total = sum(len(host_domains[host_id][0]) for host_id in consensus_hosts)
+    matched = sum(len(assignment.pdns_domains)
+                  for assignment in assignments.values() if assignment is not None)
+    metrics.inc('consensus_domains', total)
+    metrics.inc('consensus_matched_domains', matched)
+    logger.info("Consensus: {} domains of {} hosts are matched as {} domains on {} hosts".format(
+        total, len(consensus_hosts), matched,
+        len([a for a in assignments.values() if a is not None])))
+    return assignments
+
+
+def members_of(assignment):
+    """Hosts which get results of the leading host"""
+    return sorted({host_id for members in assignment.fanout.values() for host_id in members})
@@ -0,0 +1,233 @@
+"""
+Long-running synchronization (--daemon).
+
+Every cycle synchronizes a budget of domains chosen by DomainScheduler on all
+PowerDNS hosts, keeping the Hub connection and remote sessions between cycles.
+"""
+import heapq
+import logging
+import signal
+import sys
+import threading
+import time
+
+from db.hub_cache import HubRecordCache
+from db.selectors import (
+    fetch_hub_changed_domains,
+    fetch_hub_domain_names,
+    fetch_hub_sync_watermark,
+    get_powerdns_hosts,
+)
+from processing.synchronizer import synchronize
+from utils.decorators import save_traceback
+
+DEFAULT_CYCLE_DOMAINS = 1000
+DEFAULT_CYCLE_INTERVAL = 60
+HOSTS_REFRESH_INTERVAL = 600
+DOMAINS_REFRESH_INTERVAL = 600
+MAX_ERROR_BACKOFF = 600
+
+# a boosted domain is scheduled as if it was not checked for this many seconds longer
+BOOST_CHANGED = 24 * 3600
+BOOST_FAILED = 2 * 24 * 3600
+BOOST_INCONSISTENT = 3 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+class DomainScheduler(object):
+    """
+    Picks domains to check next. Every domain ages since its last check,
+    changed, failed and inconsistent domains get a boost which is dropped
+    once the domain is checked, so all domains are eventually cycled through.
+    """
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_checked = {}  # domain_name -> time
+        self._boosts = {}  # domain_name -> seconds
+
+    def update_domains(self, domain_names):
+        """Sets the domains to schedule, new domains go first"""
+        with self._lock:
+            domain_names = set(domain_names)
+            for name in domain_names.difference(self._last_checked):
+                self._last_checked[name] = 0
+            for name in set(self._last_checked).difference(domain_names):
+                del self._last_checked[name]
+                self._boosts.pop(name, None)
+
+    def boost(self, domain_names, seconds):
+        with self._lock:
+            for name in domain_names:
+                if name in self._last_checked:
+                    self._boosts[name] = max(self._boosts.get(name, 0), seconds)
+
+    def flag_domains(self, domain_names):
+        """Called by synchronize() for inconsistent domains"""
+        self.boost(domain_names, BOOST_INCONSISTENT)
+
+    def next_batch(self, budget):
+        with self._lock:
+            now = self._clock()
+            return heapq.nlargest(
+                budget, self._last_checked,
+                key=lambda name: now - self._last_checked[name] + self._boosts.get(name, 0))
+
+    def mark_checked(self, domain_names):
+        with self._lock:
+            now = self._clock()
+            for name in domain_names:
+                if name in self._last_checked:
+                    self._last_checked[name] = now
+                    self._boosts.pop(name, None)
+
+
+class SyncDaemon(object):
+    """
+    connect: () -> Hub connection, called again after a Hub failure
+    make_reporter: () -> CsvReporter, called when the report file should be rotated
+    sync_kwargs: keyword arguments passed to synchronize()
+    after_cycle: () -> None, called after every cycle, also a failed one
+    """
+    def __init__(self, connect, make_reporter, sync_kwargs,
+                 cycle_domains=DEFAULT_CYCLE_DOMAINS, cycle_interval=DEFAULT_CYCLE_INTERVAL,
+                 hub_cache_size=None, after_cycle=None):
+        self._connect = connect
+        self._make_reporter = make_reporter
+        self._sync_kwargs = sync_kwargs
+        self._cycle_domains = cycle_domains
+        self._cycle_interval = cycle_interval
+        self._hub_cache_size = hub_cache_size
+        self._after_cycle = after_cycle
+        self._stop = threading.Event()
+        self.scheduler = DomainScheduler()
+
+        self._conn = None
+        self._hosts = []
+        self._failed_hosts = set()
+        self._watermark = None
+        self._hosts_refreshed = 0
+        self._domains_refreshed = 0
+        self._reporter = None
+        self._report_day = None
+
+    def stop(self, *args):
+        logger.info("Synchronization daemon is stopping after the current cycle")
+        self._stop.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self):
+        errors = 0
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                self.run_cycle()
+                errors = 0
+                delay = self._cycle_interval - (time.time() - started)
+            except Exception:
+                save_traceback()
+                logger.error("Synchronization cycle failed: {}".format(sys.exc_info()[1]))
+                self._close_conn()
+                errors += 1
+                delay = min(self._cycle_interval * 2 ** errors, MAX_ERROR_BACKOFF)
+            if self._after_cycle is not None:
+                try:
+                    self._after_cycle()
+                except Exception:
+                    save_traceback()
+                    logger.error("After cycle actions failed: {}".format(sys.exc_info()[1]))
+            self._stop.wait(max(delay, 0))
+        self._close_conn()
+        if self._reporter is not None:
+            self._reporter.close()
+
+    def run_cycle(self):
+        try:
+            self._sync_cycle()
+        finally:
+            self._end_transaction()
+
+    def _sync_cycle(self):
+        now = time.time()
+        if self._conn is None:
+            self._conn = self._connect()
+            self._watermark = None
+        if not self._hosts or now - self._hosts_refreshed >= HOSTS_REFRESH_INTERVAL:
+            self._hosts = get_powerdns_hosts(self._conn)
+            self._hosts_refreshed = now
+        if now - self._domains_refreshed >= DOMAINS_REFRESH_INTERVAL:
+            self.scheduler.update_domains(fetch_hub_domain_names(self._conn))
+            self._domains_refreshed = now
+
+        watermark = fetch_hub_sync_watermark(self._conn)
+        if self._watermark is not None:
+            self.scheduler.boost(
+                fetch_hub_changed_domains(self._conn, self._watermark), BOOST_CHANGED)
+        self._watermark = watermark
+
+        batch = self.scheduler.next_batch(self._cycle_domains)
+        if not batch or not self._hosts:
+            return
+
+        # recently failed hosts go first
+        hosts = sorted(self._hosts, key=lambda host_id: host_id not in self._failed_hosts)
+        logger.info("Synchronization cycle: {} domains on {} hosts".format(
+            len(batch), len(hosts)))
+        # Hub records may change between cycles, so they are cached within a cycle only
+        hub_cache = HubRecordCache(self._conn, self._hub_cache_size) \
+            if self._hub_cache_size else None
+        # marked before synchronization, so domains flagged by it keep their boost
+        self.scheduler.mark_checked(batch)
+        try:
+            failed_hosts = synchronize(
+                db_conn=self._conn,
+                csv_reporter=self._current_reporter(),
+                hosts=hosts,
+                sync_domains=batch,
+                hub_cache=hub_cache,
+                sync_state=self.scheduler,
+                connect=self._connect,
+                **self._sync_kwargs
+            )
+        except Exception:
+            self.scheduler.boost(batch, BOOST_FAILED)
+            raise
+        finally:
+            if hub_cache is not None:
+                hub_cache.close()
+
+        self._failed_hosts = set(failed_hosts)
+        if failed_hosts:
+            self.scheduler.boost(batch, BOOST_FAILED)
+
+    def _current_reporter(self):
+        day = time.strftime('%Y-%m-%d')
+        if self._reporter is None or day != self._report_day:
+            if self._reporter is not None:
+                self._reporter.close()
+            self._reporter = self._make_reporter()
+            self._report_day = day
+        return self._reporter
+
+    def _end_transaction(self):
+        # the daemon only reads Hub, an open transaction would hold back the watermark
+        # (see fetch_hub_sync_watermark) and vacuum on Hub until the daemon stops
+        if self._conn is None:
+            return
+        try:
+            self._conn.rollback()
+        except Exception:
+            logger.warning("Hub transaction can not be rolled back: {}".format(sys.exc_info()[1]))
+            self._close_conn()
+
+    def _close_conn(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
@@ -0,0 +1,108 @@
+"""
+Incremental synchronization (--incremental).
+
+A state file keeps the Hub transaction watermark of the last run, domains found
+inconsistent by it and hosts which failed. The next run synchronizes only domains
+changed on Hub since the watermark plus the flagged ones, failed hosts are
+synchronized fully, and every full_rescan_interval seconds a full run is made.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from db.selectors import fetch_hub_changed_domains, fetch_hub_sync_watermark
+from utils.utils import write_file_atomically
+
+STATE_VERSION = 1
+DEFAULT_STATE_FILE = 'powerdns_sync_state.json'
+DEFAULT_FULL_RESCAN_INTERVAL = 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+class SyncState(object):
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self.watermark = None
+        self.last_full_scan = None
+        self.flagged_domains = set()
+        self.failed_hosts = set()
+        self._new_flagged_domains = set()
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self._path) as state_file:
+            state = json.load(state_file)
+        if state.get('version') != STATE_VERSION:
+            raise Exception("Unsupported version of synchronization state file {}: {}".format(
+                self._path, state.get('version')))
+        self.watermark = state['watermark']
+        self.last_full_scan = state['last_full_scan']
+        self.flagged_domains = set(state['flagged_domains'])
+        self.failed_hosts = set(state['failed_hosts'])
+
+    def flag_domains(self, domain_names):
+        """Domains to synchronize again on the next run, called from worker threads"""
+        if domain_names:
+            with self._lock:
+                self._new_flagged_domains.update(domain_names)
+
+    def save(self, watermark, failed_hosts, full_scan, now=None):
+        with self._lock:
+            self.watermark = watermark
+            if full_scan:
+                self.last_full_scan = now or time.time()
+            self.flagged_domains = self._new_flagged_domains
+            self._new_flagged_domains = set()
+            self.failed_hosts = set(failed_hosts)
+            state = {
+                'version': STATE_VERSION,
+                'watermark': self.watermark,
+                'last_full_scan': self.last_full_scan,
+                'flagged_domains': sorted(self.flagged_domains),
+                'failed_hosts': sorted(self.failed_hosts),
+            }
+        write_file_atomically(self._path, json.dumps(state, indent=1))
+
+
+class IncrementalRun(object):
+    """What to synchronize in this run, see synchronize() for the meaning of fields"""
+    def __init__(self, watermark, full_scan, hosts, sync_domains, host_sync_domains):
+        self.watermark = watermark
+        self.full_scan = full_scan
+        self.hosts = hosts
+        self.sync_domains = sync_domains
+        self.host_sync_domains = host_sync_domains
+
+
+def plan_incremental_run(db_conn, state, hosts, sync_domains,
+                         full_rescan_interval=DEFAULT_FULL_RESCAN_INTERVAL, now=None):
+    # the watermark is taken before anything is read, changes made during the run
+    # are picked up by the next one
+    watermark = fetch_hub_sync_watermark(db_conn)
+    now = now or time.time()
+    if state.watermark is None or state.last_full_scan is None or \
+            now - state.last_full_scan >= full_rescan_interval:
+        logger.info("Incremental synchronization: full rescan")
+        return IncrementalRun(watermark, True, hosts, sync_domains, {})
+
+    domains = set(fetch_hub_changed_domains(db_conn, state.watermark))
+    logger.info("Incremental synchronization: {} domains changed on Hub, {} flagged".format(
+        len(domains), len(state.flagged_domains)))
+    domains.update(state.flagged_domains)
+    if sync_domains:
+        domains.intersection_update(sync_domains)
+
+    failed_hosts = [host_id for host_id in hosts if host_id in state.failed_hosts]
+    if failed_hosts:
+        logger.info("Incremental synchronization: full rescan of previously failed hosts: {}"
+                    .format(', '.join(map(str, failed_hosts))))
+
+    # an empty list of domains would mean all domains for synchronize()
+    run_hosts = hosts if domains else failed_hosts
+    return IncrementalRun(watermark, False, run_hosts, sorted(domains),
+                          {host_id: sync_domains for host_id in failed_hosts})
@@ -0,0 +1,89 @@
+from itertools import groupby
+from operator import itemgetter
+
+from utils.decorators import log_start_end
+
+# powerdns_records: [
+#   (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
+#    domain_name, rec_hash, ttl_hash),
+# ]
+PDNS_REC_ID = 0
+PDNS_REC_HASH = 8
+PDNS_TTL_HASH = 9
+
+# hub_dns_records: [
+#   (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id),
+# ]
+HUB_TTL = 2
+HUB_REC_HASH = 3
+HUB_TTL_HASH = 4
+
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+
+# returned after the last group, None is a valid key of records with NULL hashes
+_NO_GROUP = object()
+
+
+def _ordered(records, key_idx, source):
+    prev_key = None
+    for rec in records:
+        key = rec[key_idx]
+        if prev_key is not None and key < prev_key:
+            raise Exception("{} records are not ordered by rec_hash: '{}' follows '{}'".format(
+                source, key, prev_key))
+        prev_key = key
+        yield rec
+
+
+def _next_group(groups):
+    for key, recs in groups:
+        return (key, list(recs))
+    return (_NO_GROUP, [])
+
+
+def iter_merge_decisions(powerdns_records, hub_dns_records):
+    """
+    Single pass merge join of PowerDNS and Hub records, both ordered by rec_hash
+    (PowerDNS records with the same rec_hash are ordered by rec_id descending).
+    Yields (ACTION_DELETE, powerdns_record, None) and
+    (ACTION_UPDATE, powerdns_record, new_ttl) decisions.
+    """
+    hub_groups = groupby(_ordered(hub_dns_records, HUB_REC_HASH, 'Hub'),
+                         key=itemgetter(HUB_REC_HASH))
+    pdns_groups = groupby(_ordered(powerdns_records, PDNS_REC_HASH, 'PowerDNS'),
+                          key=itemgetter(PDNS_REC_HASH))
+
+    hub_hash, hub_recs = _next_group(hub_groups)
+    for rec_hash, pdns_recs in pdns_groups:
+        while hub_hash is not _NO_GROUP and hub_hash < rec_hash:
+            hub_hash, hub_recs = _next_group(hub_groups)
+
+        unique_rec = next(pdns_recs)
+        for duplicate_rec in pdns_recs:
+            yield (ACTION_DELETE, duplicate_rec, None)
+
+        if hub_hash != rec_hash:  # phantom record
+            yield (ACTION_DELETE, unique_rec, None)
+        elif unique_rec[PDNS_TTL_HASH] not in {rec[HUB_TTL_HASH] for rec in hub_recs}:
+            yield (ACTION_UPDATE, unique_rec, hub_recs[-1][HUB_TTL])
+
+
+@log_start_end
+def merge_match_dns_records(powerdns_records, hub_dns_records):
+    """
+    Same as match_dns_records, but streams over records ordered by rec_hash and
+    keeps only the records which need a fix. Returns (upd_map, del_set, powerdns_rec_dict),
+    powerdns_rec_dict holds report fields of the records from upd_map and del_set only.
+    """
+    upd_map = {}
+    del_set = set()
+    powerdns_rec_dict = {}
+    for (action, rec, new_ttl) in iter_merge_decisions(powerdns_records, hub_dns_records):
+        rec_id = rec[PDNS_REC_ID]
+        if action == ACTION_UPDATE:
+            upd_map[rec_id] = new_ttl
+        else:
+            del_set.add(rec_id)
+        powerdns_rec_dict[rec_id] = tuple(rec[1:8])
+    return (upd_map, del_set, powerdns_rec_dict)
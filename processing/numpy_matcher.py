@@ -0,0 +1,98 @@
+"""
+Matching of DNS records with NumPy (--matcher=numpy).
+
+Hashes of a chunk are put into arrays of 16-byte digests, duplicates are
+found with np.unique and records are looked up among Hub records with
+searchsorted/isin over sorted arrays, so the per-record work is done in C
+instead of Python dicts and sets. The results are the same as of
+processing.synchronizer.match_stored_dns_records.
+
+NumPy is optional, the matcher is only available when it is installed.
+"""
+from array import array
+
+from processing.record_store import NULL_INT, digest
+from utils.decorators import log_start_end
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# numpy strips trailing zero bytes of 'S' items, which does not make digests
+# of the same length equal; NULL hashes become empty items
+DIGEST_DTYPE = 'S16'
+# hashes of NULL read as text ('') match no NULL hash, as in the default matcher
+TEXT_NULL_ITEM = '\x01'
+
+
+def numpy_available():
+    return np is not None
+
+
+def _digest_array(digests):
+    return np.array([value if value else ('' if value is None else TEXT_NULL_ITEM)
+                     for value in digests], dtype=DIGEST_DTYPE)
+
+
+def index_hub_records_array(hub_dns_records):
+    """
+    Builds (hub_rec_hashes, hub_ttls, hub_ttl_hashes, number of records) in a single pass:
+    digests of rec_hash sorted with TTLs of the records in the same order and
+    sorted unique digests of ttl_hash.
+    """
+    # hub_dns_records: [
+    #   (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id),
+    # ]
+    rec_hashes = []
+    ttls = array('l')
+    ttl_hashes = []
+    for (_, _, ttl, rec_hash, ttl_hash, _) in hub_dns_records:
+        rec_hashes.append(digest(rec_hash))
+        ttls.append(ttl if ttl is not None else NULL_INT)
+        ttl_hashes.append(digest(ttl_hash))
+
+    hub_rec_hashes = _digest_array(rec_hashes)
+    # the stable sort keeps the last of records with the same rec_hash last, as a dict would
+    order = np.argsort(hub_rec_hashes, kind='mergesort')
+    hub_ttls = np.array(ttls, dtype=np.int64)
+    return (hub_rec_hashes[order], hub_ttls[order], np.unique(_digest_array(ttl_hashes)),
+            len(rec_hashes))
+
+
+@log_start_end
+def numpy_match_dns_records(record_store, hub_rec_hashes, hub_ttls, hub_ttl_hashes):
+    """
+    Same as match_stored_dns_records for a record store (see processing.record_store)
+    and a Hub index of index_hub_records_array.
+    """
+    if not len(record_store):
+        return ({}, set(), {})
+
+    rec_hashes = _digest_array(record_store.rec_hashes)
+    # indices of the first records with every rec_hash
+    unique_hashes, unique_rows = np.unique(rec_hashes, return_index=True)
+    duplicate = np.ones(len(rec_hashes), dtype=bool)
+    duplicate[unique_rows] = False
+
+    # the last Hub record with the same rec_hash
+    hub_pos = np.searchsorted(hub_rec_hashes, unique_hashes, side='right') - 1
+    found = hub_pos >= 0
+    found[found] = hub_rec_hashes[hub_pos[found]] == unique_hashes[found]
+
+    found_rows = unique_rows[found]
+    ttl_hashes = _digest_array(record_store.ttl_hashes)[found_rows]
+    outdated = ~np.isin(ttl_hashes, hub_ttl_hashes)
+    upd_rows = found_rows[outdated].tolist()
+    new_ttls = hub_ttls[hub_pos[found][outdated]].tolist()
+    del_rows = np.flatnonzero(duplicate).tolist() + unique_rows[~found].tolist()
+
+    ids = record_store.ids
+    upd_map = {ids[row]: (ttl if ttl != NULL_INT else None)
+               for (row, ttl) in zip(upd_rows, new_ttls)}
+    del_set = {ids[row] for row in del_rows}
+    powerdns_rec_dict = {}
+    if record_store.has_fields():
+        for row in upd_rows + del_rows:
+            powerdns_rec_dict[ids[row]] = record_store.report_fields(row)
+    return (upd_map, del_set, powerdns_rec_dict)
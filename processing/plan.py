@@ -0,0 +1,169 @@
+"""
+Fix plans (--plan-file, --apply-plan).
+
+A scan writes the fixes it would make to a plan file next to the report, so
+the report can be reviewed and the fixes applied later without a new scan.
+A plan is gzipped JSON lines: a header with the version, then an entry per
+chunk of a host with updates [rec_id, ttl, old_ttl] and deletions
+[rec_id, rec_hash]. Applying a plan changes only records which still hold
+the expected TTL or content, others are counted as stale.
+"""
+import functools
+import gzip
+import json
+import logging
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from db.hashing import md5_hex, record_hashes
+from db.mutators import apply_checked_fixes
+from db.references import PowerDnsSqlReference
+from utils.decorators import save_traceback
+from utils.metrics import metrics
+from utils.utils import split_to_sized_chunks, timestamp
+
+PLAN_VERSION = 1
+# bytes of values per statement, as for fixes made by a scan
+MAX_PLAN_PAYLOAD = 96 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _rec_hash(idn_host, rr_type, rec_data):
+    # checked deletions compare it with md5 computed by the host
+    return record_hashes(idn_host, rr_type, rec_data, None, md5_hex)[0]
+
+
+class FixPlanWriter(object):
+    """Plan file which is safe to share between worker threads"""
+    def __init__(self, path, report_path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._plan_file = gzip.open(path, 'wb')
+        self._write_line({
+            'version': PLAN_VERSION,
+            'created': timestamp(),
+            'report': report_path,
+        })
+
+    def _write_line(self, entry):
+        self._plan_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+    def add(self, host_id, upd_map, del_set, powerdns_rec_dict):
+        """powerdns_rec_dict holds report fields of records, see match_stored_dns_records"""
+        if not upd_map and not del_set:
+            return
+        entry = {
+            'host_id': host_id,
+            'update': [[rec_id, ttl, powerdns_rec_dict[rec_id][3]]
+                       for (rec_id, ttl) in sorted(upd_map.items())],
+            'delete': [[rec_id, _rec_hash(*powerdns_rec_dict[rec_id][:3])]
+                       for rec_id in sorted(del_set)],
+        }
+        with self._lock:
+            self._write_line(entry)
+
+    def get_plan_path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            self._plan_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return self
+
+
+def read_plan(path):
+    """Returns {host_id: ([(rec_id, ttl, old_ttl), ...], [(rec_id, rec_hash), ...])}"""
+    host_fixes = {}
+    plan_file = gzip.open(path, 'rb')
+    try:
+        header = json.loads(plan_file.readline() or '{}')
+        if header.get('version') != PLAN_VERSION:
+            raise Exception("Unsupported version of plan file {}: {}".format(
+                path, header.get('version')))
+        logger.info("Plan {} was created {}, report: {}".format(
+            path, header['created'], header['report']))
+        for line in plan_file:
+            entry = json.loads(line)
+            (upd_list, del_list) = host_fixes.setdefault(entry['host_id'], ([], []))
+            upd_list.extend(tuple(item) for item in entry['update'])
+            # JSON strings are unicode
+            del_list.extend((rec_id, str(rec_hash)) for (rec_id, rec_hash) in entry['delete'])
+    finally:
+        plan_file.close()
+    return host_fixes
+
+
+def apply_host_plan(host_id, upd_list, del_list, throttle=None):
+    """Returns the numbers of (updated, deleted) records"""
+    upd_chunks = split_to_sized_chunks(
+        upd_list, MAX_PLAN_PAYLOAD,
+        lambda item: len(PowerDnsSqlReference.checked_update_values_item(*item)) + 1)
+    del_chunks = split_to_sized_chunks(
+        del_list, MAX_PLAN_PAYLOAD,
+        lambda item: len(PowerDnsSqlReference.checked_delete_values_item(*item)) + 1)
+    if throttle is None:
+        return apply_checked_fixes(host_id, upd_chunks, del_chunks)
+
+    updated = deleted = 0
+    for upd_chunk in upd_chunks:
+        with throttle.write(host_id, len(upd_chunk)):
+            updated += apply_checked_fixes(host_id, [upd_chunk], [])[0]
+    for del_chunk in del_chunks:
+        with throttle.write(host_id, len(del_chunk)):
+            deleted += apply_checked_fixes(host_id, [], [del_chunk])[1]
+    return (updated, deleted)
+
+
+def _isolated_apply_host_plan(host_fixes, host_id, throttle):
+    (upd_list, del_list) = host_fixes[host_id]
+    try:
+        (updated, deleted) = apply_host_plan(host_id, upd_list, del_list, throttle)
+    except Exception:
+        save_traceback()
+        logger.error("Applying the plan to PowerDNS host #{} failed: {}".format(
+            host_id, sys.exc_info()[1]))
+        metrics.inc('failed_hosts', host=host_id)
+        return host_id
+
+    stale = len(upd_list) + len(del_list) - updated - deleted
+    metrics.inc('plan_updated', updated, host=host_id)
+    metrics.inc('plan_deleted', deleted, host=host_id)
+    metrics.inc('plan_stale', stale, host=host_id)
+    logger.info("Host #{}: updated {} of {} records, deleted {} of {} records".format(
+        host_id, updated, len(upd_list), deleted, len(del_list)))
+    if stale:
+        logger.warning("Host #{}: {} records have changed since the plan was made "
+                       "and were left as is".format(host_id, stale))
+    return None
+
+
+def apply_plan(path, parallel_hosts=1, throttle=None):
+    """Applies the plan file to its hosts, returns the list of hosts which failed"""
+    host_fixes = read_plan(path)
+    hosts = sorted(host_fixes)
+    apply_fn = functools.partial(_isolated_apply_host_plan, host_fixes, throttle=throttle)
+
+    if parallel_hosts > 1 and len(hosts) > 1:
+        pool = ThreadPool(min(parallel_hosts, len(hosts)))
+        try:
+            results = pool.map(apply_fn, hosts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [apply_fn(host_id) for host_id in hosts]
+
+    failed_hosts = [host_id for host_id in results if host_id is not None]
+    if failed_hosts:
+        logger.error("Applying the plan failed for PowerDNS hosts: {}".format(
+            ', '.join(map(str, failed_hosts))))
+    return failed_hosts
@@ -0,0 +1,110 @@
+"""
+Compact storage of PowerDNS records of a chunk for the default matcher.
+
+Records are kept in columns instead of a tuple per record: integers in arrays,
+md5 hashes as 16-byte digests instead of 32-char hex strings, repeated record
+types and domain names interned. Text fields are needed only for the report,
+so they are not kept at all without it.
+"""
+import binascii
+
+from array import array
+
+# ttl and prio are NULL in rows with broken data
+NULL_INT = -1
+
+
+def digest(hex_hash):
+    """32-char hex md5 -> 16-byte digest, None for NULL"""
+    return binascii.unhexlify(hex_hash) if hex_hash is not None else None
+
+
+def _int_or_null(value):
+    return value if value is not None else NULL_INT
+
+
+def _null_or_int(value):
+    return value if value != NULL_INT else None
+
+
+def match_rows(rec_hashes, ttl_hashes, hub_ttl_hashes, hub_rechash2ttl):
+    """
+    Returns (upd_rows, del_rows), indices of records which need a new TTL and
+    of records to be deleted. The first of records with the same rec_hash is kept,
+    the rest are duplicates.
+    """
+    unique_rows = {}  # rec_hash -> row
+    del_rows = []
+    for (row, rec_hash) in enumerate(rec_hashes):
+        if rec_hash in unique_rows:
+            del_rows.append(row)
+        else:
+            unique_rows[rec_hash] = row
+
+    upd_rows = []
+    for (rec_hash, row) in unique_rows.items():
+        if rec_hash not in hub_rechash2ttl:
+            del_rows.append(row)  # phantom record
+        elif ttl_hashes[row] not in hub_ttl_hashes:
+            upd_rows.append(row)
+    return (upd_rows, del_rows)
+
+
+class PowerDnsRecordStore(object):
+    __slots__ = ('ids', 'ttls', 'prios', 'domain_ids', 'rec_hashes', 'ttl_hashes',
+                 'idn_hosts', 'rr_types', 'rec_datas', 'domain_names')
+
+    def __init__(self, keep_fields=True):
+        self.ids = array('l')
+        self.ttls = array('l')
+        self.prios = array('l')
+        self.domain_ids = array('l')
+        self.rec_hashes = []
+        self.ttl_hashes = []
+        if keep_fields:
+            self.idn_hosts = []
+            self.rr_types = []
+            self.rec_datas = []
+            self.domain_names = []
+        else:
+            self.idn_hosts = self.rr_types = self.rec_datas = self.domain_names = None
+
+    @classmethod
+    def from_rows(cls, powerdns_records, keep_fields=True):
+        """
+        powerdns_records: [
+          (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
+           domain_name, rec_hash, ttl_hash),
+        ], rows are consumed one by one, so they can be streamed.
+        """
+        store = cls(keep_fields)
+        for row in powerdns_records:
+            store.append(row)
+        return store
+
+    def append(self, row):
+        (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
+         domain_name, rec_hash, ttl_hash) = row
+        self.ids.append(rec_id)
+        self.ttls.append(_int_or_null(ttl))
+        self.prios.append(_int_or_null(prio))
+        self.domain_ids.append(domain_id)
+        self.rec_hashes.append(digest(rec_hash))
+        self.ttl_hashes.append(digest(ttl_hash))
+        if self.idn_hosts is not None:
+            self.idn_hosts.append(idn_host)
+            self.rr_types.append(intern(rr_type))
+            self.rec_datas.append(rec_data)
+            self.domain_names.append(intern(domain_name))
+
+    def report_fields(self, row):
+        """(idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name) of the row"""
+        return (self.idn_hosts[row], self.rr_types[row], self.rec_datas[row],
+                _null_or_int(self.ttls[row]), _null_or_int(self.prios[row]),
+                self.domain_ids[row], self.domain_names[row])
+
+    def has_fields(self):
+        return self.idn_hosts is not None
+
+    def __len__(self):
+        return len(self.ids)
@@ -1,18 +1,35 @@
 import csv
+import os
+import threading
 
 
 class CsvReporter:
-    def __init__(self, path):
+    """
+    CSV writer which is safe to share between worker threads. With resume_position
+    an existing report is truncated to it and appended to (see processing.checkpoint).
+    """
+    def __init__(self, path, resume_position=None):
         self._path = path
-        self._csv_file = open(path, 'wb')
+        if resume_position is None:
+            self._csv_file = open(path, 'wb')
+        else:
+            self._csv_file = open(path, 'r+b')
+            self._csv_file.truncate(resume_position)
+            self._csv_file.seek(0, os.SEEK_END)
         self._field_names = []
         self._writer = csv.writer(self._csv_file)
+        self._lock = threading.RLock()
+        self._header_posted = bool(resume_position)
 
     def set_field_names(self, field_set):
         self._field_names = field_set
 
     def post_header(self):
-        self._writer.writerow(self._field_names)
+        """Writes the header once, so a report can be shared by several runs"""
+        with self._lock:
+            if not self._header_posted:
+                self._writer.writerow(self._field_names)
+                self._header_posted = True
 
     def post_row(self, values):
         values_len = len(values)
@@ -23,10 +40,23 @@ class CsvReporter:
                 " Expected {0} fields, passed {1} fields"
             raise Exception(exc_msg.format(header_len, values_len))
 
-        self._writer.writerow([unicode(s).encode("utf-8") for s in values])
+        row = [unicode(s).encode("utf-8") for s in values]
+        with self._lock:
+            self._writer.writerow(row)
+
+    def batch(self):
+        """Holds rows of other threads back while a batch of rows is posted"""
+        return self._lock
+
+    def position(self):
+        """The size of the report with all posted rows"""
+        with self._lock:
+            self._csv_file.flush()
+            return self._csv_file.tell()
 
     def close(self):
-        self._csv_file.close()
+        with self._lock:
+            self._csv_file.close()
 
     def get_report_path(self):
         return self._path
@@ -52,8 +82,8 @@ class PowerDnsSyncCsvReporter(CsvReporter):
     FLD_ERROR_TYPE = "Error"
     FLD_SUGGESTED_FIX = "Suggested Fix"
 
-    def __init__(self, path):
-        CsvReporter.__init__(self, path)
+    def __init__(self, path, resume_position=None):
+        CsvReporter.__init__(self, path, resume_position)
 
         # Order
         self.set_field_names([self.FLD_HOST_ID,
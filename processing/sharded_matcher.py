@@ -0,0 +1,176 @@
+"""
+Matching of DNS records of a chunk in several processes (--match-workers).
+
+Records are partitioned by the first byte of rec_hash. A shard holds all
+PowerDNS and Hub records with the same rec_hash, and also with the same
+ttl_hash, which hashes the same fields and the TTL. So every shard is matched
+on its own by the default rules (see processing.record_store.match_rows) in a
+pool of processes and the results are merged. Records are partitioned once by
+the calling thread, Hub records while they are indexed, and every worker gets
+only the digests of its shard joined into strings of 16-byte items, so they
+are pickled as a few strings instead of an object per record.
+
+Chunks of fewer than MIN_SHARDED_RECORDS records are matched by the default
+matcher in the calling thread, shipping them would cost more than it saves.
+"""
+import logging
+
+from array import array
+from itertools import izip
+from multiprocessing import Pool
+
+from processing.record_store import NULL_INT, digest, match_rows
+from utils.decorators import log_start_end
+
+DIGEST_SIZE = 16
+MIN_SHARDED_RECORDS = 50000
+
+logger = logging.getLogger(__name__)
+
+_match_pool = None
+_match_workers = 0
+
+
+def set_match_workers(workers):
+    """Matching is sharded between as many processes if workers > 0"""
+    global _match_pool, _match_workers
+    if _match_pool is not None:
+        _match_pool.close()
+        _match_pool = None
+    _match_workers = workers
+    if workers > 0:
+        _match_pool = Pool(workers)
+    logger.debug("Match workers: {}".format(workers))
+
+
+def sharding_enabled():
+    return _match_workers > 0
+
+
+def should_shard(record_store):
+    """Whether records of a record store (see processing.record_store) are matched in shards"""
+    return sharding_enabled() and len(record_store) >= MIN_SHARDED_RECORDS
+
+
+def _shard_of(rec_hash, shards):
+    # NULL hashes are in shard 0
+    return ord(rec_hash[0]) % shards if rec_hash else 0
+
+
+def _pack(digests):
+    """
+    Returns (a string of 16-byte digests, [(position, value), ...] of values which are
+    not digests), NULL hashes are None and hashes of NULL read as text are ''
+    """
+    if all(value is not None and len(value) == DIGEST_SIZE for value in digests):
+        return (''.join(digests), [])
+    irregular = [(pos, value) for (pos, value) in enumerate(digests)
+                 if value is None or len(value) != DIGEST_SIZE]
+    return (''.join(value if value is not None and len(value) == DIGEST_SIZE
+                    else '\0' * DIGEST_SIZE for value in digests), irregular)
+
+
+def _unpack(packed):
+    (joined, irregular) = packed
+    digests = [joined[pos:pos + DIGEST_SIZE] for pos in xrange(0, len(joined), DIGEST_SIZE)]
+    for (pos, value) in irregular:
+        digests[pos] = value
+    return digests
+
+
+def _from_string(packed):
+    values = array('l')
+    values.fromstring(packed)
+    return values
+
+
+def index_hub_records_sharded(hub_dns_records):
+    """
+    Builds ([(hub_rec_hashes, hub_ttls, hub_ttl_hashes) of every shard, packed],
+    whether any ttl_hash is NULL, number of records) in a single pass.
+    """
+    # hub_dns_records: [
+    #   (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id),
+    # ]
+    shards = max(_match_workers, 1)
+    rec_hashes = [[] for _ in xrange(shards)]
+    ttls = [array('l') for _ in xrange(shards)]
+    ttl_hashes = [[] for _ in xrange(shards)]
+    null_ttl_hash = False
+    count = 0
+    for (_, _, ttl, rec_hash, ttl_hash, _) in hub_dns_records:
+        rec_hash = digest(rec_hash)
+        shard = _shard_of(rec_hash, shards)
+        rec_hashes[shard].append(rec_hash)
+        ttls[shard].append(ttl if ttl is not None else NULL_INT)
+        ttl_hashes[shard].append(digest(ttl_hash))
+        null_ttl_hash = null_ttl_hash or ttl_hash is None
+        count += 1
+    hub_shards = [(_pack(rec_hashes[shard]), ttls[shard].tostring(), _pack(ttl_hashes[shard]))
+                  for shard in xrange(shards)]
+    # a record whose TTL is NULL matches a Hub record of any shard whose TTL is NULL
+    return (hub_shards, null_ttl_hash, count)
+
+
+def _match_shard(payload):
+    """
+    Runs in a worker on records of one shard.
+    Returns (upd_rows, new TTLs, del_rows) of the shard as array strings.
+    """
+    (rec_hashes, ttl_hashes, (hub_rec_hashes, hub_ttls, hub_ttl_hashes), null_ttl_hash) = payload
+    # the last of Hub records with the same rec_hash wins, as in index_hub_records
+    hub_rechash2ttl = dict(izip(_unpack(hub_rec_hashes), _from_string(hub_ttls)))
+    hub_ttl_hash_set = set(_unpack(hub_ttl_hashes))
+    if null_ttl_hash:
+        hub_ttl_hash_set.add(None)
+
+    rec_hashes = _unpack(rec_hashes)
+    upd_rows, del_rows = match_rows(
+        rec_hashes, _unpack(ttl_hashes), hub_ttl_hash_set, hub_rechash2ttl)
+    new_ttls = array('l', [hub_rechash2ttl[rec_hashes[row]] for row in upd_rows])
+    return (array('l', upd_rows).tostring(), new_ttls.tostring(),
+            array('l', del_rows).tostring())
+
+
+@log_start_end
+def sharded_match_dns_records(record_store, hub_shards, null_ttl_hash):
+    """
+    Same as match_stored_dns_records for a record store (see processing.record_store)
+    and a Hub index of index_hub_records_sharded.
+    """
+    shards = len(hub_shards)
+    shard_rows = [array('l') for _ in xrange(shards)]
+    shard_rec_hashes = [[] for _ in xrange(shards)]
+    shard_ttl_hashes = [[] for _ in xrange(shards)]
+    for (row, (rec_hash, ttl_hash)) in enumerate(
+            izip(record_store.rec_hashes, record_store.ttl_hashes)):
+        shard = _shard_of(rec_hash, shards)
+        shard_rows[shard].append(row)
+        shard_rec_hashes[shard].append(rec_hash)
+        shard_ttl_hashes[shard].append(ttl_hash)
+    payloads = [(_pack(shard_rec_hashes[shard]), _pack(shard_ttl_hashes[shard]),
+                 hub_shards[shard], null_ttl_hash) for shard in xrange(shards)]
+    del shard_rec_hashes, shard_ttl_hashes
+    if _match_pool is not None:
+        results = _match_pool.map(_match_shard, payloads)
+    else:
+        results = map(_match_shard, payloads)
+
+    ids = record_store.ids
+    upd_map = {}
+    del_set = set()
+    report_rows = []
+    for (rows, (upd_rows, new_ttls, del_rows)) in izip(shard_rows, results):
+        upd_rows = [rows[row] for row in _from_string(upd_rows)]
+        del_rows = [rows[row] for row in _from_string(del_rows)]
+        for (row, ttl) in izip(upd_rows, _from_string(new_ttls)):
+            upd_map[ids[row]] = ttl if ttl != NULL_INT else None
+        del_set.update(ids[row] for row in del_rows)
+        report_rows.extend(upd_rows)
+        report_rows.extend(del_rows)
+
+    powerdns_rec_dict = {}
+    if record_store.has_fields():
+        for row in report_rows:
+            powerdns_rec_dict[ids[row]] = record_store.report_fields(row)
+    return (upd_map, del_set, powerdns_rec_dict)
@@ -0,0 +1,383 @@
+"""
+Snapshots of DNS records (--export-snapshots, --diff-snapshots).
+
+A snapshot keeps the records of a PowerDNS host or of Hub in a single file:
+fixed-width records grouped by domain and sorted by rec_hash within a domain,
+an index of domains with the position of their records and a heap of text
+fields, which are read for reported records only. Snapshots are read through
+mmap and diffed domain by domain like by the merge matcher, so the memory of a
+diff does not grow with the number of records, reports and plans can be made
+offline again and again, and several processes can share a Hub snapshot.
+
+Digests of both snapshots of a diff have to be made by the same hash, see
+db.hashing.hash_name.
+"""
+import glob
+import json
+import logging
+import marshal
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from db.hashing import hash_name
+from db.selectors import (
+    fetch_hub_records_by_domain_ids,
+    fetch_powerdns_domains,
+    fetch_powerdns_records_by_domain_list,
+)
+from processing.chunking import DEFAULT_CHUNK_RECORDS, AdaptiveChunker, fetch_record_counts
+from processing.merge_matcher import ACTION_DELETE, PDNS_REC_ID, iter_merge_decisions
+from processing.record_store import NULL_INT, digest
+from processing.synchronizer import report_errors
+from utils.decorators import log_start_end, save_traceback
+from utils.utils import split_to_chunks, timestamp
+
+SNAPSHOT_MAGIC = 'PDNSSNAP'
+SNAPSHOT_VERSION = 2
+KIND_POWERDNS = 'powerdns'
+KIND_HUB = 'hub'
+HUB_SNAPSHOT_FILE = 'hub.snapshot'
+POWERDNS_SNAPSHOT_FILE = 'powerdns_{}.snapshot'
+# Hub has no record counts to size chunks by
+HUB_CHUNK_DOMAINS = 1000
+# digest field of NULL hashes, which are told apart by the flags of their record
+NULL_DIGEST = '\0' * 16
+# flags of a record: NULL hashes (None) are kept apart from hashes of NULL read as
+# text (''), as the matchers keep them apart; the flag of '' is the NULL flag << 1
+_REC_HASH_NULL = 1
+_TTL_HASH_NULL = 4
+
+# magic, version, then offset and size of the records, domains, heap and meta sections
+_HEADER = struct.Struct('<8sI4xQQQQQQQQ')
+# rec_hash, ttl_hash, rec_id, ttl, prio, heap offset and size of (idn_host, rr_type, rec_data),
+# flags
+_POWERDNS_RECORD = struct.Struct('<16s16sqqqQQB')
+# rec_hash, ttl_hash, ttl, flags
+_HUB_RECORD = struct.Struct('<16s16sqB')
+# domain_id, first record, number of records, heap offset and size of the name
+_DOMAIN = struct.Struct('<qQQQQ')
+
+logger = logging.getLogger(__name__)
+
+
+def _hash_field(rec_hash, null_flag):
+    """(digest field, flags) of a digest (see processing.record_store.digest)"""
+    if rec_hash is None:
+        return (NULL_DIGEST, null_flag)
+    if rec_hash == '':
+        return (NULL_DIGEST, null_flag << 1)
+    return (rec_hash, 0)
+
+
+def _hash_value(field, flags, null_flag):
+    if flags & null_flag:
+        return None
+    if flags & (null_flag << 1):
+        return ''
+    return field
+
+
+def _int_or_null(value):
+    return value if value is not None else NULL_INT
+
+
+def _null_or_int(value):
+    return value if value != NULL_INT else None
+
+
+class SnapshotWriter(object):
+    """
+    Writes a snapshot domain by domain, sections are kept in temporary files
+    and joined on close, the snapshot appears at path only when it is complete.
+    """
+    def __init__(self, path, kind, **meta):
+        self._path = path
+        self._record = _POWERDNS_RECORD if kind == KIND_POWERDNS else _HUB_RECORD
+        self._meta = dict(meta, kind=kind, created=timestamp(), hash=hash_name())
+        self._records = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self._domains = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self._heap = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self._records_count = 0
+        self._domains_count = 0
+        self._heap_size = 0
+
+    def _add_text(self, text):
+        offset = self._heap_size
+        self._heap.write(text)
+        self._heap_size += len(text)
+        return (offset, len(text))
+
+    def _add_domain(self, domain_id, domain_name, records_count):
+        name_offset, name_size = self._add_text(domain_name)
+        self._domains.write(_DOMAIN.pack(
+            domain_id, self._records_count, records_count, name_offset, name_size))
+        self._domains_count += 1
+        self._records_count += records_count
+
+    def add_powerdns_domain(self, domain_id, domain_name, powerdns_records):
+        """
+        powerdns_records: [
+          (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
+           domain_name, rec_hash, ttl_hash),
+        ] of the domain
+        """
+        # records with the same rec_hash are ordered by rec_id descending, as by the merge matcher
+        rows = sorted(((digest(rec[8]), -rec[0], rec) for rec in powerdns_records))
+        for (rec_hash, _, rec) in rows:
+            (rec_id, idn_host, rr_type, rec_data, ttl, prio) = rec[:6]
+            text_offset, text_size = self._add_text(marshal.dumps((idn_host, rr_type, rec_data)))
+            rec_hash, rec_hash_flags = _hash_field(rec_hash, _REC_HASH_NULL)
+            ttl_hash, ttl_hash_flags = _hash_field(digest(rec[9]), _TTL_HASH_NULL)
+            self._records.write(_POWERDNS_RECORD.pack(
+                rec_hash, ttl_hash, rec_id, _int_or_null(ttl), _int_or_null(prio),
+                text_offset, text_size, rec_hash_flags | ttl_hash_flags))
+        self._add_domain(domain_id, domain_name, len(rows))
+
+    def add_hub_domain(self, domain_id, domain_name, hub_dns_records):
+        """
+        hub_dns_records: [
+          (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id),
+        ] of the domain
+        """
+        # the sort is stable, so the last of records with the same rec_hash stays last
+        rows = sorted(((digest(rec[3]), digest(rec[4]), rec[2]) for rec in hub_dns_records),
+                      key=lambda row: row[0])
+        for (rec_hash, ttl_hash, ttl) in rows:
+            rec_hash, rec_hash_flags = _hash_field(rec_hash, _REC_HASH_NULL)
+            ttl_hash, ttl_hash_flags = _hash_field(ttl_hash, _TTL_HASH_NULL)
+            self._records.write(_HUB_RECORD.pack(
+                rec_hash, ttl_hash, _int_or_null(ttl), rec_hash_flags | ttl_hash_flags))
+        self._add_domain(domain_id, domain_name, len(rows))
+
+    def close(self):
+        meta = json.dumps(dict(self._meta, records=self._records_count,
+                               domains=self._domains_count))
+        sections = [(self._records, self._records_count * self._record.size),
+                    (self._domains, self._domains_count * _DOMAIN.size),
+                    (self._heap, self._heap_size)]
+        header = [SNAPSHOT_MAGIC, SNAPSHOT_VERSION]
+        offset = _HEADER.size
+        for (_, size) in sections:
+            header.extend((offset, size))
+            offset += size
+        header.extend((offset, len(meta)))
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._path)))
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            snapshot_file.write(_HEADER.pack(*header))
+            for (section, _) in sections:
+                section.seek(0)
+                shutil.copyfileobj(section, snapshot_file)
+                section.close()
+            snapshot_file.write(meta)
+        os.rename(tmp_path, self._path)
+        logger.info("Snapshot {} holds {} records of {} domains".format(
+            self._path, self._records_count, self._domains_count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for section in (self._records, self._domains, self._heap):
+                section.close()
+
+
+class Snapshot(object):
+    """A snapshot file mapped into memory"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _HEADER.unpack_from(self._map, 0)
+        if header[0] != SNAPSHOT_MAGIC or header[1] != SNAPSHOT_VERSION:
+            self._map.close()
+            raise Exception("Unsupported snapshot file {}".format(path))
+        (self._records_offset, _, self._domains_offset, _,
+         self._heap_offset, _, meta_offset, meta_size) = header[2:]
+        self.meta = json.loads(self._map[meta_offset:meta_offset + meta_size])
+        self.kind = self.meta['kind']
+        self._record = _POWERDNS_RECORD if self.kind == KIND_POWERDNS else _HUB_RECORD
+
+    def _text(self, offset, size):
+        return self._map[self._heap_offset + offset:self._heap_offset + offset + size]
+
+    def domains(self):
+        """Yields (domain_id, domain_name, first record, number of records)"""
+        for pos in xrange(self.meta['domains']):
+            (domain_id, first, count, name_offset, name_size) = _DOMAIN.unpack_from(
+                self._map, self._domains_offset + pos * _DOMAIN.size)
+            yield (domain_id, self._text(name_offset, name_size), first, count)
+
+    def _unpack_records(self, first, count):
+        size = self._record.size
+        offset = self._records_offset + first * size
+        for pos in xrange(offset, offset + count * size, size):
+            yield self._record.unpack_from(self._map, pos)
+
+    def powerdns_records(self, first, count):
+        """
+        Yields records in the shape which the merge matcher reads: rec_id, the position
+        of the record in the snapshot in place of idn_host (see report_fields), rec_hash and
+        ttl_hash, other fields are not read from the snapshot.
+        """
+        for (row, rec) in enumerate(self._unpack_records(first, count), first):
+            flags = rec[7]
+            yield (rec[2], row, None, None, None, None, None, None,
+                   _hash_value(rec[0], flags, _REC_HASH_NULL),
+                   _hash_value(rec[1], flags, _TTL_HASH_NULL))
+
+    def hub_records(self, first, count):
+        """Yields records in the shape which the merge matcher reads: ttl, rec_hash and ttl_hash"""
+        for (rec_hash, ttl_hash, ttl, flags) in self._unpack_records(first, count):
+            yield (None, None, _null_or_int(ttl), _hash_value(rec_hash, flags, _REC_HASH_NULL),
+                   _hash_value(ttl_hash, flags, _TTL_HASH_NULL), None)
+
+    def report_fields(self, row, domain_id, domain_name):
+        """(idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name) of a PowerDNS record"""
+        (_, _, _, ttl, prio, text_offset, text_size, _) = _POWERDNS_RECORD.unpack_from(
+            self._map, self._records_offset + row * _POWERDNS_RECORD.size)
+        (idn_host, rr_type, rec_data) = marshal.loads(self._text(text_offset, text_size))
+        return (idn_host, rr_type, rec_data, _null_or_int(ttl), _null_or_int(prio),
+                domain_id, domain_name)
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@log_start_end
+def export_powerdns_snapshot(host_id, path, sync_domains=None, exclude_domains=None,
+                             chunk_records=DEFAULT_CHUNK_RECORDS):
+    """Records of a chunk of domains are kept in memory until they are written"""
+    pdns_domains = fetch_powerdns_domains(host_id, sync_domains, exclude_domains)
+    chunker = AdaptiveChunker(
+        fetch_record_counts(host_id, pdns_domains, sync_domains is None), chunk_records)
+    with SnapshotWriter(path, KIND_POWERDNS, host_id=host_id) as writer:
+        for domain_chunk in chunker.split(pdns_domains):
+            started = time.time()
+            domain_records = {}
+            for rec in fetch_powerdns_records_by_domain_list(
+                    host_id, [domain_id for (domain_id, _) in domain_chunk], stream=True):
+                domain_records.setdefault(rec[6], []).append(rec)
+            chunker.observe(sum(len(recs) for recs in domain_records.values()),
+                            time.time() - started)
+            for (domain_id, domain_name) in domain_chunk:
+                writer.add_powerdns_domain(
+                    domain_id, domain_name, domain_records.get(domain_id, []))
+
+
+@log_start_end
+def export_hub_snapshot(db_conn, path, hub_domain_index):
+    """Records of all domains of hub_domain_index (see db.hub_domains.HubDomainIndex)"""
+    hub_domains = sorted((domain_id, name) for (name, domain_id) in hub_domain_index.items())
+    with SnapshotWriter(path, KIND_HUB) as writer:
+        for domain_chunk in split_to_chunks(hub_domains, HUB_CHUNK_DOMAINS):
+            domain_records = {}
+            for rec in fetch_hub_records_by_domain_ids(
+                    db_conn, [domain_id for (domain_id, _) in domain_chunk], stream=True):
+                domain_records.setdefault(rec[5], []).append(rec)
+            for (domain_id, domain_name) in domain_chunk:
+                writer.add_hub_domain(domain_id, domain_name, domain_records.get(domain_id, []))
+
+
+def diff_snapshots(powerdns_snapshot, hub_snapshot):
+    """
+    Yields (domain_name, upd_map, del_set, powerdns_rec_dict) of domains of the PowerDNS
+    snapshot which are found in the Hub snapshot, powerdns_rec_dict holds report fields
+    of the records from upd_map and del_set only. Only the index of Hub domains is
+    kept in memory.
+    """
+    if powerdns_snapshot.meta['hash'] != hub_snapshot.meta['hash']:
+        raise Exception("Snapshots {} and {} are hashed by {} and {}".format(
+            powerdns_snapshot.path, hub_snapshot.path,
+            powerdns_snapshot.meta['hash'], hub_snapshot.meta['hash']))
+    hub_domains = {domain_name: (first, count)
+                   for (_, domain_name, first, count) in hub_snapshot.domains()}
+
+    missing = 0
+    for (domain_id, domain_name, first, count) in powerdns_snapshot.domains():
+        if domain_name not in hub_domains:
+            missing += 1
+            continue
+        upd_map = {}
+        del_set = set()
+        powerdns_rec_dict = {}
+        for (action, rec, new_ttl) in iter_merge_decisions(
+                powerdns_snapshot.powerdns_records(first, count),
+                hub_snapshot.hub_records(*hub_domains[domain_name])):
+            rec_id = rec[PDNS_REC_ID]
+            if action == ACTION_DELETE:
+                del_set.add(rec_id)
+            else:
+                upd_map[rec_id] = new_ttl
+            powerdns_rec_dict[rec_id] = powerdns_snapshot.report_fields(
+                rec[1], domain_id, domain_name)
+        yield (domain_name, upd_map, del_set, powerdns_rec_dict)
+
+    if missing:
+        logger.warning("{} domains of {} are not found in {}, they are skipped".format(
+            missing, powerdns_snapshot.path, hub_snapshot.path))
+
+
+def powerdns_snapshot_paths(directory):
+    """Paths of PowerDNS snapshots in the directory in the order of host IDs"""
+    paths = glob.glob(os.path.join(directory, POWERDNS_SNAPSHOT_FILE.format('*')))
+    return sorted(paths, key=lambda path: int(re.search(r'\d+', os.path.basename(path)).group()))
+
+
+def export_snapshots(db_conn, directory, hosts, sync_domains, exclude_domains,
+                     hub_domain_index=None, chunk_records=DEFAULT_CHUNK_RECORDS):
+    """
+    Exports snapshots of the hosts and, if hub_domain_index is given, of Hub
+    into the directory. Returns the list of hosts which failed.
+    """
+    if hub_domain_index is not None:
+        export_hub_snapshot(db_conn, os.path.join(directory, HUB_SNAPSHOT_FILE), hub_domain_index)
+
+    failed_hosts = []
+    for host_id in hosts:
+        try:
+            export_powerdns_snapshot(
+                host_id, os.path.join(directory, POWERDNS_SNAPSHOT_FILE.format(host_id)),
+                sync_domains, exclude_domains, chunk_records)
+        except Exception:
+            save_traceback()
+            logger.error("Snapshot of PowerDNS host #{} failed: {}".format(
+                host_id, sys.exc_info()[1]))
+            failed_hosts.append(host_id)
+    return failed_hosts
+
+
+def report_snapshot_diffs(powerdns_paths, hub_path, csv_reporter, plan=None):
+    """
+    Reports differences of PowerDNS snapshots from the Hub snapshot and writes
+    their fixes to plan (see processing.plan.FixPlanWriter) if given.
+    """
+    csv_reporter.post_header()
+    with Snapshot(hub_path) as hub_snapshot:
+        for path in powerdns_paths:
+            with Snapshot(path) as powerdns_snapshot:
+                host_id = powerdns_snapshot.meta['host_id']
+                logger.info("Diffing snapshot of PowerDNS host #{} taken {} with {} taken {}"
+                            .format(host_id, powerdns_snapshot.meta['created'],
+                                    hub_path, hub_snapshot.meta['created']))
+                for (_, upd_map, del_set, powerdns_rec_dict) in diff_snapshots(
+                        powerdns_snapshot, hub_snapshot):
+                    with csv_reporter.batch():
+                        report_errors(csv_reporter, host_id, upd_map, del_set, powerdns_rec_dict)
+                    if plan is not None:
+                        plan.add(host_id, upd_map, del_set, powerdns_rec_dict)
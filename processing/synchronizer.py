@@ -1,91 +1,137 @@
+import functools
 import logging
+import sys
+import time
 
-from itertools import groupby
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 
-from db.mutators import delete_duplicates, update_ttl
+from db.core import hub_transaction_failed
+from db.mutators import delete_duplicates, update_ttl, update_ttl_and_delete_duplicates
+from db.references import PowerDnsSqlReference
 from db.selectors import (
+    fetch_hub_domain_digests,
     fetch_hub_records_by_domain_list,
+    fetch_powerdns_domain_digests,
     fetch_powerdns_domains,
     fetch_powerdns_records_by_domain_list,
-    get_powerdns_report_dict,
 )
 
-from utils.utils import flatten_list, split_to_chunks
-from utils.decorators import log_start_end
+from processing.chunking import (
+    DEFAULT_CHUNK_RECORDS,
+    DEFAULT_CHUNK_SECONDS,
+    AdaptiveChunker,
+    fetch_record_counts,
+)
+from processing.consensus import members_of, plan_consensus
+from processing.merge_matcher import HUB_REC_HASH, merge_match_dns_records
+from processing.numpy_matcher import index_hub_records_array, numpy_match_dns_records
+from processing.record_store import PowerDnsRecordStore, digest, match_rows
+from processing.sharded_matcher import (
+    index_hub_records_sharded,
+    sharded_match_dns_records,
+    should_shard,
+)
+
+from utils.pipeline import prefetch
+from utils.utils import flatten_list, split_to_chunks, split_to_sized_chunks
+from utils.decorators import log_start_end, save_traceback
+from utils.metrics import metrics
 
 
-DOMAINS_CHUNK_SIZE = 2000
-MAX_UPD_SIZE = 650
-MAX_DEL_SIZE = 3500
+# bytes of ids/values per statement, statements are sent to a host in scripts
+# of up to db.session.MAX_SCRIPT_SIZE
+MAX_UPD_PAYLOAD = 96 * 1024
+MAX_DEL_PAYLOAD = 96 * 1024
+
+MATCHER_DEFAULT = 'default'
+MATCHER_MERGE = 'merge'
+MATCHER_NUMPY = 'numpy'
+MATCHERS = (MATCHER_DEFAULT, MATCHER_MERGE, MATCHER_NUMPY)
 
 logger = logging.getLogger(__name__)
 
 
-def group_powerdns_recs_by_record_hash(powerdns_records):
+def index_hub_records(hub_dns_records):
     """
-    [(rec_id, ..., rec_hash,...), ...] -> {rec_hash: [(rec_id,...),], ...}
+    Builds (hub_ttl_hashes, hub_rechash2ttl, number of records) in a single pass,
+    so Hub records can be streamed without keeping them. Hashes are digests
+    (see processing.record_store).
     """
-    sorted_by_rec_hash = sorted(powerdns_records, key=lambda row: row[8])
-    return {
-        rec_hash: list(recs)
-        for rec_hash, recs in groupby(sorted_by_rec_hash, key=lambda row: row[8])
-    }
-
-
-# @measure_worktime
-@log_start_end
-def match_dns_records(powerdns_records, hub_dns_records):
     # hub_dns_records: [
-    #   (rr_type, rec_data, ttl, rec_hash, ttl_hash),
+    #   (rr_type, rec_data, ttl, rec_hash, ttl_hash, domain_id),
     # ]
-    hub_ttl_hashes = {ttl_hash for (_, _, _, _, ttl_hash) in hub_dns_records}
-    hub_rechash2ttl = {rec_hash: ttl for (_, _, ttl, rec_hash, _) in hub_dns_records}
-
-    # powerdns_records: [
-    #   (rec_id, idn_host, rr_type, rec_data, ttl, prio, domain_id,
-    #    domain_name, rec_hash, ttl_hash),
-    # ]
-    pdns_rec_hash_grps = group_powerdns_recs_by_record_hash(powerdns_records)
-    unique_pdns_recs = {rec_hash: recs[0] for rec_hash, recs in pdns_rec_hash_grps.items()}
-    duplicate_pdns_recs = flatten_list([recs[1:] for _, recs in pdns_rec_hash_grps.items()])
-
-    duplicate_ids = {row[0] for row in duplicate_pdns_recs}
+    hub_ttl_hashes = set()
+    hub_rechash2ttl = {}
+    count = 0
+    for (_, _, ttl, rec_hash, ttl_hash, _) in hub_dns_records:
+        hub_ttl_hashes.add(digest(ttl_hash))
+        hub_rechash2ttl[digest(rec_hash)] = ttl
+        count += 1
+    return (hub_ttl_hashes, hub_rechash2ttl, count)
 
-    pdns_rec_hashes = set(unique_pdns_recs.keys())
-    phantom_recs = pdns_rec_hashes.difference(hub_rechash2ttl.keys())
-    matching_recs = pdns_rec_hashes.intersection(hub_rechash2ttl.keys())
-
-    del_set = {
-        rec_id
-        for rec_hash, (rec_id, _, _, _, _, _, _, _, _, _) in unique_pdns_recs.items()
-        if rec_hash in phantom_recs
-    }.union(duplicate_ids)
-
-    upd_map = {
-        rec_id: hub_rechash2ttl[rec_hash]  # relevant TTL value
-        for rec_hash, (rec_id, _, _, _, _, _, _, _, _, ttl_hash) in unique_pdns_recs.items()
-        if (ttl_hash not in hub_ttl_hashes) and (rec_hash in matching_recs)
-    }
 
+def match_dns_records(powerdns_records, hub_dns_records):
+    """Records are matched in shards if it is enabled, see processing.sharded_matcher"""
+    record_store = PowerDnsRecordStore.from_rows(powerdns_records, keep_fields=False)
+    if should_shard(record_store):
+        upd_map, del_set, _ = sharded_match_dns_records(
+            record_store, *index_hub_records_sharded(hub_dns_records)[:-1])
+    else:
+        upd_map, del_set, _ = match_stored_dns_records(
+            record_store, *index_hub_records(hub_dns_records)[:-1])
     return (upd_map, del_set)
 
 
-def fix_records(host_id, upd_map, del_set):
-    if len(upd_map) or len(del_set):
-        logger.info("Fixing a difference on PowerDNS host #{}".format(host_id))
+@log_start_end
+def match_stored_dns_records(record_store, hub_ttl_hashes, hub_rechash2ttl):
+    """
+    Returns (upd_map, del_set, powerdns_rec_dict), powerdns_rec_dict holds report
+    fields of the records from upd_map and del_set if record_store keeps them.
+    """
+    upd_rows, del_rows = match_rows(
+        record_store.rec_hashes, record_store.ttl_hashes, hub_ttl_hashes, hub_rechash2ttl)
 
-    if len(upd_map):
-        upd_chunks = split_to_chunks(upd_map.items(), MAX_UPD_SIZE, lambda x: dict(x))
-        for chunck in upd_chunks:
-            update_ttl(host_id, chunck)
+    ids = record_store.ids
+    upd_map = {ids[row]: hub_rechash2ttl[record_store.rec_hashes[row]] for row in upd_rows}
+    del_set = {ids[row] for row in del_rows}
+    powerdns_rec_dict = {}
+    if record_store.has_fields():
+        for row in upd_rows + del_rows:
+            powerdns_rec_dict[ids[row]] = record_store.report_fields(row)
+    return (upd_map, del_set, powerdns_rec_dict)
 
-    if len(del_set):
-        del_chunks = split_to_chunks(list(del_set), MAX_DEL_SIZE)
-        for chunck in del_chunks:
-            delete_duplicates(host_id, chunck)
+
+def fix_records(host_id, upd_map, del_set, throttle=None):
+    """
+    Without throttle all statements are sent at once, with it (see
+    processing.throttle.WriteThrottle) they are sent one by one at its pace.
+    """
+    if not len(upd_map) and not len(del_set):
+        return
+
+    logger.info("Fixing a difference on PowerDNS host #{}".format(host_id))
+    upd_chunks = split_to_sized_chunks(
+        upd_map.items(), MAX_UPD_PAYLOAD,
+        lambda item: len(PowerDnsSqlReference.update_values_item(*item)) + 1)
+    del_chunks = split_to_sized_chunks(
+        list(del_set), MAX_DEL_PAYLOAD, lambda rec_id: len(str(rec_id)) + 1)
+    if throttle is None:
+        update_ttl_and_delete_duplicates(host_id, [dict(x) for x in upd_chunks], del_chunks)
+        return
+
+    statement_rows = throttle.statement_rows()
+    if statement_rows:
+        upd_chunks = flatten_list(split_to_chunks(x, statement_rows) for x in upd_chunks)
+        del_chunks = flatten_list(split_to_chunks(x, statement_rows) for x in del_chunks)
+    for upd_chunk in upd_chunks:
+        with throttle.write(host_id, len(upd_chunk)):
+            update_ttl(host_id, dict(upd_chunk))
+    for del_chunk in del_chunks:
+        with throttle.write(host_id, len(del_chunk)):
+            delete_duplicates(host_id, del_chunk)
 
 
-# @measure_worktime
 def report_errors(csv_reporter, host_id, upd_map, del_set, powerdns_rec_dict):
     for (rec_id, new_ttl) in upd_map.items():
         (idn_host,
@@ -123,46 +169,359 @@ def report_errors(csv_reporter, host_id, upd_map, del_set, powerdns_rec_dict):
         )
 
 
+def filter_unsynced_domains(db_conn, host_id, domain_chunk, hub_domain_index=None):
+    """
+    [(domain_id, domain_name), ...] -> [(domain_id, domain_name), ...]
+    Leaves only domains whose digests of DNS records differ between PowerDNS and Hub,
+    records of the rest are known to be in sync and are not fetched.
+    """
+    domain_ids, domain_names = zip(*domain_chunk)
+    pdns_digests = fetch_powerdns_domain_digests(host_id, domain_ids)
+    hub_digests = fetch_hub_domain_digests(db_conn, domain_names, hub_domain_index)
+    return [
+        (domain_id, domain_name)
+        for (domain_id, domain_name) in domain_chunk
+        if pdns_digests.get(domain_id) != hub_digests.get(domain_name)
+    ]
+
+
+class _Chunk(object):
+    """A chunk of domains of a host on its way through fetch, match and report/fix stages"""
+    __slots__ = ('chunk_no', 'size', 'last_domain_id', 'domain_names',
+                 'powerdns_records', 'hub_requested', 'hub_dns_records', 'hub_index',
+                 'upd_map', 'del_set', 'powerdns_rec_dict')
+
+    def __init__(self, chunk_no, size, last_domain_id):
+        self.chunk_no = chunk_no
+        self.size = size
+        self.last_domain_id = last_domain_id
+        self.domain_names = ()
+        self.powerdns_records = []
+        self.hub_requested = False
+        self.hub_dns_records = []
+        self.hub_index = None
+        self.upd_map = {}
+        self.del_set = set()
+        self.powerdns_rec_dict = {}
+
+    def inconsistent_domains(self):
+        if not self.upd_map and not self.del_set:
+            return set()
+        if not self.powerdns_rec_dict:
+            return set(self.domain_names)
+        # (idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name)
+        return {self.powerdns_rec_dict[rec_id][6]
+                for rec_id in self.del_set.union(self.upd_map.keys())}
+
+
+def _fetch_chunks(db_conn, host_id, pdns_domains, chunker,
+                  hub_cache, hub_domain_index, digest_precheck, matcher, keep_rec_dict):
+    for (chunk_no, domain_chunk) in enumerate(chunker.split(pdns_domains)):
+        chunk = _Chunk(chunk_no, len(domain_chunk), domain_chunk[-1][0])
+        metrics.inc('domains', chunk.size, host=host_id)
+        if digest_precheck:
+            with metrics.stage('precheck', host_id, chunk_no):
+                domain_chunk = filter_unsynced_domains(
+                    db_conn, host_id, domain_chunk, hub_domain_index)
+            metrics.inc('domains_unsynced', len(domain_chunk), host=host_id)
+            logger.info("Host #{}: {} of {} domains differ from Hub".format(
+                host_id, len(domain_chunk), chunk.size))
+            if not domain_chunk:
+                yield chunk
+                continue
+
+        started = time.time()
+        domain_ids, chunk.domain_names = zip(*domain_chunk)
+        estimated_records = sum(chunker.estimate(domain_id) for domain_id in domain_ids)
+        logger.info(
+            "Synchronizing DNS records of next {} domains between Server and PowerDNS host #{}"
+            .format(len(chunk.domain_names), host_id)
+        )
+        with metrics.stage('remote_fetch', host_id, chunk_no):
+            chunk.powerdns_records = fetch_powerdns_records_by_domain_list(
+                host_id, domain_ids, order_by_rec_hash=(matcher == MATCHER_MERGE), stream=True)
+        # the merge matcher needs a single pass, so records are parsed while matched
+        if matcher != MATCHER_MERGE:
+            with metrics.stage('parse', host_id, chunk_no):
+                chunk.powerdns_records = PowerDnsRecordStore.from_rows(
+                    chunk.powerdns_records, keep_fields=keep_rec_dict)
+            metrics.inc('powerdns_records', len(chunk.powerdns_records), host=host_id)
+
+        # Hub records are streamed, the default matcher keeps only their index
+        with metrics.stage('hub_fetch', host_id, chunk_no):
+            chunk.hub_requested, hub_dns_records = fetch_hub_records_by_domain_list(
+                db_conn, chunk.domain_names, hub_cache, stream=True,
+                domain_index=hub_domain_index)
+            if matcher == MATCHER_MERGE:
+                chunk.hub_dns_records = list(hub_dns_records)
+                hub_records_count = len(chunk.hub_dns_records)
+            elif matcher == MATCHER_NUMPY:
+                chunk.hub_index = index_hub_records_array(hub_dns_records)
+                hub_records_count = chunk.hub_index[-1]
+            elif should_shard(chunk.powerdns_records):
+                chunk.hub_index = index_hub_records_sharded(hub_dns_records)
+                hub_records_count = chunk.hub_index[-1]
+            else:
+                chunk.hub_index = index_hub_records(hub_dns_records)
+                hub_records_count = chunk.hub_index[-1]
+        metrics.inc('hub_records', hub_records_count, host=host_id)
+        chunker.observe(estimated_records, time.time() - started)
+        yield chunk
+
+
+def _match_chunks(host_id, fetched_chunks, matcher):
+    for chunk in fetched_chunks:
+        if chunk.hub_requested:
+            with metrics.stage('match', host_id, chunk.chunk_no):
+                if matcher == MATCHER_MERGE:
+                    chunk.upd_map, chunk.del_set, chunk.powerdns_rec_dict = \
+                        merge_match_dns_records(
+                            chunk.powerdns_records,
+                            sorted(chunk.hub_dns_records, key=itemgetter(HUB_REC_HASH)))
+                elif matcher == MATCHER_NUMPY:
+                    chunk.upd_map, chunk.del_set, chunk.powerdns_rec_dict = \
+                        numpy_match_dns_records(chunk.powerdns_records, *chunk.hub_index[:-1])
+                elif should_shard(chunk.powerdns_records):
+                    chunk.upd_map, chunk.del_set, chunk.powerdns_rec_dict = \
+                        sharded_match_dns_records(chunk.powerdns_records, *chunk.hub_index[:-1])
+                else:
+                    chunk.upd_map, chunk.del_set, chunk.powerdns_rec_dict = \
+                        match_stored_dns_records(chunk.powerdns_records, *chunk.hub_index[:-1])
+            metrics.inc('outdated_ttl', len(chunk.upd_map), host=host_id)
+            metrics.inc('redundant_records', len(chunk.del_set), host=host_id)
+
+        # matched records are not needed anymore
+        chunk.powerdns_records = chunk.hub_dns_records = chunk.hub_index = None
+        yield chunk
+
+
+def synchronize_host(
+    db_conn, csv_reporter, host_id,
+    sync_domains, exclude_domains,
+    skip_error_report, fix_errors,
+    hub_cache=None, digest_precheck=False, pipeline_depth=0, matcher=MATCHER_DEFAULT,
+    sync_state=None, checkpoint=None, throttle=None, plan=None,
+    chunk_records=DEFAULT_CHUNK_RECORDS, chunk_seconds=DEFAULT_CHUNK_SECONDS,
+    hub_domain_index=None, pdns_domains=None, fanout=None,
+):
+    """
+    Chunks of domains go through fetch, match and fix/report stages. With
+    pipeline_depth > 0 every stage runs in its own thread and keeps at most
+    pipeline_depth chunks queued, so remote I/O overlaps with matching and fixing.
+    Inconsistent domains are flagged in sync_state (see processing.incremental) if given.
+    Processed chunks are recorded in checkpoint (see processing.checkpoint) if given,
+    and domains recorded there are skipped. Fixes are paced by throttle if given
+    and written to plan (see processing.plan.FixPlanWriter) if given.
+    Chunks are sized by records of domains, see processing.chunking.AdaptiveChunker
+    for chunk_records and chunk_seconds.
+    pdns_domains ([(domain_id, domain_name), ...]) are fetched from the host if not given.
+    Results for domains of fanout ({domain_id: [host_id, ...]}, see processing.consensus)
+    are also fixed and reported for the other hosts.
+    """
+    # excluded domains are few, they are counted with the rest in a single pass
+    all_domains = pdns_domains is None and sync_domains is None
+    if pdns_domains is None:
+        pdns_domains = fetch_powerdns_domains(host_id, sync_domains, exclude_domains)
+    processed_count = 0
+    if checkpoint is not None:
+        processed_count, last_domain_id = checkpoint.host_progress(host_id)
+        if last_domain_id is not None:
+            pdns_domains = [domain for domain in pdns_domains if domain[0] > last_domain_id]
+            logger.info("Host #{}: resuming after {} processed domains".format(
+                host_id, processed_count))
+    if not pdns_domains:
+        return
+
+    with metrics.stage('count', host_id):
+        chunker = AdaptiveChunker(
+            fetch_record_counts(host_id, pdns_domains, all_domains), chunk_records, chunk_seconds)
+
+    fetched_chunks = prefetch(
+        _fetch_chunks(db_conn, host_id, pdns_domains, chunker,
+                      hub_cache, hub_domain_index, digest_precheck, matcher,
+                      not skip_error_report or plan is not None or bool(fanout)),
+        pipeline_depth, name="fetch-{}".format(host_id))
+    matched_chunks = prefetch(
+        _match_chunks(host_id, fetched_chunks, matcher),
+        pipeline_depth, name="match-{}".format(host_id))
+
+    domains_count = processed_count + len(pdns_domains)
+    for chunk in matched_chunks:
+        # [(host_id, upd_map, del_set), ...]
+        targets = [(host_id, chunk.upd_map, chunk.del_set)]
+        if fanout:
+            targets.extend(_fan_out(chunk, fanout))
+
+        if fix_errors:
+            with metrics.stage('fix', host_id, chunk.chunk_no):
+                for (target_id, upd_map, del_set) in targets:
+                    fix_records(target_id, upd_map, del_set, throttle)
+
+        if sync_state is not None:
+            sync_state.flag_domains(chunk.inconsistent_domains())
+
+        processed_count += chunk.size
+        # rows of a chunk and its checkpoint go together, so a resumed run
+        # neither loses nor repeats rows
+        with csv_reporter.batch():
+            if not skip_error_report:
+                with metrics.stage('report', host_id, chunk.chunk_no):
+                    for (target_id, upd_map, del_set) in targets:
+                        report_errors(csv_reporter, target_id,
+                                      upd_map, del_set, chunk.powerdns_rec_dict)
+            if plan is not None:
+                for (target_id, upd_map, del_set) in targets:
+                    plan.add(target_id, upd_map, del_set, chunk.powerdns_rec_dict)
+            if checkpoint is not None:
+                checkpoint.chunk_done(
+                    host_id, processed_count, chunk.last_domain_id, csv_reporter.position())
+
+        logger.info("Host #{}: processed domains: {}; total: {}".format(
+            host_id, processed_count, domains_count))
+
+
+def _fan_out(chunk, fanout):
+    """Returns [(host_id, upd_map, del_set), ...] of other hosts with the same domains"""
+    member_fixes = {}
+    # (idn_host, rr_type, rec_data, ttl, prio, domain_id, domain_name)
+    for (rec_id, ttl) in chunk.upd_map.items():
+        for member_id in fanout.get(chunk.powerdns_rec_dict[rec_id][5], ()):
+            member_fixes.setdefault(member_id, ({}, set()))[0][rec_id] = ttl
+    for rec_id in chunk.del_set:
+        for member_id in fanout.get(chunk.powerdns_rec_dict[rec_id][5], ()):
+            member_fixes.setdefault(member_id, ({}, set()))[1].add(rec_id)
+    return [(member_id, upd_map, del_set)
+            for (member_id, (upd_map, del_set)) in sorted(member_fixes.items())]
+
+
+def _isolated_synchronize_host(host_id, host_sync_domains, host_assignments, connect, **kwargs):
+    """
+    Synchronizes a single host and returns host_id on failure, None on success,
+    so a broken PowerDNS node does not abort synchronization of the others.
+    """
+    checkpoint = kwargs['checkpoint']
+    if checkpoint is not None and checkpoint.is_host_done(host_id):
+        logger.info("PowerDNS host #{} is already synchronized".format(host_id))
+        return None
+    if host_id in host_sync_domains:
+        kwargs['sync_domains'] = host_sync_domains[host_id]
+    if host_assignments.get(host_id) is not None:
+        kwargs['pdns_domains'] = host_assignments[host_id].pdns_domains
+        kwargs['fanout'] = host_assignments[host_id].fanout
+    host_conn = None
+    try:
+        if connect is not None:
+            host_conn = kwargs['db_conn'] = connect()
+        synchronize_host(host_id=host_id, **kwargs)
+        if checkpoint is not None:
+            checkpoint.host_done(host_id)
+    except Exception:
+        save_traceback()
+        logger.error("Synchronization of PowerDNS host #{} failed: {}".format(
+            host_id, sys.exc_info()[1]))
+        metrics.inc('failed_hosts', host=host_id)
+        if connect is None:
+            _end_failed_hub_transaction(kwargs['db_conn'])
+        return host_id
+    finally:
+        if host_conn is not None:
+            host_conn.close()
+    return None
+
+
+def _end_failed_hub_transaction(db_conn):
+    # a failed Hub statement aborts the transaction, later Hub queries would fail too
+    if not hub_transaction_failed(db_conn):
+        return
+    try:
+        db_conn.rollback()
+    except Exception:
+        logger.warning("Hub transaction can not be rolled back: {}".format(sys.exc_info()[1]))
+
+
 def synchronize(
     db_conn, csv_reporter,
     hosts, sync_domains, exclude_domains,
     skip_error_report, fix_errors,
+    parallel_hosts=1, hub_cache=None, digest_precheck=False, pipeline_depth=0,
+    matcher=MATCHER_DEFAULT, sync_state=None, host_sync_domains=None, checkpoint=None,
+    throttle=None, plan=None,
+    chunk_records=DEFAULT_CHUNK_RECORDS, chunk_seconds=DEFAULT_CHUNK_SECONDS,
+    hub_domain_index=None, consensus=False, connect=None,
 ):
+    """
+    With connect (() -> Hub connection) every host reads Hub through a connection
+    of its own, which is closed when the host is done, so a failed Hub statement
+    of one host does not abort the Hub transaction of the others. Otherwise all
+    hosts read Hub through db_conn and a failed host rolls back its transaction.
+    Hub records are read through hub_cache (see db.hub_cache.HubRecordCache) when
+    it is given, so the same domains are not re-queried from Hub for every host.
+    Likewise domain names are resolved to Hub IDs through hub_domain_index
+    (see db.hub_domains.HubDomainIndex) when it is given.
+    With digest_precheck only domains whose record digests differ are fully compared.
+    See synchronize_host for pipeline_depth, sync_state, checkpoint, throttle, plan,
+    chunk_records and chunk_seconds.
+    matcher is one of MATCHERS.
+    host_sync_domains ({host_id: sync_domains}) overrides sync_domains for some hosts.
+    With consensus domains which are identical on several hosts are matched once,
+    see processing.consensus.
+    Returns the list of hosts which failed to synchronize.
+    """
     csv_reporter.post_header()
 
-    for host_id in hosts:
-        pdns_domains = fetch_powerdns_domains(host_id, sync_domains, exclude_domains)
-        if not pdns_domains:
-            continue
-
-        processed_count = 0
-        domains_count = len(pdns_domains)
-        for domain_chunk in split_to_chunks(pdns_domains, DOMAINS_CHUNK_SIZE):
-            domain_ids, domain_names = zip(*domain_chunk)
-            powerdns_records = fetch_powerdns_records_by_domain_list(host_id, domain_ids)
-            hub_requested, hub_dns_records = fetch_hub_records_by_domain_list(db_conn, domain_names)
-
-            logger.info("Processed domains: {}; total: {}".format(processed_count, domains_count))
-            logger.info(
-                "Synchronizing DNS records of next {} domains between Server and PowerDNS host #{}",
-                len(domain_names), host_id
-            )
-
-            if hub_requested:
-                upd_map, del_set = match_dns_records(powerdns_records, hub_dns_records)
-
-                if not skip_error_report:
-                    report_errors(
-                        csv_reporter, host_id, upd_map, del_set,
-                        get_powerdns_report_dict(powerdns_records)
-                    )
-
-                if fix_errors:
-                    fix_records(host_id, upd_map, del_set)
-
-            processed_count += len(domain_chunk)
+    host_assignments = {}
+    if consensus:
+        host_assignments = plan_consensus(
+            hosts, sync_domains, exclude_domains, host_sync_domains or {}, parallel_hosts)
+        hosts = [host_id for host_id in hosts if host_id in host_assignments]
+
+    host_kwargs = dict(
+        db_conn=db_conn,
+        csv_reporter=csv_reporter,
+        sync_domains=sync_domains,
+        exclude_domains=exclude_domains,
+        skip_error_report=skip_error_report,
+        fix_errors=fix_errors,
+        hub_cache=hub_cache,
+        digest_precheck=digest_precheck,
+        pipeline_depth=pipeline_depth,
+        matcher=matcher,
+        sync_state=sync_state,
+        host_sync_domains=host_sync_domains or {},
+        host_assignments=host_assignments,
+        connect=connect,
+        checkpoint=checkpoint,
+        throttle=throttle,
+        plan=plan,
+        chunk_records=chunk_records,
+        chunk_seconds=chunk_seconds,
+        hub_domain_index=hub_domain_index,
+    )
+    sync_fn = functools.partial(_isolated_synchronize_host, **host_kwargs)
+
+    if parallel_hosts > 1 and len(hosts) > 1:
+        pool = ThreadPool(min(parallel_hosts, len(hosts)))
+        try:
+            results = pool.map(sync_fn, hosts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [sync_fn(host_id) for host_id in hosts]
+
+    failed_hosts = [host_id for host_id in results if host_id is not None]
+    # results of a failed leader are incomplete for the hosts it matched for
+    for host_id in list(failed_hosts):
+        if host_assignments.get(host_id) is not None:
+            failed_hosts.extend(members_of(host_assignments[host_id]))
+    failed_hosts = sorted(set(failed_hosts))
+    if failed_hosts:
+        logger.error("Synchronization failed for PowerDNS hosts: {}".format(
+            ', '.join(map(str, failed_hosts))))
 
     if not skip_error_report:
         logger.info(
             "Synchronization is complete, a difference report has been created: {}"
             .format(csv_reporter.get_report_path()))
+
+    return failed_hosts
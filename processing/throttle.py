@@ -0,0 +1,108 @@
+"""
+Throttling of fixes written to PowerDNS databases (--fix-rows-per-second,
+--max-fix-writers).
+
+PowerDNS serves queries from the same records table, so statements of a fix
+are paced to a number of rows per second per host and at most max_writers
+hosts are written at once. The rate of a host is halved when the latency of
+its statements rises well above the usual one of statements of a similar size
+and is raised back step by step while it stays normal.
+"""
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+from utils.metrics import metrics
+
+# a statement slower per row than BACKOFF_LATENCY_RATIO times the usual one of its size
+# class backs off; rows of a class differ less than this ratio, so a fixed cost of
+# every statement (su and psql startup) does not make shorter statements look slow
+BACKOFF_LATENCY_RATIO = 2.0
+BACKOFF_FACTOR = 0.5
+# the rate is raised by this part of the cap after every statement of normal latency
+RECOVERY_STEP = 0.1
+MIN_RATE_RATIO = 0.05
+# weight of the last statement in the usual latency
+LATENCY_SMOOTHING = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+def _size_class(rows):
+    # statements within a factor of two of rows are compared with each other
+    return max(rows, 1).bit_length()
+
+
+class _HostState(object):
+    __slots__ = ('rate', 'next_time', 'row_latencies')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = 0
+        self.row_latencies = {}  # size class -> usual latency per row
+
+
+class WriteThrottle(object):
+    """Shared by all hosts of a run, rows_per_second and max_writers may be None"""
+    def __init__(self, rows_per_second=None, max_writers=None, clock=time.time, sleep=time.sleep):
+        self.rows_per_second = rows_per_second
+        self._writers = threading.BoundedSemaphore(max_writers) if max_writers else None
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def statement_rows(self):
+        """Rows per statement, so that a statement takes about a second of the rate"""
+        return self.rows_per_second
+
+    def _host_state(self, host_id):
+        with self._lock:
+            if host_id not in self._hosts:
+                self._hosts[host_id] = _HostState(self.rows_per_second)
+            return self._hosts[host_id]
+
+    @contextmanager
+    def write(self, host_id, rows):
+        """Wraps a statement writing rows to the host"""
+        state = self._host_state(host_id)
+        if self.rows_per_second:
+            delay = state.next_time - self._clock()
+            if delay > 0:
+                metrics.inc('fix_throttled_seconds', delay, host=host_id)
+                self._sleep(delay)
+
+        if self._writers is not None:
+            self._writers.acquire()
+        try:
+            started = self._clock()
+            yield
+            latency = self._clock() - started
+        finally:
+            if self._writers is not None:
+                self._writers.release()
+
+        metrics.observe('fix_statement_seconds', latency, host=host_id)
+        if self.rows_per_second:
+            self._adapt(host_id, state, rows, latency)
+            state.next_time = started + float(rows) / state.rate
+
+    def _adapt(self, host_id, state, rows, latency):
+        size_class = _size_class(rows)
+        row_latency = latency / max(rows, 1)
+        usual = state.row_latencies.get(size_class)
+        if usual is None:
+            state.row_latencies[size_class] = row_latency
+            return
+        if row_latency > usual * BACKOFF_LATENCY_RATIO:
+            rate = max(state.rate * BACKOFF_FACTOR, self.rows_per_second * MIN_RATE_RATIO)
+            if rate < state.rate:
+                logger.info("Host #{}: statement latency {:.3f}s, fix rate is lowered to {:.0f} "
+                            "rows/s".format(host_id, latency, rate))
+            state.rate = rate
+            # a slow statement does not become the usual latency at once
+            return
+        state.rate = min(state.rate + self.rows_per_second * RECOVERY_STEP, self.rows_per_second)
+        state.row_latencies[size_class] = usual + (row_latency - usual) * LATENCY_SMOOTHING
@@ -1,8 +1,12 @@
+from __future__ import absolute_import
+
 import sys
 import time
 
 import logging
 
+from utils.metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -19,8 +23,8 @@ def log_remote_errors(func):
         except:
             save_traceback()
             logger.error(
-                "Failed to perform remote operation '{}', with args: {}, {}, reason: {}",
-                func.func_name, args, kwargs, sys.exc_info()[0]
+                "Failed to perform remote operation '{}', with args: {}, {}, reason: {}".format(
+                    func.func_name, args, kwargs, sys.exc_info()[0])
             )
             raise
     _safe_func.func_name = func.func_name
@@ -40,7 +44,7 @@ def log_start_end(func):
                 return arg
 
         display_args = [get_display_view(a) for a in args]
-        display_kwargs = {k: get_display_view(v) for k, v in kwargs}
+        display_kwargs = {k: get_display_view(v) for k, v in kwargs.items()}
 
         logger.debug("Enter function '{}', args: {}, kwargs: {}"
                      .format(func.func_name, display_args, display_kwargs))
@@ -55,11 +59,13 @@ def log_start_end(func):
 
 
 def measure_worktime(f):
-    def _wrap(*args):
+    def _wrap(*args, **kwargs):
         time1 = time.time()
-        ret = f(*args)
-        time2 = time.time()
-        print '{} function took {:0.3f} ms'.format(f.func_name, (time2 - time1) * 1000.0)
-        return ret
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = time.time() - time1
+            metrics.observe('function_seconds', elapsed, function=f.func_name)
+            logger.debug('{} function took {:0.3f} ms'.format(f.func_name, elapsed * 1000.0))
     _wrap.func_name = f.func_name
     return _wrap
@@ -0,0 +1,195 @@
+"""
+Counters and latency histograms of synchronization stages.
+
+    with metrics.stage('match', host_id, chunk_no):
+        ...
+    metrics.inc('records_fetched', len(records), host=host_id)
+
+The registry is shared by all threads of a run and is dumped with write_json()
+or write_prometheus() (a node_exporter textfile) at the end of it, or after
+every cycle of a daemon.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import resource
+import threading
+import time
+
+from contextlib import contextmanager
+
+from utils.utils import write_file_atomically
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2 has no tracemalloc, peak RSS is used instead
+    tracemalloc = None
+
+PROM_PREFIX = 'powerdns_sync_'
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+logger = logging.getLogger(__name__)
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, trace_memory=False):
+        with self._lock:
+            self._counters = {}  # (name, labels_key) -> value
+            self._histograms = {}  # (name, labels_key) -> Histogram
+            self._gauges = {}  # (name, labels_key) -> value
+            self._chunks = []
+            self._started = time.time()
+            self._trace_memory = trace_memory
+        if trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset_chunks(self):
+        """Drops latencies of chunks, a daemon does it once they are written after a cycle"""
+        with self._lock:
+            self._chunks = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def set_max(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = max(self._gauges.get(key, value), value)
+
+    @contextmanager
+    def stage(self, name, host_id=None, chunk_no=None):
+        """
+        Measures latency of a stage per host, and per chunk in the JSON summary.
+        With trace_memory also the peak of memory (tracemalloc or RSS) per stage.
+        Peaks of stages running in parallel threads are not separated.
+        """
+        if self._trace_memory and tracemalloc is not None and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.time()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.observe('stage_seconds', elapsed, stage=name, host=host_id)
+            if failed:
+                self.inc('stage_failures', stage=name, host=host_id)
+            if self._trace_memory:
+                self.set_max('stage_memory_peak_bytes', _memory_peak(), stage=name)
+            if chunk_no is not None:
+                with self._lock:
+                    self._chunks.append({'host': host_id, 'chunk': chunk_no, 'stage': name,
+                                         'seconds': round(elapsed, 6), 'failed': failed})
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self._started,
+                'duration_seconds': time.time() - self._started,
+                'counters': [
+                    dict(name=name, labels=dict(labels), value=value)
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'gauges': [
+                    dict(name=name, labels=dict(labels), value=value)
+                    for (name, labels), value in sorted(self._gauges.items())
+                ],
+                'histograms': [
+                    dict(name=name, labels=dict(labels), count=h.count, sum=h.sum, max=h.max,
+                         buckets=[[_bound_str(b), c] for b, c in zip(h.buckets, h.counts)])
+                    for (name, labels), h in sorted(self._histograms.items())
+                ],
+                'chunks': list(self._chunks),
+            }
+
+    def write_json(self, path):
+        write_file_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+        logger.info("Metrics have been written to {}".format(path))
+
+    def write_prometheus(self, path):
+        lines = []
+        typed = set()
+
+        def add_type(name, prom_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {}{} {}'.format(PROM_PREFIX, name, prom_type))
+
+        summary = self.summary()
+        add_type('run_duration_seconds', 'gauge')
+        lines.append(_prom_line('run_duration_seconds', {}, summary['duration_seconds']))
+        for kind, prom_type in (('counters', 'counter'), ('gauges', 'gauge')):
+            for metric in summary[kind]:
+                add_type(metric['name'], prom_type)
+                lines.append(_prom_line(metric['name'], metric['labels'], metric['value']))
+        for h in summary['histograms']:
+            add_type(h['name'], 'histogram')
+            cumulative = 0
+            for bound, count in h['buckets']:
+                cumulative += count
+                labels = dict(h['labels'], le=bound)
+                lines.append(_prom_line(h['name'] + '_bucket', labels, cumulative))
+            lines.append(_prom_line(h['name'] + '_sum', h['labels'], h['sum']))
+            lines.append(_prom_line(h['name'] + '_count', h['labels'], h['count']))
+        write_file_atomically(path, '\n'.join(lines) + '\n')
+        logger.info("Metrics have been written to {}".format(path))
+
+
+def _bound_str(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _prom_line(name, labels, value):
+    labels_str = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in sorted(labels.items()))
+    return '{}{}{} {}'.format(PROM_PREFIX, name,
+                              '{' + labels_str + '}' if labels_str else '', value)
+
+
+def _memory_peak():
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+metrics = Metrics()
@@ -0,0 +1,59 @@
+import Queue
+import sys
+import threading
+
+_ITEM = 'item'
+_ERROR = 'error'
+_END = 'end'
+
+
+def prefetch(iterable, depth, name=None):
+    """
+    Runs iterable in a background thread, keeping at most depth items ready ahead
+    of the consumer. Exceptions raised by the producer are re-raised in the consumer.
+    With depth < 1 the iterable is consumed in the caller's thread.
+    """
+    if depth < 1:
+        return iter(iterable)
+    return _prefetched(iterable, depth, name)
+
+
+def _prefetched(iterable, depth, name):
+    queue = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((_ITEM, item)):
+                    return
+        except Exception:
+            put((_ERROR, sys.exc_info()))
+            return
+        put((_END, None))
+
+    producer = threading.Thread(target=produce, name=name)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            kind, payload = queue.get()
+            if kind == _ITEM:
+                yield payload
+            elif kind == _ERROR:
+                raise payload[0], payload[1], payload[2]
+            else:
+                return
+    finally:
+        # the consumer is done or has failed, let the producer go
+        stopped.set()
+        producer.join()
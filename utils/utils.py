@@ -1,4 +1,6 @@
 import itertools
+import os
+import tempfile
 import time
 
 
@@ -16,6 +18,35 @@ def split_to_chunks(item_list, chunk_size, transform_fn=lambda x: x):
     return chunks
 
 
+def split_to_sized_chunks(item_list, max_size, size_fn, transform_fn=lambda x: x):
+    """
+    Splits item_list into chunks whose total size (a sum of size_fn(item)) does not
+    exceed max_size. An item bigger than max_size makes a chunk of its own.
+    """
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for item in item_list:
+        item_size = size_fn(item)
+        if chunk and chunk_size + item_size > max_size:
+            chunks.append(transform_fn(chunk))
+            chunk = []
+            chunk_size = 0
+        chunk.append(item)
+        chunk_size += item_size
+    if chunk:
+        chunks.append(transform_fn(chunk))
+    return chunks
+
+
 def timestamp():
     now = time.time()
     return time.strftime('%Y-%m-%d %H:%M:%S') + '{:03d}'.format(int((now - int(now)) * 1000))
+
+
+def write_file_atomically(path, content):
+    """Readers of path see either the old or the new content, never a partial one"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_path, path)